@@ -9,23 +9,20 @@ import re
 import subprocess
 import argparse
 
-parser = argparse.ArgumentParser(description="Restore parameters")
-
-parser.add_argument('--account', required=True, help='AWS account to use')
-parser.add_argument('--region', required=True, help='AWS region to use')
-parser.add_argument('--file', required=True, help='Path to the JSON file')
-
-args = parser.parse_args()
+def add_arguments(parser):
+    parser.add_argument('--account', required=True, help='AWS account to use')
+    parser.add_argument('--region', required=True, help='AWS region to use')
+    parser.add_argument('--file', required=True, help='Path to the JSON file')
 
-file_name = args.file
-region = args.region
-account = args.account
+parser = argparse.ArgumentParser(description="Restore parameters")
+add_arguments(parser)
 
-with open(file_name, 'r') as f:
-        data = json.load(f)
+def load_parameters(file_name):
+    with open(file_name, 'r') as f:
+        return json.load(f)
 
 # Generate a list of parameter names that match /MunaVault/cluster-stack-env/sslcert/dashboard        
-def generate_ssl_parameters():
+def generate_ssl_parameters(data):
     
     pattern = re.compile(r"^/MyVault/.+/sslcert/dashboard/.+/.+$")    
 
@@ -38,7 +35,7 @@ def generate_ssl_parameters():
     return matching_names
 
 # Go through the parameter name list that matches /MyVault/cluster-stack-env/sslcert/dashboard and do ssm put-parameter
-def restore_ssl_parameters(name):
+def restore_ssl_parameters(data, name, account, region):
     for param in data.get('Parameters', []):
         if param.get('Name') == name:
             value = param.get('Value')
@@ -66,9 +63,14 @@ def restore_ssl_parameters(name):
                 print(f"Error updating {name}: {e.stderr}") 
         
 
-ssl_parameters = generate_ssl_parameters()   
+def main(args):
+    data = load_parameters(args.file)
+    ssl_parameters = generate_ssl_parameters(data)
+
+    for name in ssl_parameters:
+        restore_ssl_parameters(data, name, args.account, args.region)
 
-for name in ssl_parameters:
-    restore_ssl_parameters(name) 
+if __name__ == "__main__":
+    main(parser.parse_args())
 
     
\ No newline at end of file
@@ -1,43 +1,60 @@
 # Usage
-# aws-vault exec <account> -- python3 cf_changes.py --stack <cluster>-<stack>-<env> --bucket <s3-bucket> --region <aws-region>
+# aws-vault exec <account> -- python3 cf_changes.py --stack <cluster>-<stack>-<env> --bucket <s3-bucket> --region <aws-region> [--trace <file.json>]
+# aws-vault exec <account> -- python3 cf_changes.py --fleet <fleet-file> --bucket <s3-bucket> [--region <default-region>] [--max-workers 10]
+#
+# The fleet file lists one stack per line as "<cluster>-<stack>-<env> [<aws-region>]", lines starting with # are ignored.
+# The stacks are changed at once, the describe calls of all of them share --api-rate calls per second per region
+# so the workers don't get throttled, and a summary of each stack's status and timing is printed at the end.
 
-import json
-import boto3
 import argparse
+import copy
 import os
+import sys
 import time
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-parser = argparse.ArgumentParser(description="Cloudformation changes and resource import")
-parser.add_argument('--stack', required=True, help='CF stack cluster-stack-env')
-parser.add_argument('--bucket', required=True, help='S3 bucket to store the CF templates')
-parser.add_argument('--region', required=True, help='region')
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import clients, tracing
+from common.artifacts import template_store
+from common.fleet import read_fleet_file
+from common.rate_limit import limit_calls
+from common.stack_events import StackEvents, wait_for_change_set, wait_until_stable
+from common.stacks import stack_cache
+from common.template_checks import check_template
+from common.template_diff import diff_templates
+
+TEMPLATE_KEY_PREFIX = "rds-encryption-cf-templates"
+
+# The event stream stops at the first *_FAILED event, so the cap only has to cover slow RDS updates that succeed
+STACK_WAIT_TIMEOUT = 1800
 
-args = parser.parse_args()
+# The calls every worker keeps making while it waits, the ones fleet mode rate limits
+DESCRIBE_OPERATIONS = ['DescribeStacks', 'GetTemplate', 'DescribeStackEvents', 'DescribeChangeSet']
 
-cf_stack = args.stack
-s3_bucket = args.bucket
-aws_region = args.region
+def add_arguments(parser):
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--stack', help='CF stack cluster-stack-env')
+    target.add_argument('--fleet', help='file listing the stacks to change, one "<stack> [<region>]" per line')
+    parser.add_argument('--bucket', required=True, help='S3 bucket to store the CF templates')
+    parser.add_argument('--region', help='region, default region for fleet entries without one')
+    parser.add_argument('--max-workers', type=int, default=10, help='number of stacks to change at once in fleet mode')
+    parser.add_argument('--api-rate', type=float, default=4, help='CF describe calls per second per region shared by the workers in fleet mode')
 
-cf = boto3.client('cloudformation', region_name=aws_region)
+parser = argparse.ArgumentParser(description="Cloudformation changes and resource import")
+add_arguments(parser)
+parser.add_argument('--trace', help='write a Chrome trace of the phases and AWS API calls to this file and print a call summary')
 
-def get_stack(stack_name):
+def get_stack(cf, stack_name):
     try:
-        response = cf.describe_stacks(
-        StackName=stack_name
-        )
-        return response['Stacks'][0]
+        return stack_cache(cf).get_stack(stack_name)
     except:
         return None
         
-def get_current_stack_template(stack_name):
+def get_current_stack_template(cf, stack_name):
     try:
-        response = cf.get_template(
-            StackName=stack_name,
-            TemplateStage='Original'  
-        )
-        template_body = response['TemplateBody']
-        return template_body
+        return stack_cache(cf).get_template(stack_name)
     except Exception as e:
         print("Couldn't fetch template:", e)
         return None
@@ -46,34 +63,28 @@ def modify_stack_template(cf_template):
     cf_template['Resources']['MySQLServer']['DeletionPolicy'] = "Retain"
     return cf_template
 
-def upload_template_to_s3(template_file, bucket_name, key_prefix="rds-encryption-cf-templates"):
-    s3 = boto3.client('s3', region_name=aws_region)
-    key = f"{key_prefix}/{template_file}"
-    s3.upload_file(template_file, bucket_name, key)
-    url = f"https://{bucket_name}.s3.amazonaws.com/{key}"
-    return url
+def get_template_store(s3, bucket):
+    return template_store(s3, bucket, TEMPLATE_KEY_PREFIX)
 
-def download_template_from_s3(template_file, bucket_name, local_file, key_prefix="rds-encryption-cf-templates"):
-    s3 = boto3.client('s3', region_name=aws_region)
-    key = f"{key_prefix}/{template_file}"
-    s3.download_file(bucket_name, key, local_file)
+def stack_parameters(stack):
+    # NoEcho values come back masked, they can't be used to resolve anything
+    return {
+        parameter['ParameterKey']: parameter.get('ResolvedValue', parameter['ParameterValue'])
+        for parameter in stack['Parameters']
+        if parameter.get('ParameterValue') != '****'
+    }
 
-def check_s3_file_exists(bucket, template_path,  key_prefix="rds-encryption-cf-templates"):
-    try:
-        s3 = boto3.client('s3', region_name = aws_region)
-        response = s3.get_object(
-            Bucket=bucket,
-            Key=f"{key_prefix}/{template_path}",
-        )
-        return response
-    except:
-        return None
+def put_checked_template(s3, bucket, stack_name, stack, template, resources_to_import=None):
+    # Fails before anything is uploaded or sent to CF
+    check_template(template, resources_to_import, stack_parameters(stack), stack_name)
+    return get_template_store(s3, bucket).put(template)
 
-def update_stack(stack_name, stack, template_url):
+def update_stack(cf, stack_name, stack, template, timeout=STACK_WAIT_TIMEOUT):
+    events = StackEvents(cf, stack_name).start()
     try:
             cf.update_stack(
             StackName=stack_name,
-            TemplateURL=template_url,
+            **template.template_args(),
             Parameters=stack['Parameters'],
             Capabilities=['CAPABILITY_IAM'],
             Tags=stack['Tags'],
@@ -81,14 +92,11 @@ def update_stack(stack_name, stack, template_url):
             )
     except Exception as e:
         raise e
+    stack_cache(cf).invalidate(stack_name)
     
     try:
         print("Waiting for stack update to finish...")
-        waiter = cf.get_waiter('stack_update_complete')
-        waiter.wait(
-            StackName=stack_name,
-            WaiterConfig={'Delay': 5, 'MaxAttempts': 20}
-        )
+        events.wait(timeout=timeout)
         print("Stack update completed\n")
     except Exception as e:
         raise e
@@ -134,7 +142,7 @@ def inject_rds_resource(template, rds_resource_name, rds_resource_definition, af
     template['Resources'] = new_resources
     return template    
 
-def create_import_changeset(stack, stack_name, template_url, resources_to_import):
+def create_import_changeset(cf, stack, stack_name, template, resources_to_import, timeout=STACK_WAIT_TIMEOUT):
     change_set_name = f"import-changeset"
     print(f"Creating change set: {change_set_name}")
     
@@ -143,153 +151,230 @@ def create_import_changeset(stack, stack_name, template_url, resources_to_import
         ChangeSetName=change_set_name,
         ChangeSetType='IMPORT',
         ResourcesToImport=resources_to_import,
-        TemplateURL=template_url,
+        **template.template_args(),
         Parameters=stack['Parameters'],
         Capabilities=['CAPABILITY_IAM'],
         Tags=stack['Tags']
     )
 
     print("Waiting for change set to be created...")
-    waiter = cf.get_waiter('change_set_create_complete')
     try:
-        waiter.wait(
-            ChangeSetName=change_set_name,
-            StackName=stack_name,
-            WaiterConfig={'Delay': 5, 'MaxAttempts': 20}
-        )
+        wait_for_change_set(cf, stack_name, change_set_name, timeout=timeout)
     except Exception as e:
         print("Change set creation failed:", e)
         return None
 
     return change_set_name
 
-def execute_import_changeset(stack_name, change_set_name):
+def execute_import_changeset(cf, stack_name, change_set_name, timeout=STACK_WAIT_TIMEOUT):
     print(f"Executing change set: {change_set_name}")
+    events = StackEvents(cf, stack_name).start()
     cf.execute_change_set(
         ChangeSetName=change_set_name,
         StackName=stack_name
     )
+    stack_cache(cf).invalidate(stack_name)
     print("Waiting for import to complete...")
-    waiter = cf.get_waiter('stack_import_complete')
     try:
-        waiter.wait(
-            StackName=stack_name,
-            WaiterConfig={'Delay': 10, 'MaxAttempts': 30}
-        )
+        events.wait(timeout=timeout)
         print("Import completed successfully.\n")
+        return True
     except Exception as e:
         print("Change set execution failed:", e)
         return None          
 
-if __name__ == "__main__":
-    # Get the original stack details before starting the update operations
-    stack = get_stack(cf_stack)
-
-    # Download the current original template and save it in S3 - check if template already exists in S3
+def backup_original_template(cf, s3, stack_name, bucket):
     print("### Fetching the current CF template...")
-    template_exist = check_s3_file_exists(s3_bucket, f"{cf_stack}-original.json")
-    if template_exist == None:
-        current_template = get_current_stack_template(cf_stack)
-        current_template_json = json.dumps(current_template, indent=2)
-        with open(f"{cf_stack}-original.json", "w") as f:
-            f.write(current_template_json)
-        upload_template_to_s3(f"{cf_stack}-original.json", s3_bucket)
-        os.remove(f"{cf_stack}-original.json")
-        print(f"CF template has been fetched and saved in S3 bucket {s3_bucket}/rds-encryption-cf-templates\n")
-        time.sleep(3)
+    templates = get_template_store(s3, bucket)
+    if not templates.exists_named(f"{stack_name}-original.json"):
+        current_template = get_current_stack_template(cf, stack_name)
+        if current_template == None:
+            return None
+        templates.put_named(f"{stack_name}-original.json", current_template)
+        print(f"CF template has been fetched and saved in S3 bucket {bucket}/rds-encryption-cf-templates\n")
     else:
-        print("The current CF template already exists in S3 bucket, proceeding to next step...\n")   
-        time.sleep(3)     
+        print("The current CF template already exists in S3 bucket, proceeding to next step...\n")
+    return f"{stack_name}-original.json"
 
+def retain_mysql_resource(cf, s3, stack_name, bucket, stack, updated_template):
     # Update the template to set DeletionPolicy to Retain for MySQLServer resource
     print("### Updating the CF template to set DeletionPolicy to Retain for resource MySQLServer...")
-    current_template = get_current_stack_template(cf_stack)
-    updated_template = modify_stack_template(current_template)
-    updated_template_json = json.dumps(updated_template, indent=2)
-    with open(f"{cf_stack}-rds-retain.json", "w") as f:
-        f.write(updated_template_json)
-    cf_template_url = upload_template_to_s3(f"{cf_stack}-rds-retain.json", s3_bucket)
-    os.remove(f"{cf_stack}-rds-retain.json")
+    cf_template = put_checked_template(s3, bucket, stack_name, stack, updated_template)
     print("CF template updated")
-    time.sleep(3)
     # Run Cloudformation Update to set DeletionPolicy to Retain
     print("Running the CF Update to set DeletionPolicy to Retain for MySQLServer...")
-    update_stack(cf_stack, stack, cf_template_url)
+    update_stack(cf, stack_name, stack, cf_template)
 
+def remove_mysql_resource(cf, s3, stack_name, bucket, stack, updated_template_mysql_removed):
     # Update the template to remove the MySQLServer resource
     print("### Updating the CF template to remove the original unencrypted MySQLServer resource and dependencies...")
-    current_template_with_retain = get_current_stack_template(cf_stack)
-    updated_template_mysql_removed = remove_mysql_resource_from_template(current_template_with_retain)
-    updated_template_mysql_removed_json = json.dumps(updated_template_mysql_removed, indent=2)
-    with open(f"{cf_stack}-rds-remove.json", "w") as f:
-        f.write(updated_template_mysql_removed_json)
-    cf_template_url = upload_template_to_s3(f"{cf_stack}-rds-remove.json", s3_bucket)
-    os.remove(f"{cf_stack}-rds-remove.json")
+    cf_template = put_checked_template(s3, bucket, stack_name, stack, updated_template_mysql_removed)
     print("CF template updated")
-    time.sleep(3)
     # Run Cloudformation Update to remove unencrypted MySQLServer resource
     print("Running the CF Update to remove unencrypted MySQLServer resource and dependencies...")
-    update_stack(cf_stack, stack, cf_template_url)
-
-    # Import the new encrypted MySQL resource into Cloudformation
-    print("### Importing new encrypted RDS resource into Cloudformation...")
-    print("Creating the CF template for import operation....")
-    time.sleep(3)
-
-    current_template_after_rds_removed = get_current_stack_template(cf_stack)
-    rds_resource_name = "MySQLServer"
-
-    download_template_from_s3(f"{cf_stack}-original.json", s3_bucket, f"{cf_stack}-original.json")
-    with open(f"{cf_stack}-original.json", "r") as f:
-            import_template = json.loads(f.read())
-    import_template['Resources']['MySQLServer']['DeletionPolicy'] = "Retain"
-    import_template['Resources']['MySQLServer']['Properties']['StorageEncrypted'] = True
-    import_template['Resources']['MySQLServer']['Properties']['DBInstanceIdentifier']['Fn::Join'][1].insert(3, "encrypted")
-    os.remove(f"{cf_stack}-original.json")
-    
-    rds_resource_definition = import_template['Resources']['MySQLServer']
-    resource_to_import = [
+    update_stack(cf, stack_name, stack, cf_template)
+
+def encrypted_resource_definition(original_template):
+    # The original MySQLServer, pointed at the -encrypted instance
+    rds_resource_definition = copy.deepcopy(original_template['Resources']['MySQLServer'])
+    rds_resource_definition['DeletionPolicy'] = "Retain"
+    rds_resource_definition['Properties']['StorageEncrypted'] = True
+    rds_resource_definition['Properties']['DBInstanceIdentifier']['Fn::Join'][1].insert(3, "encrypted")
+    return rds_resource_definition
+
+def encrypted_resource_to_import(stack_name):
+    return [
         {
         "ResourceType": "AWS::RDS::DBInstance",
-        "LogicalResourceId": rds_resource_name,
+        "LogicalResourceId": "MySQLServer",
         "ResourceIdentifier": {
-            "DBInstanceIdentifier": f"{cf_stack}-encrypted"
+            "DBInstanceIdentifier": f"{stack_name}-encrypted"
             }
         }
     ]
 
-    after_resource_name = "RdsSecGroup"
-    updated_template_with_new_rds = inject_rds_resource(current_template_after_rds_removed, rds_resource_name, rds_resource_definition, after_resource_name)
-    updated_template_with_new_rds_json = json.dumps(updated_template_with_new_rds, indent=2)
-    with open(f"{cf_stack}-rds-import.json", "w") as f:
-        f.write(updated_template_with_new_rds_json)
-    cf_template_url = upload_template_to_s3(f"{cf_stack}-rds-import.json", s3_bucket)
-    os.remove(f"{cf_stack}-rds-import.json")
+def import_encrypted_resource(cf, s3, stack_name, bucket, stack, updated_template_with_new_rds):
+    # Import the new encrypted MySQL resource into Cloudformation
+    print("### Importing new encrypted RDS resource into Cloudformation...")
+    resource_to_import = encrypted_resource_to_import(stack_name)
+    cf_template = put_checked_template(s3, bucket, stack_name, stack, updated_template_with_new_rds, resource_to_import)
     print("CF template for import operation has been created...")
-    time.sleep(3)
     
     # Create import change set 
-    import_resource_change_set = create_import_changeset(stack, cf_stack, cf_template_url, resource_to_import)
+    import_resource_change_set = create_import_changeset(cf, stack, stack_name, cf_template, resource_to_import)
     # Execute changeset to import encrypted RDS
+    imported = False
     if import_resource_change_set:
-        execute_import_changeset(cf_stack, import_resource_change_set)
+        imported = execute_import_changeset(cf, stack_name, import_resource_change_set)
+    # The dependencies update needs the imported MySQLServer, it would create a new instance otherwise
+    if not imported:
+        raise SystemExit(f"Import of '{stack_name}-encrypted' didn't complete, rerun once the stack is fixed")
 
+def add_dependencies(cf, s3, stack_name, bucket, stack, updated_template_deps_added):
     # Update dependencies - Add resources for "RDSCPUCreditBalanceAlarm", "RDSLowDiskSpaceAlarm" and the output "MySQLEndpoint"  
     print("### Updating the CF template to add dependent resources and output...")
-    current_template_with_new_rds = get_current_stack_template(cf_stack)
-    download_template_from_s3(f"{cf_stack}-original.json", s3_bucket, f"{cf_stack}-original.json")
-    with open(f"{cf_stack}-original.json", "r") as f:
-            original_template = json.loads(f.read())
-
-    updated_template_deps_added = add_resources_output_to_template(current_template_with_new_rds, original_template)
-    updated_template_deps_added_json = json.dumps(updated_template_deps_added, indent=2)
-    with open(f"{cf_stack}-rds-update-deps.json", "w") as f:
-        f.write(updated_template_deps_added_json)
-    cf_template_url = upload_template_to_s3(f"{cf_stack}-rds-update-deps.json", s3_bucket)
-    os.remove(f"{cf_stack}-rds-update-deps.json")
-    os.remove(f"{cf_stack}-original.json")
+    cf_template = put_checked_template(s3, bucket, stack_name, stack, updated_template_deps_added)
     print("CF template updated")
-    time.sleep(3)
     # Run Cloudformation Update to add cloudwatch alarm resources and output that relates to RDS
     print("Running the CF Update to add dependent resources and output...")
-    update_stack(cf_stack, stack, cf_template_url)
\ No newline at end of file
+    update_stack(cf, stack_name, stack, cf_template)
+
+def plan_cf_changes(current_template, original_template):
+    # Works out the template of each phase from the live template, each phase starting from the previous
+    # one's. Returns (phase, template, changes) for every phase, changes is empty when the phase has
+    # nothing left to do: a run that stopped part way only does the phases it didn't finish
+    plan = []
+    template = current_template
+    mysql_server = template['Resources'].get('MySQLServer')
+    unencrypted = mysql_server is not None and mysql_server.get('Properties', {}).get('StorageEncrypted') is not True
+
+    for phase, build in (
+        ('retain-update', modify_stack_template),
+        ('remove-update', remove_mysql_resource_from_template)
+    ):
+        if not unencrypted:
+            plan.append((phase, None, []))
+            continue
+        target = build(copy.deepcopy(template))
+        plan.append((phase, target, diff_templates(template, target)))
+        template = target
+
+    if 'MySQLServer' in template['Resources']:
+        plan.append(('import', None, []))
+    else:
+        target = inject_rds_resource(copy.deepcopy(template), "MySQLServer", encrypted_resource_definition(original_template), "RdsSecGroup")
+        plan.append(('import', target, diff_templates(template, target)))
+        template = target
+
+    target = add_resources_output_to_template(copy.deepcopy(template), copy.deepcopy(original_template))
+    plan.append(('dependencies-update', target, diff_templates(template, target)))
+    return plan
+
+def print_plan(plan):
+    for phase, template, changes in plan:
+        if not changes:
+            print(f"{phase}: nothing to do, skipping")
+            continue
+        print(f"{phase}: {len(changes)} changes")
+        for change in changes:
+            print(f"  {change}")
+    print()
+
+PHASES = {
+    'retain-update': retain_mysql_resource,
+    'remove-update': remove_mysql_resource,
+    'import': import_encrypted_resource,
+    'dependencies-update': add_dependencies
+}
+
+def run_cf_changes(cf, s3, stack_name, bucket):
+    # A rerun after a failed update has to wait for CF's rollback to finish
+    wait_until_stable(cf, stack_name, timeout=STACK_WAIT_TIMEOUT)
+
+    # Get the original stack details before starting the update operations
+    stack = get_stack(cf, stack_name)
+
+    # Download the current original template and save it in S3 - check if template already exists in S3
+    with tracing.phase('backup-template', stack_name):
+        backup_original_template(cf, s3, stack_name, bucket)
+
+    # The live template is fetched once, the phases that wouldn't change anything are skipped
+    current_template = get_current_stack_template(cf, stack_name)
+    original_template = get_template_store(s3, bucket).get_named(f"{stack_name}-original.json")
+    plan = plan_cf_changes(current_template, original_template)
+    print_plan(plan)
+
+    phases_run = []
+    for phase, template, changes in plan:
+        if changes:
+            with tracing.phase(phase, stack_name):
+                PHASES[phase](cf, s3, stack_name, bucket, stack, template)
+            phases_run.append(phase)
+    return phases_run
+
+def run_fleet(jobs, bucket, max_workers, api_rate):
+    # Returns (status, elapsed, phases run, error) per (stack, region)
+    for region in {region for _, region in jobs}:
+        limit_calls(clients.get_client('cloudformation', region), DESCRIBE_OPERATIONS, api_rate, burst=max(1, int(api_rate * 2)))
+
+    def change_stack(stack_name, region):
+        start = time.monotonic()
+        try:
+            phases_run = run_cf_changes(clients.get_client('cloudformation', region), clients.get_client('s3', region), stack_name, bucket)
+        except (Exception, SystemExit) as e:
+            return 'failed', time.monotonic() - start, [], str(e)
+        return 'completed' if phases_run else 'unchanged', time.monotonic() - start, phases_run, None
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(change_stack, stack_name, region): (stack_name, region) for stack_name, region in jobs}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+    return results
+
+def print_fleet_summary(results):
+    print("### Fleet summary")
+    print(f"{'stack':<40} {'region':<16} {'status':<10} {'min':>6}  phases run")
+    for (stack_name, region), (status, elapsed, phases_run, error) in sorted(results.items()):
+        print(f"{stack_name:<40} {region:<16} {status:<10} {elapsed / 60:>6.1f}  {', '.join(phases_run) or '-'}")
+        if error:
+            print(f"  {error}")
+
+def main(args):
+    if args.stack:
+        if not args.region:
+            raise SystemExit("--region is required with --stack")
+        cf = clients.get_client('cloudformation', args.region)
+        s3 = clients.get_client('s3', args.region)
+        return run_cf_changes(cf, s3, args.stack, args.bucket)
+
+    jobs = read_fleet_file(args.fleet, args.region)
+    results = run_fleet(jobs, args.bucket, args.max_workers, args.api_rate)
+    print_fleet_summary(results)
+    return results
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    clients.configure(max_pool_connections=max(clients.DEFAULT_MAX_POOL_CONNECTIONS, args.max_workers * 2 + 1))
+    with tracing.traced(args.trace):
+        main(args)
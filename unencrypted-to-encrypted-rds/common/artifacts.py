@@ -0,0 +1,126 @@
+# Content-addressed store for the CF templates the scripts generate
+#
+# put() serializes a template in memory, compactly, and uploads it under <prefix>/sha256/<hash>.json,
+# unless that hash is already known locally or a head_object shows it is in the bucket. It returns a
+# Template whose template_args() pass the body inline when it is under the CF TemplateBody limit and
+# the S3 URL otherwise. put_named()/get_named() keep the templates that have to be found under a fixed
+# key, like the <stack>-original.json backup. Every body is also kept under .template-cache with a
+# manifest of which bucket keys hold which hash, so downloads of known keys are served locally.
+
+import hashlib
+import json
+import os
+import threading
+
+DEFAULT_CACHE_DIR = ".template-cache"
+
+# CloudFormation's limit for TemplateBody, bigger templates have to be passed as a TemplateURL
+TEMPLATE_BODY_LIMIT = 51200
+
+_manifest_lock = threading.Lock()
+
+class Template:
+    def __init__(self, body, url):
+        self.body = body
+        self.url = url
+
+    def template_args(self):
+        if len(self.body.encode()) <= TEMPLATE_BODY_LIMIT:
+            return {'TemplateBody': self.body}
+        return {'TemplateURL': self.url}
+
+class TemplateStore:
+    def __init__(self, s3, bucket, key_prefix, cache_dir=DEFAULT_CACHE_DIR):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key_prefix = key_prefix
+        self.cache_dir = cache_dir
+        self.manifest_path = os.path.join(cache_dir, "manifest.json")
+        self.lock = threading.Lock()
+        self.manifest = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as f:
+                self.manifest = json.load(f)
+
+    def _url(self, key):
+        return f"https://{self.bucket}.s3.amazonaws.com/{key}"
+
+    def _cache(self, key, body):
+        digest = hashlib.sha256(body.encode()).hexdigest()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        body_path = os.path.join(self.cache_dir, f"{digest}.json")
+        if not os.path.exists(body_path):
+            with open(body_path, 'w') as f:
+                f.write(body)
+        # Merged into what's on disk, other stores share the manifest
+        with _manifest_lock:
+            if os.path.exists(self.manifest_path):
+                with open(self.manifest_path, 'r') as f:
+                    self.manifest = {**json.load(f), **self.manifest}
+            self.manifest[f"{self.bucket}/{key}"] = digest
+            tmp_path = f"{self.manifest_path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(self.manifest, f, indent=2)
+            os.replace(tmp_path, self.manifest_path)
+
+    def _cached_body(self, key):
+        digest = self.manifest.get(f"{self.bucket}/{key}")
+        if digest is None:
+            return None
+        body_path = os.path.join(self.cache_dir, f"{digest}.json")
+        if not os.path.exists(body_path):
+            return None
+        with open(body_path, 'r') as f:
+            return f.read()
+
+    def _exists(self, key):
+        # Metadata only, doesn't download the object
+        try:
+            self.s3.head_object(Bucket=self.bucket, Key=key)
+            return True
+        except self.s3.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def put(self, template):
+        body = json.dumps(template, separators=(',', ':'))
+        key = f"{self.key_prefix}/sha256/{hashlib.sha256(body.encode()).hexdigest()}.json"
+        with self.lock:
+            if f"{self.bucket}/{key}" not in self.manifest:
+                if not self._exists(key):
+                    self.s3.put_object(Bucket=self.bucket, Key=key, Body=body.encode(), ContentType='application/json')
+                self._cache(key, body)
+        return Template(body, self._url(key))
+
+    def put_named(self, name, template):
+        body = json.dumps(template, separators=(',', ':'))
+        key = f"{self.key_prefix}/{name}"
+        with self.lock:
+            self.s3.put_object(Bucket=self.bucket, Key=key, Body=body.encode(), ContentType='application/json')
+            self._cache(key, body)
+        return Template(body, self._url(key))
+
+    def exists_named(self, name):
+        key = f"{self.key_prefix}/{name}"
+        with self.lock:
+            return self._exists(key)
+
+    def get_named(self, name):
+        key = f"{self.key_prefix}/{name}"
+        with self.lock:
+            body = self._cached_body(key)
+            if body is None:
+                body = self.s3.get_object(Bucket=self.bucket, Key=key)['Body'].read().decode()
+                self._cache(key, body)
+        return json.loads(body)
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def template_store(s3, bucket, key_prefix):
+    # One store per client, bucket and prefix, clients come from common.clients
+    with _stores_lock:
+        if (id(s3), bucket, key_prefix) not in _stores:
+            _stores[(id(s3), bucket, key_prefix)] = TemplateStore(s3, bucket, key_prefix)
+        return _stores[(id(s3), bucket, key_prefix)]
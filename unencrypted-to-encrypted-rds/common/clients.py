@@ -0,0 +1,58 @@
+# Shared boto3 client registry for the migration scripts
+#
+# One client per (profile, region, service), created once and reused by every module and thread, so
+# repeated calls go over warm pooled connections and credentials are only resolved once per profile.
+# The profile stands for the account, None being whatever aws-vault exported into the environment.
+# Clients use adaptive retry mode, which also rate limits client side once throttling starts.
+# Call configure() before the first get_client() to size the connection pools for the concurrency used.
+# boto3 is only imported when the first client is created, importing this module is cheap.
+
+import threading
+
+from common import tracing
+
+DEFAULT_MAX_POOL_CONNECTIONS = 50
+DEFAULT_MAX_ATTEMPTS = 10
+
+_pool_size = DEFAULT_MAX_POOL_CONNECTIONS
+_max_attempts = DEFAULT_MAX_ATTEMPTS
+_config = None
+_sessions = {}
+_clients = {}
+_lock = threading.Lock()
+
+def configure(max_pool_connections=None, max_attempts=None):
+    global _pool_size, _max_attempts
+    with _lock:
+        if _clients:
+            raise RuntimeError("configure() has to be called before the first client is created")
+        _pool_size = max_pool_connections or DEFAULT_MAX_POOL_CONNECTIONS
+        _max_attempts = max_attempts or DEFAULT_MAX_ATTEMPTS
+
+def get_session(profile=None):
+    with _lock:
+        return _get_session(profile)
+
+def _get_config():
+    global _config
+    if _config is None:
+        from botocore.config import Config
+        _config = Config(max_pool_connections=_pool_size, retries={'mode': 'adaptive', 'max_attempts': _max_attempts})
+    return _config
+
+def _get_session(profile):
+    if profile not in _sessions:
+        import boto3
+        session = boto3.session.Session(profile_name=profile)
+        tracing.instrument(session)
+        _sessions[profile] = session
+    return _sessions[profile]
+
+def get_client(service, region=None, profile=None):
+    # Sessions aren't thread safe, so clients are only ever created under the lock. The clients themselves
+    # are thread safe and shared by every thread calling into the same region and service
+    key = (profile, region, service)
+    with _lock:
+        if key not in _clients:
+            _clients[key] = _get_session(profile).client(service, region_name=region, config=_get_config())
+        return _clients[key]
@@ -0,0 +1,32 @@
+# Endpoints and password of a source instance and its -encrypted target, for the scripts that connect to both.
+# Endpoints come from the inventory and the password from the stack output MySQLPassword, unless they are given
+
+from common import clients
+from common.inventory import get_inventory
+from common.stacks import stack_cache
+
+def source_endpoint(region, db, source_host=None, password=None):
+    if source_host and password:
+        return source_host, password
+    if not db or not region:
+        raise SystemExit("--db and --region, or --source-host and --password, are required")
+    if not source_host:
+        source = get_inventory(region).get(db)
+        if source is None:
+            raise SystemExit(f"Couldn't find the endpoint of '{db}'")
+        source_host = source['Endpoint']['Address']
+    password = password or stack_cache(clients.get_client('cloudformation', region)).get_output(db, "MySQLPassword")
+    return source_host, password
+
+def database_endpoints(region, db, source_host=None, target_host=None, password=None):
+    if source_host and target_host and password:
+        return source_host, target_host, password
+    if not db or not region:
+        raise SystemExit("--db and --region, or --source-host, --target-host and --password, are required")
+    source_host, password = source_endpoint(region, db, source_host, password)
+    if not target_host:
+        target = get_inventory(region).get(f"{db}-encrypted")
+        if target is None:
+            raise SystemExit(f"Couldn't find the endpoint of '{db}-encrypted'")
+        target_host = target['Endpoint']['Address']
+    return source_host, target_host, password
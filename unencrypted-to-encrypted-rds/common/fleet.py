@@ -0,0 +1,16 @@
+# Fleet files shared by the scripts' fleet modes
+#
+# One "<cluster>-<stack>-<env> [<aws-region>]" per line, everything after a # is ignored
+
+def read_fleet_file(fleet_file, default_region=None):
+    jobs = []
+    with open(fleet_file, 'r') as f:
+        for line in f:
+            fields = line.split('#', 1)[0].split()
+            if not fields:
+                continue
+            region = fields[1] if len(fields) > 1 else default_region
+            if not region:
+                raise ValueError(f"No region given for '{fields[0]}' and no --region default set")
+            jobs.append((fields[0], region))
+    return jobs
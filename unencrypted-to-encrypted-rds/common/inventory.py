@@ -0,0 +1,139 @@
+# RDS instance inventory shared by the describe helpers
+#
+# The first lookup in a region pages through describe_db_instances once and indexes every instance by
+# identifier, VPC and subnet group. The listing is kept on disk under .rds-inventory for DEFAULT_TTL
+# seconds so the other scripts and reruns reuse it, an instance missing from it is looked up on its own.
+# Only attributes that don't change on their own (class, storage, network, endpoint, parameter groups)
+# should be read from here, status checks go to RDS directly. Call invalidate() after modifying or
+# creating an instance so the next lookup fetches it again. Instances listed without an endpoint, still being
+# created, are looked up again on every get() until they have one.
+# Timestamps in the cached descriptions are stored as strings.
+
+import json
+import os
+import threading
+import time
+
+from common import clients
+
+DEFAULT_CACHE_DIR = ".rds-inventory"
+DEFAULT_TTL = 900
+
+class Inventory:
+    def __init__(self, rds, region, profile=None, cache_dir=DEFAULT_CACHE_DIR, ttl=DEFAULT_TTL):
+        self.rds = rds
+        self.path = os.path.join(cache_dir, f"{profile or 'default'}-{region}.json")
+        self.ttl = ttl
+        self.instances = None
+        self.by_vpc = {}
+        self.by_subnet_group = {}
+        self.fetched = 0
+        self.lock = threading.Lock()
+
+    def _set_instances(self, instances, fetched):
+        self.instances = {instance['DBInstanceIdentifier']: instance for instance in instances}
+        self.fetched = fetched
+        self._reindex()
+
+    def _reindex(self):
+        self.by_vpc = {}
+        self.by_subnet_group = {}
+        for instance in self.instances.values():
+            subnet_group = instance.get('DBSubnetGroup', {})
+            if subnet_group.get('VpcId'):
+                self.by_vpc.setdefault(subnet_group['VpcId'], []).append(instance)
+            if subnet_group.get('DBSubnetGroupName'):
+                self.by_subnet_group.setdefault(subnet_group['DBSubnetGroupName'], []).append(instance)
+
+    def _read_cache(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, 'r') as f:
+            return json.load(f)
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'fetched': self.fetched, 'instances': list(self.instances.values())}, f, default=str)
+        os.replace(tmp_path, self.path)
+
+    def _load(self):
+        if self.instances is not None and time.time() - self.fetched < self.ttl:
+            return
+        cached = self._read_cache()
+        if cached and time.time() - cached['fetched'] < self.ttl:
+            self._set_instances(cached['instances'], cached['fetched'])
+            return
+        self._refresh()
+
+    def _refresh(self):
+        instances = []
+        paginator = self.rds.get_paginator('describe_db_instances')
+        for page in paginator.paginate():
+            instances.extend(page['DBInstances'])
+        # Round trip through JSON so fresh and cached descriptions look the same
+        self._set_instances(json.loads(json.dumps(instances, default=str)), time.time())
+        self._save()
+
+    def refresh(self):
+        with self.lock:
+            self._refresh()
+
+    def get(self, db_instance_id):
+        # Returns None when the instance doesn't exist
+        with self.lock:
+            self._load()
+            # An instance listed while it was still being created has no endpoint yet, look it up again
+            if 'Endpoint' not in self.instances.get(db_instance_id, {}):
+                try:
+                    response = self.rds.describe_db_instances(DBInstanceIdentifier=db_instance_id)
+                except self.rds.exceptions.DBInstanceNotFoundFault:
+                    return None
+                self.instances[db_instance_id] = json.loads(json.dumps(response['DBInstances'][0], default=str))
+                self._reindex()
+                self._save()
+            return self.instances[db_instance_id]
+
+    def all(self):
+        with self.lock:
+            self._load()
+            return list(self.instances.values())
+
+    def in_vpc(self, vpc_id):
+        with self.lock:
+            self._load()
+            return list(self.by_vpc.get(vpc_id, []))
+
+    def in_subnet_group(self, subnet_group_name):
+        with self.lock:
+            self._load()
+            return list(self.by_subnet_group.get(subnet_group_name, []))
+
+    def invalidate(self, db_instance_id=None):
+        # Drops one instance, or the whole listing, from memory and from the on-disk cache. Doesn't
+        # list anything itself, the on-disk cache is edited even when it has expired
+        with self.lock:
+            if db_instance_id is None:
+                self.instances = None
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+                return
+            if self.instances is None:
+                cached = self._read_cache()
+                if not cached:
+                    return
+                self._set_instances(cached['instances'], cached['fetched'])
+            if self.instances.pop(db_instance_id, None) is not None:
+                self._reindex()
+                self._save()
+
+_inventories = {}
+_inventories_lock = threading.Lock()
+
+def get_inventory(region, profile=None):
+    with _inventories_lock:
+        if (profile, region) not in _inventories:
+            rds = clients.get_client('rds', region, profile)
+            _inventories[(profile, region)] = Inventory(rds, region or rds.meta.region_name, profile)
+        return _inventories[(profile, region)]
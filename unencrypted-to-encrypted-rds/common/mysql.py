@@ -0,0 +1,53 @@
+# MySQL helpers shared by the scripts that talk to the databases themselves
+#
+# Needs PyMySQL (pip install pymysql), it is only imported when a connection is made
+
+SYSTEM_SCHEMAS = ('mysql', 'information_schema', 'performance_schema', 'sys')
+
+def connect(host, user, password, port=3306, database=None):
+    try:
+        import pymysql
+    except ImportError:
+        raise RuntimeError("PyMySQL is required to connect to the database, install it with 'pip install pymysql'")
+    return pymysql.connect(host=host, port=port, user=user, password=password, database=database, connect_timeout=10)
+
+def quote_identifier(name):
+    return "`" + name.replace("`", "``") + "`"
+
+def schema_filter(databases=None):
+    # SQL condition and parameters selecting the given schemas, or every non-system schema
+    schemas = databases or []
+    if schemas:
+        return f"IN ({', '.join(['%s'] * len(schemas))})", tuple(schemas)
+    return f"NOT IN ({', '.join(['%s'] * len(SYSTEM_SCHEMAS))})", SYSTEM_SCHEMAS
+
+def stream(connection, sql, params=(), batch_rows=1000):
+    # Yields the rows batch_rows at a time as the server sends them, instead of holding the whole result in memory
+    import pymysql.cursors
+    with connection.cursor(pymysql.cursors.SSCursor) as cursor:
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(batch_rows)
+            if not rows:
+                return
+            yield rows
+
+def master_status(connection):
+    # {'File', 'Position'} of the binlog, None when binary logging is off
+    with connection.cursor() as cursor:
+        cursor.execute("SHOW MASTER STATUS")
+        row = cursor.fetchone()
+    return {'File': row[0], 'Position': int(row[1])} if row else None
+
+def replica_status(connection):
+    # SHOW REPLICA STATUS as a dict, with the 8.0.22+ column names whatever the version, None when it isn't a replica
+    with connection.cursor() as cursor:
+        try:
+            cursor.execute("SHOW REPLICA STATUS")
+        except Exception:
+            cursor.execute("SHOW SLAVE STATUS")
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        names = [column[0].replace('Master', 'Source').replace('Slave', 'Replica') for column in cursor.description]
+    return dict(zip(names, row))
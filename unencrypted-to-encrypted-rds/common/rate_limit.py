@@ -0,0 +1,45 @@
+# Token buckets that share an API's call budget between the threads using a client
+#
+# limit_calls(client, operations, rate, burst) makes every call of those operations through the client
+# take a token first, blocking until one is free. Tokens come back at rate per second and up to burst
+# of them can be saved up. Clients come from common.clients, so every thread calling an account and
+# region's API draws from the same bucket. Retries aren't counted, the adaptive retry mode backs
+# those off on its own.
+
+import threading
+import time
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+def limit_calls(client, operations, rate, burst):
+    # Only the first call for a client registers anything, the bucket it returns is shared
+    with _buckets_lock:
+        if id(client) in _buckets:
+            return _buckets[id(client)]
+        bucket = TokenBucket(rate, burst)
+        service = client.meta.service_model.service_id.hyphenize()
+        for operation in operations:
+            client.meta.events.register_first(f"before-call.{service}.{operation}", lambda **kwargs: bucket.acquire())
+        _buckets[id(client)] = bucket
+        return bucket
@@ -0,0 +1,103 @@
+# Waits for CloudFormation stack operations by following the stack's events
+#
+# StackEvents.start() remembers the newest event of the stack before an operation is started, wait()
+# then reads only the events after it through describe_stack_events, prints each resource's progress
+# as it comes in and returns once the stack itself reaches a *_COMPLETE status. The first *_FAILED
+# event raises StackOperationFailed with its reason straight away, CF's rollback carries on without
+# us. Polls come quicker while events keep arriving and back off while nothing happens.
+# wait_for_change_set() and wait_until_stable() do the same for change sets and for a stack that
+# another operation is still running on.
+
+import time
+
+MIN_DELAY = 2
+MAX_DELAY = 15
+
+SUCCEEDED_STACK_STATUSES = {'CREATE_COMPLETE', 'UPDATE_COMPLETE', 'IMPORT_COMPLETE'}
+
+class StackOperationFailed(Exception):
+    pass
+
+def _backoff(delay):
+    return min(delay * 2, MAX_DELAY)
+
+class StackEvents:
+    def __init__(self, cf, stack_name):
+        self.cf = cf
+        self.stack_name = stack_name
+        self.last_event_id = None
+
+    def start(self):
+        # Call before the operation, a stack that doesn't exist yet has no events to skip
+        try:
+            events = self.cf.describe_stack_events(StackName=self.stack_name)['StackEvents']
+        except self.cf.exceptions.ClientError:
+            events = []
+        self.last_event_id = events[0]['EventId'] if events else None
+        return self
+
+    def _new_events(self):
+        # describe_stack_events lists the newest first, pages are read until the last event seen
+        events = []
+        paginator = self.cf.get_paginator('describe_stack_events')
+        for page in paginator.paginate(StackName=self.stack_name):
+            for event in page['StackEvents']:
+                if event['EventId'] == self.last_event_id:
+                    break
+                events.append(event)
+            else:
+                continue
+            break
+        if events:
+            self.last_event_id = events[0]['EventId']
+        return list(reversed(events))
+
+    def wait(self, timeout):
+        # Returns the stack's final status
+        started = time.monotonic()
+        delay = MIN_DELAY
+        while True:
+            events = self._new_events()
+            for event in events:
+                status = event['ResourceStatus']
+                reason = event.get('ResourceStatusReason', '')
+                print(f"  {event['LogicalResourceId']} ({event['ResourceType']}) - {status}" + (f": {reason}" if reason else ""))
+                if status.endswith('_FAILED'):
+                    raise StackOperationFailed(f"{event['LogicalResourceId']} {status}: {reason}")
+                if event.get('PhysicalResourceId') == event['StackId']:
+                    if status in SUCCEEDED_STACK_STATUSES:
+                        return status
+                    if status.endswith('ROLLBACK_COMPLETE'):
+                        raise StackOperationFailed(f"Stack {event['StackName']} {status}")
+            if time.monotonic() - started > timeout:
+                raise StackOperationFailed(f"Stack {self.stack_name} didn't finish within {timeout}s")
+            delay = MIN_DELAY if events else _backoff(delay)
+            time.sleep(delay)
+
+def wait_for_change_set(cf, stack_name, change_set_name, timeout):
+    started = time.monotonic()
+    delay = MIN_DELAY
+    while True:
+        response = cf.describe_change_set(StackName=stack_name, ChangeSetName=change_set_name)
+        if response['Status'] == 'CREATE_COMPLETE':
+            return response
+        if response['Status'] == 'FAILED':
+            raise StackOperationFailed(f"Change set {change_set_name} failed: {response.get('StatusReason', '')}")
+        if time.monotonic() - started > timeout:
+            raise StackOperationFailed(f"Change set {change_set_name} wasn't created within {timeout}s")
+        time.sleep(delay)
+        delay = _backoff(delay)
+
+def wait_until_stable(cf, stack_name, timeout):
+    # Waits for whatever is running on the stack to end, successfully or not
+    started = time.monotonic()
+    delay = MIN_DELAY
+    while True:
+        status = cf.describe_stacks(StackName=stack_name)['Stacks'][0]['StackStatus']
+        if not status.endswith('_IN_PROGRESS'):
+            return status
+        if time.monotonic() - started > timeout:
+            raise StackOperationFailed(f"Stack {stack_name} still {status} after {timeout}s")
+        print(f"Stack {stack_name} is {status}, waiting for it to finish...")
+        time.sleep(delay)
+        delay = _backoff(delay)
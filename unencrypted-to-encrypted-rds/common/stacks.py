@@ -0,0 +1,78 @@
+# CloudFormation stack cache shared by the scripts that read stacks
+#
+# Keeps each stack's description (parameters, tags, outputs as a dict) and its original template.
+# Descriptions are reused for DEFAULT_TTL seconds, or until invalidate() is called, which the scripts do
+# after updating a stack. The TTL bounds how stale parameters and outputs get when a stack is updated
+# from outside this process during a long run.
+# A cached template is only returned after a describe_stacks call shows the stack's LastUpdatedTime
+# and StackStatus haven't changed since it was fetched, so get_template isn't called again for a
+# stack that hasn't changed. Templates are handed out as copies, the callers modify them.
+# stack_cache(cf) returns the cache of a client, clients come from common.clients so there is one
+# cache per account and region.
+
+import copy
+import threading
+import time
+
+DEFAULT_TTL = 60
+
+class StackCache:
+    def __init__(self, cf, ttl=DEFAULT_TTL):
+        self.cf = cf
+        self.ttl = ttl
+        self.stacks = {}
+        self.described = {}
+        self.outputs = {}
+        self.templates = {}
+        self.lock = threading.Lock()
+
+    def _describe(self, stack_name):
+        response = self.cf.describe_stacks(StackName=stack_name)
+        stack = response['Stacks'][0]
+        self.stacks[stack_name] = stack
+        self.described[stack_name] = time.monotonic()
+        self.outputs[stack_name] = {output['OutputKey']: output['OutputValue'] for output in stack.get('Outputs', [])}
+        return stack
+
+    def _is_fresh(self, stack_name):
+        return stack_name in self.stacks and time.monotonic() - self.described[stack_name] < self.ttl
+
+    def get_stack(self, stack_name):
+        with self.lock:
+            if not self._is_fresh(stack_name):
+                self._describe(stack_name)
+            return self.stacks[stack_name]
+
+    def get_output(self, stack_name, output_key):
+        # Returns None when the stack has no such output
+        with self.lock:
+            if not self._is_fresh(stack_name):
+                self._describe(stack_name)
+            return self.outputs[stack_name].get(output_key)
+
+    def get_template(self, stack_name):
+        with self.lock:
+            stack = self._describe(stack_name)
+            version = (stack.get('LastUpdatedTime', stack['CreationTime']), stack['StackStatus'])
+            cached = self.templates.get(stack_name)
+            if cached is None or cached[0] != version:
+                response = self.cf.get_template(StackName=stack_name, TemplateStage='Original')
+                cached = (version, response['TemplateBody'])
+                self.templates[stack_name] = cached
+            return copy.deepcopy(cached[1])
+
+    def invalidate(self, stack_name):
+        # The template is kept, get_template() revalidates it anyway
+        with self.lock:
+            self.stacks.pop(stack_name, None)
+            self.outputs.pop(stack_name, None)
+            self.described.pop(stack_name, None)
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def stack_cache(cf):
+    with _caches_lock:
+        if id(cf) not in _caches:
+            _caches[id(cf)] = StackCache(cf)
+        return _caches[id(cf)]
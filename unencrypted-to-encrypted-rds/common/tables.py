@@ -0,0 +1,133 @@
+# Table listing and primary key chunking shared by the scripts that read whole tables
+#
+# Needs PyMySQL (pip install pymysql) through common.mysql
+
+import math
+
+from common.mysql import quote_identifier, schema_filter
+
+INTEGER_TYPES = {'tinyint', 'smallint', 'mediumint', 'int', 'bigint'}
+
+class TableSpec:
+    def __init__(self, schema, table, columns, key_columns, key_type, rows, generated_columns=()):
+        self.schema = schema
+        self.table = table
+        self.columns = columns
+        self.generated_columns = list(generated_columns)
+        self.key_columns = key_columns
+        self.key_type = key_type
+        self.rows = rows
+        self.name = f"{quote_identifier(schema)}.{quote_identifier(table)}"
+
+    def row_hash(self):
+        # Each column is encoded as <length>:<value>, or N for NULL, so no two different rows concatenate
+        # to the same string whatever their values contain
+        columns = ", ".join(
+            f"COALESCE(CONCAT(LENGTH({quote_identifier(column)}), ':', {quote_identifier(column)}), 'N')"
+            for column in self.columns
+        )
+        return f"MD5(CONCAT({columns}))"
+
+    def stored_columns(self):
+        # The columns that can be written, generated ones are computed by the database
+        return [column for column in self.columns if column not in self.generated_columns]
+
+    def has_integer_key(self):
+        # Only a single integer primary key can be split evenly between its MIN and MAX
+        return self.key_type in INTEGER_TYPES
+
+    def key(self):
+        return "(" + ", ".join(quote_identifier(column) for column in self.key_columns) + ")"
+
+    def range_condition(self, low, high):
+        # Rows with low <= key < high, None meaning unbounded
+        conditions = []
+        params = []
+        placeholders = "(" + ", ".join(["%s"] * len(self.key_columns)) + ")"
+        if low is not None:
+            conditions.append(f"{self.key()} >= {placeholders}")
+            params.extend(low)
+        if high is not None:
+            conditions.append(f"{self.key()} < {placeholders}")
+            params.extend(high)
+        return " AND ".join(conditions) or "1 = 1", params
+
+def query(connection, sql, params=()):
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+def list_tables(connection, databases=None):
+    condition, params = schema_filter(databases)
+    tables = query(
+        connection,
+        "SELECT TABLE_SCHEMA, TABLE_NAME, COALESCE(TABLE_ROWS, 0) FROM information_schema.TABLES "
+        f"WHERE TABLE_TYPE = 'BASE TABLE' AND TABLE_SCHEMA {condition} "
+        "ORDER BY DATA_LENGTH + INDEX_LENGTH DESC, TABLE_SCHEMA, TABLE_NAME",
+        params
+    )
+    columns = {}
+    generated = {}
+    for schema, table, column, data_type, extra in query(
+        connection,
+        "SELECT TABLE_SCHEMA, TABLE_NAME, COLUMN_NAME, DATA_TYPE, EXTRA FROM information_schema.COLUMNS "
+        f"WHERE TABLE_SCHEMA {condition} ORDER BY TABLE_SCHEMA, TABLE_NAME, ORDINAL_POSITION",
+        params
+    ):
+        columns.setdefault((schema, table), []).append((column, data_type.lower()))
+        if 'GENERATED' in (extra or '').upper():
+            generated.setdefault((schema, table), []).append(column)
+
+    key_columns = {}
+    for schema, table, column in query(
+        connection,
+        "SELECT TABLE_SCHEMA, TABLE_NAME, COLUMN_NAME FROM information_schema.KEY_COLUMN_USAGE "
+        f"WHERE CONSTRAINT_NAME = 'PRIMARY' AND TABLE_SCHEMA {condition} ORDER BY TABLE_SCHEMA, TABLE_NAME, ORDINAL_POSITION",
+        params
+    ):
+        key_columns.setdefault((schema, table), []).append(column)
+
+    specs = []
+    for schema, table, rows in tables:
+        table_columns = columns.get((schema, table), [])
+        keys = key_columns.get((schema, table), [])
+        key_type = dict(table_columns).get(keys[0]) if len(keys) == 1 else None
+        specs.append(TableSpec(schema, table, [column for column, _ in table_columns], keys, key_type, int(rows), generated.get((schema, table), [])))
+    return specs
+
+def split_integer_key(connection, spec, chunks):
+    # Values splitting the table's integer key into up to chunks even ranges, None when the table is empty.
+    # Both ends come straight from the primary key index
+    column = quote_identifier(spec.key_columns[0])
+    low, high = query(connection, f"SELECT MIN({column}), MAX({column}) FROM {spec.name}")[0]
+    if low is None:
+        return None
+    step = max(1, math.ceil((high - low + 1) / chunks))
+    return list(range(low + step, high + 1, step))
+
+def chunk_boundaries(connection, spec, chunk_rows):
+    # Lower bounds of the chunks, the first one unbounded. Integer keys are split evenly between MIN and MAX,
+    # other keys are walked chunk_rows index entries at a time
+    if not spec.key_columns:
+        return [None]
+    if spec.has_integer_key():
+        bounds = split_integer_key(connection, spec, max(1, math.ceil(spec.rows / chunk_rows)))
+        return [None] + [(bound,) for bound in bounds or []]
+
+    boundaries = [None]
+    while True:
+        condition, params = spec.range_condition(boundaries[-1], None)
+        row = query(
+            connection,
+            f"SELECT {', '.join(quote_identifier(column) for column in spec.key_columns)} FROM {spec.name} "
+            f"WHERE {condition} ORDER BY {', '.join(quote_identifier(column) for column in spec.key_columns)} LIMIT 1 OFFSET %s",
+            params + [chunk_rows]
+        )
+        if not row:
+            return boundaries
+        boundaries.append(tuple(row[0]))
+
+def chunk_ranges(boundaries):
+    # (low, high) pairs covering the whole table, the last one unbounded
+    return list(zip(boundaries, boundaries[1:] + [None]))
+
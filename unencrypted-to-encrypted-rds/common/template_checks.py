@@ -0,0 +1,257 @@
+# Local checks of a CF template before it is uploaded and handed to an update or import
+#
+# check_template() raises TemplateError listing every problem found, so a broken template fails here
+# instead of after a rollback. It checks that every Ref, Fn::GetAtt, Fn::Sub variable, DependsOn and
+# Condition points at something the template defines, that the intrinsic functions have the right
+# shape, and the required properties and property types of the resource types the scripts edit.
+# When resources_to_import is given, each of them has to be in the template with the same type, a
+# DeletionPolicy and its identifier properties, and identifiers that can be worked out from the stack
+# parameters have to match the ResourceIdentifier of the import.
+
+import re
+
+PSEUDO_PARAMETERS = {
+    'AWS::AccountId',
+    'AWS::NotificationARNs',
+    'AWS::NoValue',
+    'AWS::Partition',
+    'AWS::Region',
+    'AWS::StackId',
+    'AWS::StackName',
+    'AWS::URLSuffix'
+}
+
+DELETION_POLICIES = {'Delete', 'Retain', 'RetainExceptOnDelete', 'Snapshot'}
+
+# Required properties and property types of the resource types the scripts edit. Values built with
+# intrinsic functions aren't type checked
+RESOURCE_SCHEMAS = {
+    'AWS::RDS::DBInstance': {
+        'required': ['DBInstanceClass'],
+        'types': {
+            'AllocatedStorage': (str, int),
+            'DBInstanceIdentifier': str,
+            'StorageEncrypted': bool,
+            'VPCSecurityGroups': list
+        }
+    },
+    'AWS::CloudWatch::Alarm': {
+        'required': ['ComparisonOperator', 'EvaluationPeriods'],
+        'types': {
+            'AlarmActions': list,
+            'Dimensions': list,
+            'EvaluationPeriods': (str, int),
+            'Threshold': (str, int, float)
+        }
+    },
+    'AWS::EC2::SecurityGroup': {
+        'required': ['GroupDescription'],
+        'types': {
+            'SecurityGroupIngress': list
+        }
+    }
+}
+
+SUB_VARIABLE = re.compile(r'\$\{([^!}][^}]*)\}')
+
+class TemplateError(Exception):
+    def __init__(self, problems):
+        self.problems = problems
+        super().__init__("Template failed validation:\n" + "\n".join(f"  - {problem}" for problem in problems))
+
+def _is_intrinsic(value):
+    return isinstance(value, dict) and len(value) == 1 and (next(iter(value)) == 'Ref' or next(iter(value)).startswith('Fn::'))
+
+class _Checker:
+    def __init__(self, template):
+        self.template = template
+        self.parameters = set(template.get('Parameters', {}))
+        self.resources = template.get('Resources', {})
+        self.conditions = set(template.get('Conditions', {}))
+        self.mappings = template.get('Mappings', {})
+        self.problems = []
+
+    def check_ref(self, name, where):
+        if not isinstance(name, str):
+            self.problems.append(f"{where}: Ref needs a name, got {name!r}")
+        elif name not in self.parameters and name not in self.resources and name not in PSEUDO_PARAMETERS:
+            self.problems.append(f"{where}: Ref to undefined '{name}'")
+
+    def check_resource_name(self, name, where, function):
+        if name not in self.resources:
+            self.problems.append(f"{where}: {function} of undefined resource '{name}'")
+
+    def check_condition(self, name, where):
+        if name not in self.conditions:
+            self.problems.append(f"{where}: undefined condition '{name}'")
+
+    def check_value(self, value, where):
+        if isinstance(value, list):
+            for i, item in enumerate(value):
+                self.check_value(item, f"{where}[{i}]")
+            return
+        if not isinstance(value, dict):
+            return
+        if not _is_intrinsic(value):
+            for key, item in value.items():
+                if key == 'Condition' and isinstance(item, str):
+                    self.check_condition(item, where)
+                else:
+                    self.check_value(item, f"{where}.{key}")
+            return
+
+        function, args = next(iter(value.items()))
+        if function == 'Ref':
+            self.check_ref(args, where)
+        elif function == 'Fn::GetAtt':
+            if isinstance(args, str) and '.' in args:
+                self.check_resource_name(args.split('.', 1)[0], where, function)
+            elif isinstance(args, list) and len(args) == 2 and isinstance(args[0], str):
+                self.check_resource_name(args[0], where, function)
+                self.check_value(args[1], f"{where}.{function}[1]")
+            else:
+                self.problems.append(f"{where}: Fn::GetAtt needs [resource, attribute], got {args!r}")
+        elif function == 'Fn::Join':
+            if not (isinstance(args, list) and len(args) == 2 and isinstance(args[0], str) and isinstance(args[1], (list, dict))):
+                self.problems.append(f"{where}: Fn::Join needs [delimiter, [values]], got {args!r}")
+            else:
+                self.check_value(args[1], f"{where}.{function}[1]")
+        elif function == 'Fn::Sub':
+            if isinstance(args, str):
+                text, variables = args, {}
+            elif isinstance(args, list) and len(args) == 2 and isinstance(args[0], str) and isinstance(args[1], dict):
+                text, variables = args
+                self.check_value(variables, f"{where}.{function}[1]")
+            else:
+                self.problems.append(f"{where}: Fn::Sub needs a string or [string, {{variables}}], got {args!r}")
+                return
+            for name in SUB_VARIABLE.findall(text):
+                if name in variables:
+                    continue
+                if '.' in name:
+                    self.check_resource_name(name.split('.', 1)[0], where, function)
+                else:
+                    self.check_ref(name, where)
+        elif function == 'Fn::Select':
+            if not (isinstance(args, list) and len(args) == 2):
+                self.problems.append(f"{where}: Fn::Select needs [index, [values]], got {args!r}")
+            else:
+                self.check_value(args, f"{where}.{function}")
+        elif function == 'Fn::If':
+            if not (isinstance(args, list) and len(args) == 3 and isinstance(args[0], str)):
+                self.problems.append(f"{where}: Fn::If needs [condition, value if true, value if false], got {args!r}")
+            else:
+                self.check_condition(args[0], where)
+                self.check_value(args[1:], f"{where}.{function}")
+        elif function == 'Fn::FindInMap':
+            if not (isinstance(args, list) and len(args) == 3):
+                self.problems.append(f"{where}: Fn::FindInMap needs [map, top level key, second level key], got {args!r}")
+            else:
+                if isinstance(args[0], str) and args[0] not in self.mappings:
+                    self.problems.append(f"{where}: Fn::FindInMap of undefined mapping '{args[0]}'")
+                self.check_value(args, f"{where}.{function}")
+        else:
+            self.check_value(args, f"{where}.{function}")
+
+    def check_resource(self, name, resource):
+        where = f"Resources.{name}"
+        if not isinstance(resource, dict) or not isinstance(resource.get('Type'), str):
+            self.problems.append(f"{where}: needs a Type")
+            return
+        properties = resource.get('Properties', {})
+        if not isinstance(properties, dict):
+            self.problems.append(f"{where}.Properties: should be a mapping")
+            return
+
+        depends_on = resource.get('DependsOn', [])
+        for dependency in [depends_on] if isinstance(depends_on, str) else depends_on:
+            self.check_resource_name(dependency, where, 'DependsOn')
+        if 'Condition' in resource:
+            self.check_condition(resource['Condition'], where)
+        for policy in ('DeletionPolicy', 'UpdateReplacePolicy'):
+            if policy in resource and resource[policy] not in DELETION_POLICIES:
+                self.problems.append(f"{where}: invalid {policy} '{resource[policy]}'")
+        self.check_value(properties, f"{where}.Properties")
+
+        schema = RESOURCE_SCHEMAS.get(resource['Type'])
+        if schema is None:
+            return
+        for prop in schema['required']:
+            if prop not in properties:
+                self.problems.append(f"{where}: missing required property {prop}")
+        for prop, expected in schema['types'].items():
+            if prop in properties and not _is_intrinsic(properties[prop]) and not isinstance(properties[prop], expected):
+                self.problems.append(f"{where}.Properties.{prop}: unexpected {type(properties[prop]).__name__} value")
+        if resource['Type'] == 'AWS::CloudWatch::Alarm':
+            for i, dimension in enumerate(properties.get('Dimensions', []) if isinstance(properties.get('Dimensions'), list) else []):
+                if not isinstance(dimension, dict) or 'Name' not in dimension or 'Value' not in dimension:
+                    self.problems.append(f"{where}.Properties.Dimensions[{i}]: needs a Name and a Value")
+
+    def check(self):
+        if not isinstance(self.resources, dict) or not self.resources:
+            self.problems.append("Resources: the template needs at least one resource")
+            return
+        # Macros can add anything, references can't be checked before they run
+        if 'Transform' in self.template:
+            return
+        for name, resource in self.resources.items():
+            self.check_resource(name, resource)
+        for name, output in self.template.get('Outputs', {}).items():
+            if not isinstance(output, dict) or 'Value' not in output:
+                self.problems.append(f"Outputs.{name}: needs a Value")
+            else:
+                self.check_value(output, f"Outputs.{name}")
+
+def resolve(value, parameters, stack_name=None):
+    # Works out the value of a property built from strings, Refs to parameters and Fn::Join, None when it can't
+    if isinstance(value, str):
+        return value
+    if not _is_intrinsic(value):
+        return None
+    function, args = next(iter(value.items()))
+    if function == 'Ref':
+        if args == 'AWS::StackName':
+            return stack_name
+        return parameters.get(args)
+    if function == 'Fn::Join' and isinstance(args, list) and len(args) == 2 and isinstance(args[1], list):
+        parts = [resolve(part, parameters, stack_name) for part in args[1]]
+        if any(part is None for part in parts):
+            return None
+        return args[0].join(parts)
+    return None
+
+def check_import(template, resources_to_import, parameters=None, stack_name=None):
+    problems = []
+    resources = template.get('Resources', {})
+    for resource_to_import in resources_to_import:
+        name = resource_to_import['LogicalResourceId']
+        where = f"Resources.{name}"
+        resource = resources.get(name)
+        if resource is None:
+            problems.append(f"{where}: resource to import isn't in the template")
+            continue
+        if resource.get('Type') != resource_to_import['ResourceType']:
+            problems.append(f"{where}: is a {resource.get('Type')}, the import is of a {resource_to_import['ResourceType']}")
+        if 'DeletionPolicy' not in resource:
+            problems.append(f"{where}: resources to import need a DeletionPolicy")
+        properties = resource.get('Properties', {})
+        for prop, identifier in resource_to_import['ResourceIdentifier'].items():
+            if prop not in properties:
+                problems.append(f"{where}: identifier property {prop} isn't set")
+                continue
+            if parameters is None:
+                continue
+            value = resolve(properties[prop], parameters, stack_name)
+            if value is not None and value != identifier:
+                problems.append(f"{where}.Properties.{prop}: resolves to '{value}', the import is of '{identifier}'")
+    return problems
+
+def check_template(template, resources_to_import=None, parameters=None, stack_name=None):
+    # parameters maps parameter names to the stack's values, they are only used to check import identifiers
+    checker = _Checker(template)
+    checker.check()
+    problems = checker.problems
+    if resources_to_import:
+        problems += check_import(template, resources_to_import, parameters, stack_name)
+    if problems:
+        raise TemplateError(problems)
@@ -0,0 +1,26 @@
+# Structural diff of two CF templates
+#
+# diff_templates() returns one line per changed path, an empty list means the templates are the same.
+# Mappings are compared by key, so the order of resources or properties doesn't count as a change,
+# lists are compared item by item.
+
+def diff_templates(old, new, path=""):
+    if isinstance(old, dict) and isinstance(new, dict):
+        changes = []
+        for key in old:
+            if key not in new:
+                changes.append(f"{path}{key}: removed")
+        for key in new:
+            if key not in old:
+                changes.append(f"{path}{key}: added")
+            else:
+                changes.extend(diff_templates(old[key], new[key], f"{path}{key}."))
+        return changes
+    if isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        changes = []
+        for i, (old_item, new_item) in enumerate(zip(old, new)):
+            changes.extend(diff_templates(old_item, new_item, f"{path}{i}."))
+        return changes
+    if old != new:
+        return [f"{path.rstrip('.')}: changed"]
+    return []
@@ -0,0 +1,176 @@
+# Phase and AWS API call tracing shared by the migration scripts
+#
+# enable() hooks into botocore's event system, so every API call made through a client from
+# common.clients (or the default boto3 session) is timed, along with its retries and throttling errors.
+# phase() marks the steps of a script. write_trace() saves everything as a Chrome trace
+# (chrome://tracing or https://ui.perfetto.dev) with a per service/operation summary under
+# "otherData", and print_summary() prints that summary. traced() does all of it around a block of work.
+
+import json
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+THROTTLING_ERROR_CODES = {
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottled',
+    'RequestThrottledException',
+    'RequestLimitExceeded',
+    'TooManyRequestsException',
+    'SlowDown'
+}
+
+_tracer = None
+
+class Tracer:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.events = []
+        self.throttles = {}
+        self.thread_ids = {}
+        self.lock = threading.Lock()
+
+    def _timestamp(self, moment):
+        return round((moment - self.start) * 1000000)
+
+    def _thread_id(self):
+        with self.lock:
+            return self.thread_ids.setdefault(threading.get_ident(), len(self.thread_ids) + 1)
+
+    def instrument(self, session):
+        # Clients copy their session's event handlers when they are created, so this has to run first
+        session.events.register('before-call.*.*', self._before_call)
+        session.events.register('after-call.*.*', self._after_call)
+        session.events.register('needs-retry.*.*', self._needs_retry)
+
+    def _before_call(self, context, **kwargs):
+        context['trace_start'] = time.perf_counter()
+
+    def _after_call(self, http_response, parsed, model, context, **kwargs):
+        start = context.get('trace_start')
+        if start is None:
+            return
+        end = time.perf_counter()
+        self.events.append({
+            'name': f"{model.service_model.service_name}.{model.name}",
+            'cat': 'api',
+            'ph': 'X',
+            'ts': self._timestamp(start),
+            'dur': self._timestamp(end) - self._timestamp(start),
+            'pid': 1,
+            'tid': self._thread_id(),
+            'args': {
+                'status': http_response.status_code,
+                'retries': parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0),
+                'error': parsed.get('Error', {}).get('Code')
+            }
+        })
+
+    def _needs_retry(self, response, operation, **kwargs):
+        # Only observes the response, returning None leaves the retry decision to botocore
+        if response is None:
+            return None
+        code = response[1].get('Error', {}).get('Code')
+        if code in THROTTLING_ERROR_CODES:
+            name = f"{operation.service_model.service_name}.{operation.name}"
+            with self.lock:
+                self.throttles[name] = self.throttles.get(name, 0) + 1
+        return None
+
+    @contextmanager
+    def phase(self, name, label=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.events.append({
+                'name': f"{label}: {name}" if label else name,
+                'cat': 'phase',
+                'ph': 'X',
+                'ts': self._timestamp(start),
+                'dur': self._timestamp(end) - self._timestamp(start),
+                'pid': 1,
+                'tid': self._thread_id()
+            })
+
+    def summary(self):
+        calls = {}
+        for event in self.events:
+            if event['cat'] == 'api':
+                calls.setdefault(event['name'], []).append(event)
+
+        summary = {}
+        for name, events in sorted(calls.items()):
+            durations = sorted(event['dur'] / 1000 for event in events)
+            summary[name] = {
+                'calls': len(events),
+                'errors': sum(1 for event in events if event['args']['error']),
+                'retries': sum(event['args']['retries'] for event in events),
+                'throttles': self.throttles.get(name, 0),
+                'p50_ms': round(percentile(durations, 50), 1),
+                'p90_ms': round(percentile(durations, 90), 1),
+                'p99_ms': round(percentile(durations, 99), 1),
+                'total_ms': round(sum(durations), 1)
+            }
+        return summary
+
+def percentile(values, percent):
+    # Nearest-rank percentile of an already sorted list
+    if not values:
+        return 0
+    rank = max(int(round(percent / 100 * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+def enable():
+    global _tracer
+    if _tracer is None:
+        _tracer = Tracer()
+        import boto3
+        boto3.setup_default_session()
+        _tracer.instrument(boto3.DEFAULT_SESSION)
+    return _tracer
+
+def instrument(session):
+    # Called by common.clients for every session it creates, clients created before enable() aren't traced
+    if _tracer:
+        _tracer.instrument(session)
+
+def phase(name, label=None):
+    return _tracer.phase(name, label) if _tracer else nullcontext()
+
+def write_trace(path):
+    if _tracer is None:
+        return
+    trace = {
+        'traceEvents': sorted(_tracer.events, key=lambda event: event['ts']),
+        'displayTimeUnit': 'ms',
+        'otherData': {'summary': _tracer.summary()}
+    }
+    with open(path, 'w') as f:
+        json.dump(trace, f, indent=2)
+    print(f"Trace written to '{path}'")
+
+def print_summary():
+    if _tracer is None:
+        return
+    print("### AWS API calls")
+    print(f"{'operation':<50} {'calls':>6} {'errors':>6} {'retries':>7} {'throttled':>9} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'total s':>8}")
+    for name, stats in _tracer.summary().items():
+        print(f"{name:<50} {stats['calls']:>6} {stats['errors']:>6} {stats['retries']:>7} {stats['throttles']:>9} "
+              f"{stats['p50_ms']:>8} {stats['p90_ms']:>8} {stats['p99_ms']:>8} {stats['total_ms'] / 1000:>8.1f}")
+
+@contextmanager
+def traced(path):
+    # Traces the block when a path is given and writes the trace out even if the block fails
+    if not path:
+        yield
+        return
+    enable()
+    try:
+        yield
+    finally:
+        write_trace(path)
+        print_summary()
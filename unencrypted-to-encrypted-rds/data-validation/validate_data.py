@@ -0,0 +1,257 @@
+# Usage
+# aws-vault exec <account> -- python3 validate_data.py --db <cluster>-<stack>-<env> --region <aws-region> [--database <schema>] [--output <report.json>]
+# python3 validate_data.py --source-host <host> --target-host <host> [--port 3306] [--target-port <port>] --user <user> --password <password> [--database <schema>]
+#
+# Compares the data of the source and its -encrypted copy without CHECKSUM TABLE's full scans and locks.
+# Each table is split into primary key ranges of about --chunk-rows rows, and every chunk's row count and
+# hash (an order independent BIT_XOR of each row's MD5) is compared between both sides, --concurrency chunks
+# at once across all tables. Only the chunks that differ are split in half again and again, down to
+# --row-diff-rows rows, where the rows themselves are compared and reported as missing from the target,
+# extra on the target or changed. Tables without a primary key are compared whole.
+# Rows changing while it runs show up as differences, so run it with CDC caught up and writes frozen, or
+# rerun it for the tables it reports. With --db the endpoints are the ones of the inventory and the
+# password is the stack output MySQLPassword. Point --source-host/--target-host at two local MySQL
+# instances to try it out, see the README.
+#
+# Needs PyMySQL (pip install pymysql)
+
+import argparse
+import json
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import tracing
+from common.databases import database_endpoints
+from common.mysql import connect, quote_identifier
+from common.tables import chunk_boundaries, chunk_ranges, list_tables, query
+
+def add_arguments(parser):
+    parser.add_argument('--db', help='source database, cluster-stack-env, the target is <db>-encrypted')
+    parser.add_argument('--region', help='region')
+    parser.add_argument('--source-host', help='source endpoint, instead of the one of --db')
+    parser.add_argument('--target-host', help='target endpoint, instead of the one of <db>-encrypted')
+    parser.add_argument('--port', type=int, default=3306, help='database port')
+    parser.add_argument('--target-port', type=int, help='target port, defaults to --port')
+    parser.add_argument('--user', default='cosmos', help='database user')
+    parser.add_argument('--password', help='database password, instead of the stack output MySQLPassword')
+    parser.add_argument('--database', action='append', help='schema to validate, can be repeated, defaults to all non-system schemas')
+    parser.add_argument('--chunk-rows', type=int, default=100000, help='rows per chunk')
+    parser.add_argument('--row-diff-rows', type=int, default=1000, help='chunks up to this many rows are compared row by row')
+    parser.add_argument('--max-row-diffs', type=int, default=100, help='rows reported per table')
+    parser.add_argument('--concurrency', type=int, default=8, help='number of chunks compared at once')
+    parser.add_argument('--output', help='write the report to this JSON file')
+
+parser = argparse.ArgumentParser(description="Compare the data of the source and the encrypted target chunk by chunk")
+add_arguments(parser)
+parser.add_argument('--trace', help='write a Chrome trace of the phases and AWS API calls to this file and print a call summary')
+
+class ConnectionPool:
+    # One source and one target connection per worker thread, PyMySQL connections can't be shared
+    def __init__(self, source, target, user, password, port=3306, target_port=None):
+        self.hosts = {'source': source, 'target': target}
+        self.ports = {'source': port, 'target': target_port or port}
+        self.user = user
+        self.password = password
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def get(self, side):
+        if not hasattr(self.local, side):
+            connection = connect(self.hosts[side], self.user, self.password, self.ports[side])
+            connection.autocommit(True)
+            setattr(self.local, side, connection)
+            with self.lock:
+                self.connections.append(connection)
+        return getattr(self.local, side)
+
+    def close(self):
+        for connection in self.connections:
+            connection.close()
+
+def chunk_checksum(connection, spec, low, high):
+    condition, params = spec.range_condition(low, high)
+    row_hash = spec.row_hash()
+    count, first, second = query(
+        connection,
+        f"SELECT COUNT(*), "
+        f"COALESCE(BIT_XOR(CAST(CONV(SUBSTRING({row_hash}, 1, 16), 16, 10) AS UNSIGNED)), 0), "
+        f"COALESCE(BIT_XOR(CAST(CONV(SUBSTRING({row_hash}, 17, 16), 16, 10) AS UNSIGNED)), 0) "
+        f"FROM {spec.name} WHERE {condition}",
+        params
+    )[0]
+    return int(count), int(first), int(second)
+
+def row_hashes(connection, spec, low, high):
+    condition, params = spec.range_condition(low, high)
+    keys = ", ".join(quote_identifier(column) for column in spec.key_columns)
+    rows = query(connection, f"SELECT {keys}, {spec.row_hash()} FROM {spec.name} WHERE {condition}", params)
+    return {tuple(row[:-1]): row[-1] for row in rows}
+
+def midpoint(connection, spec, low, high, rows):
+    condition, params = spec.range_condition(low, high)
+    keys = ", ".join(quote_identifier(column) for column in spec.key_columns)
+    row = query(connection, f"SELECT {keys} FROM {spec.name} WHERE {condition} ORDER BY {keys} LIMIT 1 OFFSET %s", params + [rows // 2])
+    return tuple(row[0]) if row else None
+
+class TableResult:
+    def __init__(self, spec):
+        self.spec = spec
+        self.chunks = 0
+        self.mismatched_chunks = 0
+        self.missing = []
+        self.extra = []
+        self.changed = []
+        self.error = None
+        self.lock = threading.Lock()
+
+    def add_rows(self, kind, keys, limit):
+        with self.lock:
+            rows = getattr(self, kind)
+            rows.extend(list(keys)[:max(0, limit - len(rows))])
+
+    def to_dict(self):
+        return {
+            'table': f"{self.spec.schema}.{self.spec.table}",
+            'chunks': self.chunks,
+            'mismatched_chunks': self.mismatched_chunks,
+            'missing': [list(key) for key in self.missing],
+            'extra': [list(key) for key in self.extra],
+            'changed': [list(key) for key in self.changed],
+            'error': self.error
+        }
+
+class Validator:
+    def __init__(self, pool, chunk_rows=100000, row_diff_rows=1000, max_row_diffs=100, concurrency=8):
+        self.pool = pool
+        self.chunk_rows = chunk_rows
+        self.row_diff_rows = row_diff_rows
+        self.max_row_diffs = max_row_diffs
+        self.concurrency = concurrency
+
+    def compare_chunk(self, spec, low, high):
+        # (source checksum, target checksum), each (rows, hash, hash)
+        return chunk_checksum(self.pool.get('source'), spec, low, high), chunk_checksum(self.pool.get('target'), spec, low, high)
+
+    def diff_rows(self, result, low, high):
+        spec = result.spec
+        source = row_hashes(self.pool.get('source'), spec, low, high)
+        target = row_hashes(self.pool.get('target'), spec, low, high)
+        result.add_rows('missing', sorted(key for key in source if key not in target), self.max_row_diffs)
+        result.add_rows('extra', sorted(key for key in target if key not in source), self.max_row_diffs)
+        result.add_rows('changed', sorted(key for key in source if key in target and source[key] != target[key]), self.max_row_diffs)
+
+    def bisect(self, result, low, high, source_rows, target_rows):
+        # Splits a mismatched range in half until it is small enough to compare row by row
+        rows = max(source_rows, target_rows)
+        if rows <= self.row_diff_rows:
+            return self.diff_rows(result, low, high)
+        middle = midpoint(self.pool.get('source' if source_rows >= target_rows else 'target'), result.spec, low, high, rows)
+        if middle is None or middle == low:
+            return self.diff_rows(result, low, high)
+        for half_low, half_high in ((low, middle), (middle, high)):
+            source, target = self.compare_chunk(result.spec, half_low, half_high)
+            if source != target:
+                self.bisect(result, half_low, half_high, source[0], target[0])
+
+    def boundaries(self, spec):
+        # Runs in the worker, so it gets that thread's source connection
+        return chunk_boundaries(self.pool.get('source'), spec, self.chunk_rows)
+
+    def check_chunk(self, result, low, high):
+        source, target = self.compare_chunk(result.spec, low, high)
+        if source == target:
+            return False
+        with result.lock:
+            result.mismatched_chunks += 1
+        if result.spec.key_columns:
+            self.bisect(result, low, high, source[0], target[0])
+        return True
+
+    def validate(self, specs):
+        results = {(spec.schema, spec.table): TableResult(spec) for spec in specs}
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            boundaries = {executor.submit(self.boundaries, spec): spec for spec in specs}
+            chunks = []
+            for future in as_completed(boundaries):
+                spec = boundaries[future]
+                result = results[(spec.schema, spec.table)]
+                try:
+                    bounds = future.result()
+                except Exception as e:
+                    result.error = str(e)
+                    continue
+                result.chunks = len(bounds)
+                chunks.extend((result, low, high) for low, high in chunk_ranges(bounds))
+
+            futures = {executor.submit(self.check_chunk, *chunk): chunk for chunk in chunks}
+            for done, future in enumerate(as_completed(futures), 1):
+                result = futures[future][0]
+                try:
+                    future.result()
+                except Exception as e:
+                    result.error = str(e)
+                if done % 100 == 0 or done == len(futures):
+                    print(f"[{done}/{len(futures)}] chunks compared")
+        return list(results.values())
+
+def check_columns(source_specs, target_specs):
+    # Tables missing from the target or with different columns can't be compared chunk by chunk
+    target_columns = {(spec.schema, spec.table): spec.columns for spec in target_specs}
+    problems = {}
+    for spec in source_specs:
+        columns = target_columns.get((spec.schema, spec.table))
+        if columns is None:
+            problems[(spec.schema, spec.table)] = "missing from the target"
+        elif columns != spec.columns:
+            problems[(spec.schema, spec.table)] = "columns differ on the target"
+    return problems
+
+def print_report(results):
+    print("### Validation report")
+    print(f"{'table':<50} {'chunks':>7} {'differ':>7} {'missing':>8} {'extra':>6} {'changed':>8}")
+    for result in results:
+        line = f"{result.spec.schema + '.' + result.spec.table:<50} {result.chunks:>7} {result.mismatched_chunks:>7} {len(result.missing):>8} {len(result.extra):>6} {len(result.changed):>8}"
+        if result.error:
+            line += f"  {result.error}"
+        print(line)
+        for kind in ('missing', 'extra', 'changed'):
+            for key in getattr(result, kind)[:5]:
+                print(f"  {kind}: {key}")
+
+def main(args):
+    source_host, target_host, password = database_endpoints(args.region, args.db, args.source_host, args.target_host, args.password)
+    pool = ConnectionPool(source_host, target_host, args.user, password, args.port, args.target_port)
+    try:
+        source_specs = list_tables(pool.get('source'), args.database)
+        problems = check_columns(source_specs, list_tables(pool.get('target'), args.database))
+        validator = Validator(pool, args.chunk_rows, args.row_diff_rows, args.max_row_diffs, args.concurrency)
+        with tracing.phase('validate', args.db):
+            results = validator.validate([spec for spec in source_specs if (spec.schema, spec.table) not in problems])
+    finally:
+        pool.close()
+
+    for spec in source_specs:
+        if (spec.schema, spec.table) in problems:
+            result = TableResult(spec)
+            result.error = problems[(spec.schema, spec.table)]
+            results.append(result)
+    print_report(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump([result.to_dict() for result in results], f, indent=2, default=str)
+        print(f"Report written to '{args.output}'")
+
+    valid = all(not result.mismatched_chunks and not result.error for result in results)
+    print("Source and target match\n" if valid else "Source and target differ, see the report above\n")
+    return valid
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    with tracing.traced(args.trace):
+        if not main(args):
+            sys.exit(1)
@@ -0,0 +1,127 @@
+# Usage
+# python3 scan_encryption_status.py --output <report.csv|report.json> [--accounts <profile> ...] [--regions <aws-region> ...]
+# aws-vault exec <account> -- python3 scan_encryption_status.py --output <report.csv>
+#
+# Lists every RDS instance of each account x region pair at once and writes one row per instance with
+# its class, storage, StorageEncrypted and the CF stack it belongs to. --accounts takes AWS config
+# profiles, without it the current credentials are used. Instances come from the shared inventory
+# (common/inventory.py), --refresh lists them again instead of using a cached listing.
+# The report is sorted by --sort, largest first for sizes, so migrations can be batched by size.
+
+import argparse
+import csv
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import tracing
+from common.inventory import get_inventory
+
+# Same regions as ssm-parameter-deletion/get-all-ssm-parameters.sh
+DEFAULT_REGIONS = ["ap-southeast-2", "us-west-2", "eu-west-1"]
+
+REPORT_FIELDS = [
+    'Account',
+    'Region',
+    'DBInstanceIdentifier',
+    'DBInstanceClass',
+    'AllocatedStorage (GB)',
+    'StorageType',
+    'StorageEncrypted',
+    'Stack',
+    'Engine',
+    'DBInstanceStatus'
+]
+
+def add_arguments(parser):
+    parser.add_argument('--output', required=True, help='report file, .csv or .json')
+    parser.add_argument('--accounts', nargs='+', help='AWS config profiles to scan, the current credentials when not given')
+    parser.add_argument('--regions', nargs='+', default=DEFAULT_REGIONS, help='regions to scan')
+    parser.add_argument('--sort', default='AllocatedStorage (GB)', choices=REPORT_FIELDS, help='column to sort the report by')
+    parser.add_argument('--unencrypted-only', action='store_true', help='only report instances without storage encryption')
+    parser.add_argument('--refresh', action='store_true', help='list the instances again instead of using a cached listing')
+    parser.add_argument('--max-workers', type=int, default=16, help='number of account/region pairs scanned at once')
+
+parser = argparse.ArgumentParser(description="Report the storage encryption status of RDS instances")
+add_arguments(parser)
+parser.add_argument('--trace', help='write a Chrome trace of the AWS API calls to this file and print a call summary')
+
+def report_row(account, region, instance):
+    tags = {tag['Key']: tag['Value'] for tag in instance.get('TagList', [])}
+    return {
+        'Account': account or 'default',
+        'Region': region,
+        'DBInstanceIdentifier': instance['DBInstanceIdentifier'],
+        'DBInstanceClass': instance['DBInstanceClass'],
+        'AllocatedStorage (GB)': instance['AllocatedStorage'],
+        'StorageType': instance['StorageType'],
+        'StorageEncrypted': instance['StorageEncrypted'],
+        'Stack': tags.get('aws:cloudformation:stack-name', ''),
+        'Engine': instance['Engine'],
+        'DBInstanceStatus': instance['DBInstanceStatus']
+    }
+
+def scan_region(account, region, refresh=False):
+    inventory = get_inventory(region, account)
+    if refresh:
+        inventory.refresh()
+    return [report_row(account, region, instance) for instance in inventory.all()]
+
+def scan(accounts, regions, refresh=False, max_workers=16):
+    # Returns the rows of every pair that could be scanned and the errors of the ones that couldn't
+    pairs = [(account, region) for account in accounts for region in regions]
+    rows = []
+    errors = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {pair: executor.submit(scan_region, *pair, refresh) for pair in pairs}
+        for (account, region), future in futures.items():
+            try:
+                rows.extend(future.result())
+                print(f"{account or 'default'} ({region}) - scanned")
+            except Exception as e:
+                errors[(account, region)] = str(e)
+                print(f"{account or 'default'} ({region}) - scan failed: {e}")
+    return rows, errors
+
+def write_report(rows, output):
+    if output.endswith('.json'):
+        with open(output, 'w') as f:
+            json.dump(rows, f, indent=2)
+    else:
+        with open(output, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+    print(f"Report of {len(rows)} instances written to '{output}'")
+
+def print_report_summary(rows):
+    totals = {}
+    for row in rows:
+        total = totals.setdefault((row['Account'], row['Region']), {'instances': 0, 'unencrypted': 0, 'unencrypted_gb': 0})
+        total['instances'] += 1
+        if not row['StorageEncrypted']:
+            total['unencrypted'] += 1
+            total['unencrypted_gb'] += row['AllocatedStorage (GB)']
+
+    print(f"{'account':<20} {'region':<16} {'instances':>9} {'unencrypted':>11} {'unencrypted GB':>14}")
+    for (account, region), total in sorted(totals.items()):
+        print(f"{account:<20} {region:<16} {total['instances']:>9} {total['unencrypted']:>11} {total['unencrypted_gb']:>14}")
+
+def main(args):
+    rows, errors = scan(args.accounts or [None], args.regions, args.refresh, args.max_workers)
+    print_report_summary(rows)
+    if args.unencrypted_only:
+        rows = [row for row in rows if not row['StorageEncrypted']]
+    rows.sort(key=lambda row: (row[args.sort], row['DBInstanceIdentifier']), reverse=args.sort == 'AllocatedStorage (GB)')
+    write_report(rows, args.output)
+    if errors:
+        print(f"Warning: {len(errors)} account/region pairs couldn't be scanned and are missing from the report")
+    return rows
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    with tracing.traced(args.trace):
+        main(args)
@@ -0,0 +1,173 @@
+# Usage
+# aws-vault exec <account> -- python3 migrate.py [--trace <file.json>] <command> [options]
+# aws-vault exec <account> -- python3 migrate.py run-all --db <cluster>-<stack>-<env> --region <aws-region> --bucket <s3-bucket> [--cf-changes]
+#
+# Single entry point for the steps of the conversion, each command runs the same code as the step's script:
+#   iam           setup-iam-policy-role/create_iam_role_and_policy.py
+#   snapshot      snapshots-and-restoring-db-instance/create_encrypted_rds.py, stopping once the snapshot is taken
+#   encrypt       the same, stopping once the encrypted copy is available
+#   restore       the same, all the way to the restored -encrypted instance
+#   dms-template  setup-aws-dms/generate_dms_cf_template.py
+#   dms-stack     setup-aws-dms/create_dms_stack.py
+#   bulk-load     setup-aws-dms/bulk_load_parameter_group.py
+#   cf-changes    cloudformation-changes/cf_changes.py
+#   ssm-restore   ../ssm-parameter-deletion/restore-ssl-parameters.py
+#   direct-copy   setup-aws-dms/direct_copy.py
+#   replication   setup-aws-dms/binlog_replication.py
+#   cutover       setup-aws-dms/cdc_cutover.py
+#   validate      data-validation/validate_data.py
+#   scan          encryption-status-report/scan_encryption_status.py
+#   run-all       iam, restore, dms-template and dms-stack for one instance in one process. With --cf-changes
+#                 cf-changes runs at the end too, only use it when the app can be moved to the new instance straight away.
+#                 With --writes-frozen, --copy-mode auto (the default) copies sources under --direct-copy-threshold GiB
+#                 with direct-copy instead of DMS, skipping iam, dms-template and dms-stack. direct-copy has no CDC, so
+#                 without --writes-frozen auto always picks DMS and --copy-mode direct refuses to run.
+#                 --copy-mode replication skips them too and makes the restored instance a binlog replica of the
+#                 source instead, cut over with 'cutover --replication'
+#
+# snapshot, encrypt and restore share the checkpoints under --state-dir, so running them one after the other
+# picks up where the previous one stopped. boto3 is only imported when the first AWS client is needed.
+
+import argparse
+import importlib
+import importlib.util
+import os
+import sys
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(SCRIPTS_DIR)
+
+from common import clients, tracing
+
+SSM_RESTORE_SCRIPT = os.path.join(os.path.dirname(SCRIPTS_DIR), 'ssm-parameter-deletion', 'restore-ssl-parameters.py')
+
+def load_step(step_dir, module_name):
+    # The step folders have dashes in their names, so their modules are imported from the folder itself
+    path = os.path.join(SCRIPTS_DIR, step_dir)
+    if path not in sys.path:
+        sys.path.append(path)
+    return importlib.import_module(module_name)
+
+def load_script(module_name, path):
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def run_all(args, steps):
+    copy_mode = args.copy_mode
+    if copy_mode == 'auto':
+        with tracing.phase('choose-copy-mode', args.db):
+            copy_mode = steps['direct-copy'].choose_copy_mode(args.region, args.db, args.db_user, args.direct_copy_threshold, args.writes_frozen)
+
+    if not args.skip_iam and copy_mode == 'dms':
+        with tracing.phase('iam', args.db):
+            steps['iam'].main(args)
+
+    if copy_mode == 'replication':
+        # The binlog has to be kept from the snapshot on
+        with tracing.phase('prepare-replication', args.db):
+            steps['replication'].prepare(args.region, args.db, args.db_user)
+
+    encrypted_rds = steps['restore']
+    new_db_instance_id = encrypted_rds.migrate_instance(args.db, args.region, **encrypted_rds.migration_options(args))
+    if not new_db_instance_id:
+        raise SystemExit(f"Migration of '{args.db}' didn't complete, rerun to resume it")
+
+    if copy_mode == 'direct':
+        if not args.writes_frozen:
+            raise SystemExit("--copy-mode direct needs --writes-frozen, writes after the copy's snapshot would be lost. Use replication or DMS otherwise")
+        if not steps['direct-copy'].copy_to_encrypted(args.region, args.db, args.db_user, workers=args.workers, chunk_rows=args.chunk_rows,
+                                                      batch_rows=args.batch_rows, lock=not args.no_lock):
+            raise SystemExit(f"Direct copy of '{args.db}' failed, rerun it with 'direct-copy'")
+    elif copy_mode == 'replication':
+        steps['replication'].start(args.region, args.db, args.db_user)
+    else:
+        template_url = steps['dms-template'].main(args)
+        if not template_url:
+            raise SystemExit(f"DMS template for '{args.db}' couldn't be created")
+
+        dms_stack_args = argparse.Namespace(stack=args.db, template=template_url, region=args.region)
+        if not steps['dms-stack'].main(dms_stack_args):
+            raise SystemExit(f"DMS stack for '{args.db}' couldn't be created")
+
+    if args.cf_changes:
+        cf_changes_args = argparse.Namespace(stack=args.db, bucket=args.bucket, region=args.region)
+        steps['cf-changes'].main(cf_changes_args)
+
+def build_parser(steps):
+    parser = argparse.ArgumentParser(description="Convert an unencrypted RDS instance into an encrypted one")
+    parser.add_argument('--trace', help='write a Chrome trace of the phases and AWS API calls to this file and print a call summary')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('iam', help='create the IAM role and policy for DMS homogeneous data migrations')
+    command.set_defaults(handler=steps['iam'].main)
+
+    for name, until, description in (
+        ('snapshot', 'snapshot', 'take the snapshot of the instance'),
+        ('encrypt', 'copy', 'copy the snapshot encrypted with the instance\'s KMS key'),
+        ('restore', None, 'restore the encrypted snapshot to the -encrypted instance')
+    ):
+        command = commands.add_parser(name, help=description)
+        steps[name].add_arguments(command)
+        command.set_defaults(handler=lambda args, until=until: steps['restore'].main(args, until=until))
+
+    for name, description in (
+        ('dms-template', 'generate the DMS CF template and upload it to S3'),
+        ('dms-stack', 'create the DMS CF stack'),
+        ('bulk-load', 'apply/restore the bulk-load parameter group of the target'),
+        ('cf-changes', 'swap the unencrypted instance in the CF stack for the encrypted one'),
+        ('ssm-restore', 'restore the SSL SSM parameters from a backup file'),
+        ('direct-copy', 'copy the data straight into the encrypted target, without DMS'),
+        ('replication', 'catch the encrypted target up with binlog replication instead of DMS CDC'),
+        ('cutover', 'follow the DMS CDC lag and freeze writes once the target has caught up'),
+        ('validate', 'compare the data of the source and the encrypted target chunk by chunk'),
+        ('scan', 'report the storage encryption status of every instance across accounts and regions')
+    ):
+        command = commands.add_parser(name, help=description)
+        steps[name].add_arguments(command)
+        command.set_defaults(handler=steps[name].main)
+
+    command = commands.add_parser('run-all', help='iam, restore, dms-template and dms-stack in one go')
+    command.add_argument('--db', required=True, help='database')
+    command.add_argument('--region', required=True, help='region')
+    command.add_argument('--bucket', required=True, help='S3 bucket to store the CF templates')
+    command.add_argument('--skip-iam', action='store_true', help='don\'t create the IAM role and policy, they are per account')
+    command.add_argument('--cf-changes', action='store_true', help='also run cf-changes once the DMS stack is created')
+    steps['restore'].add_migration_arguments(command)
+    command.add_argument('--copy-mode', choices=['auto', 'dms', 'direct', 'replication'], default='auto',
+                         help='copy the data with DMS, with direct-copy, with direct-copy below --direct-copy-threshold, or catch the restored instance up with binlog replication')
+    command.add_argument('--writes-frozen', action='store_true',
+                         help='the app\'s writes to the source are frozen for the whole run, required for direct-copy, which has no CDC')
+    command.add_argument('--direct-copy-threshold', type=float, default=steps['direct-copy'].DIRECT_COPY_THRESHOLD_GIB, help='GiB under which --copy-mode auto uses direct-copy')
+    steps['dms-template'].add_sizing_arguments(command)
+    steps['direct-copy'].add_copy_arguments(command)
+    command.set_defaults(handler=lambda args: run_all(args, steps))
+    return parser
+
+def load_steps():
+    encrypted_rds = load_step('snapshots-and-restoring-db-instance', 'create_encrypted_rds')
+    return {
+        'iam': load_step('setup-iam-policy-role', 'create_iam_role_and_policy'),
+        'snapshot': encrypted_rds,
+        'encrypt': encrypted_rds,
+        'restore': encrypted_rds,
+        'dms-template': load_step('setup-aws-dms', 'generate_dms_cf_template'),
+        'dms-stack': load_step('setup-aws-dms', 'create_dms_stack'),
+        'bulk-load': load_step('setup-aws-dms', 'bulk_load_parameter_group'),
+        'cf-changes': load_step('cloudformation-changes', 'cf_changes'),
+        'direct-copy': load_step('setup-aws-dms', 'direct_copy'),
+        'replication': load_step('setup-aws-dms', 'binlog_replication'),
+        'cutover': load_step('setup-aws-dms', 'cdc_cutover'),
+        'validate': load_step('data-validation', 'validate_data'),
+        'ssm-restore': load_script('restore_ssl_parameters', SSM_RESTORE_SCRIPT),
+        'scan': load_step('encryption-status-report', 'scan_encryption_status')
+    }
+
+if __name__ == "__main__":
+    steps = load_steps()
+    args = build_parser(steps).parse_args()
+    if hasattr(args, 'max_workers'):
+        clients.configure(max_pool_connections=steps['restore'].pool_size(args.max_workers))
+    with tracing.traced(args.trace):
+        args.handler(args)
@@ -0,0 +1,254 @@
+# Usage
+# aws-vault exec <account> -- python3 binlog_replication.py --db <cluster>-<stack>-<env> --region <aws-region> --action prepare [--retention-hours 48]
+# aws-vault exec <account> -- python3 binlog_replication.py --db <cluster>-<stack>-<env> --region <aws-region> --action start [--binlog-file <file> --binlog-position <pos>]
+# aws-vault exec <account> -- python3 binlog_replication.py --db <cluster>-<stack>-<env> --region <aws-region> --action status|stop
+#
+# Catches the -encrypted instance up with MySQL's own replication instead of DMS CDC. The target is restored from
+# a snapshot of the source, so it only needs the source's binlog from the point of that snapshot.
+#   prepare - run before the snapshot. Checks that the source writes a ROW binlog and keeps it for --retention-hours
+#             (mysql.rds_set_configuration 'binlog retention hours'), long enough to cover the snapshot, copy and restore
+#   start   - makes the target a replica of the source from the snapshot's binlog coordinates and starts it
+#   status  - prints the replica's threads, position and lag
+#   stop    - stops replication and forgets the source, cdc_cutover.py --replication does this once the target caught up
+# The coordinates are, in order: --binlog-file/--binlog-position (e.g. the ones direct_copy.py prints), GTID
+# auto-positioning when gtid_mode is ON on both sides, or the binlog position the restored instance recovered to,
+# read from its RDS events and error log. The target has to reach the source on --port, they are in the same VPC.
+#
+# RDS instances are set up with the mysql.rds_* procedures, anything else with CHANGE REPLICATION SOURCE TO, so two
+# local MySQL containers can stand in for them, see the README. --replica-source-host is the source's address as
+# the target sees it when it isn't the one this script connects to. Needs PyMySQL (pip install pymysql)
+
+import argparse
+import os
+import re
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import clients, tracing
+from common.databases import database_endpoints, source_endpoint
+from common.mysql import connect, master_status, replica_status
+
+DEFAULT_RETENTION_HOURS = 48
+
+# How the restored instance reports where its binlog stops, in its RDS events and error log
+RECOVERY_POSITION_PATTERNS = (
+    (re.compile(r"[Bb]inlog position from crash recovery is (\S+) (\d+)"), 'File', 'Position'),
+    (re.compile(r"[Ll]ast MySQL binlog file position 0 (\d+), file name (\S+)"), 'Position', 'File')
+)
+
+def add_arguments(parser):
+    parser.add_argument('--db', help='source database, cluster-stack-env, the target is <db>-encrypted')
+    parser.add_argument('--region', help='region')
+    parser.add_argument('--action', required=True, choices=['prepare', 'start', 'status', 'stop'], help='what to do, see the usage')
+    parser.add_argument('--source-host', help='source endpoint, instead of the one of --db')
+    parser.add_argument('--target-host', help='target endpoint, instead of the one of <db>-encrypted')
+    parser.add_argument('--replica-source-host', help='source address the target replicates from, defaults to the source endpoint')
+    parser.add_argument('--port', type=int, default=3306, help='database port')
+    parser.add_argument('--target-port', type=int, help='target port, defaults to --port')
+    parser.add_argument('--user', default='cosmos', help='database user, also used by the replica to connect to the source')
+    parser.add_argument('--password', help='database password, instead of the stack output MySQLPassword')
+    parser.add_argument('--retention-hours', type=int, default=DEFAULT_RETENTION_HOURS, help='binlog retention set on the source by prepare')
+    parser.add_argument('--binlog-file', help='binlog file to start replicating from, instead of finding it')
+    parser.add_argument('--binlog-position', type=int, help='position in --binlog-file to start replicating from')
+
+parser = argparse.ArgumentParser(description="Catch the encrypted target up with MySQL binlog replication")
+add_arguments(parser)
+parser.add_argument('--trace', help='write a Chrome trace of the phases and AWS API calls to this file and print a call summary')
+
+def is_rds(connection):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT COUNT(*) FROM information_schema.ROUTINES WHERE ROUTINE_SCHEMA = 'mysql' AND ROUTINE_NAME = 'rds_set_external_master'")
+        return cursor.fetchone()[0] > 0
+
+def variables(connection, *names):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT " + ", ".join(f"@@GLOBAL.{name}" for name in names))
+        return dict(zip(names, cursor.fetchone()))
+
+def gtid_enabled(connection):
+    return str(variables(connection, 'gtid_mode')['gtid_mode']).upper() == 'ON'
+
+class Replica:
+    # The target replicating from the source, what cdc_cutover.py measures the lag with
+    def __init__(self, source, target):
+        self.source = source
+        self.target = target
+
+    def status(self):
+        status = replica_status(self.target)
+        if status is None:
+            raise RuntimeError("The target isn't replicating, start it with binlog_replication.py --action start")
+        for thread in ('IO', 'SQL'):
+            error = status.get(f'Last_{thread}_Error')
+            if status.get(f'Replica_{thread}_Running') == 'No' and error:
+                raise RuntimeError(f"Replication {thread} thread stopped: {error}")
+        return status
+
+    def lag(self):
+        # Seconds_Behind_Source, whole seconds only, None while it can't tell (e.g. the IO thread is reconnecting)
+        return self.status().get('Seconds_Behind_Source')
+
+    def caught_up(self):
+        # Everything the source has written is applied on the target, exact unlike the lag
+        source = master_status(self.source)
+        if source is None:
+            raise RuntimeError("Binary logging is off on the source, there is nothing for the target to catch up with")
+        status = self.status()
+        if not status.get('Relay_Source_Log_File'):
+            # Hasn't applied anything from the source yet
+            return False
+        return (status['Relay_Source_Log_File'], int(status['Exec_Source_Log_Pos'])) >= (source['File'], source['Position'])
+
+    def stop(self):
+        stop_replication(self.target)
+
+def prepare_source(connection, retention_hours=DEFAULT_RETENTION_HOURS):
+    settings = variables(connection, 'log_bin', 'binlog_format', 'gtid_mode')
+    if str(settings['log_bin']) not in ('1', 'ON'):
+        raise SystemExit("Binary logging is off on the source, on RDS it needs automated backups to be enabled")
+    if str(settings['binlog_format']).upper() != 'ROW':
+        raise SystemExit(f"binlog_format is {settings['binlog_format']} on the source, set it to ROW in its parameter group first")
+    if is_rds(connection):
+        with connection.cursor() as cursor:
+            cursor.execute("CALL mysql.rds_set_configuration('binlog retention hours', %s)", (retention_hours,))
+        print(f"Source keeps its binlog for {retention_hours}h")
+    print(f"Source is ready for replication, gtid_mode {settings['gtid_mode']}, currently at {format_coordinates(master_status(connection))}\n")
+
+def format_coordinates(coordinates):
+    return f"{coordinates['File']}:{coordinates['Position']}" if coordinates else "GTID auto-position"
+
+def recovery_position(rds, db_instance_id):
+    # The binlog position the restored instance recovered to, which is where the snapshot was taken. None when not found
+    messages = []
+    paginator = rds.get_paginator('describe_events')
+    for page in paginator.paginate(SourceIdentifier=db_instance_id, SourceType='db-instance', Duration=7 * 24 * 60):
+        messages.extend(event['Message'] for event in page['Events'])
+    log_files = rds.describe_db_log_files(DBInstanceIdentifier=db_instance_id, FilenameContains='error')['DescribeDBLogFiles']
+    for log_file in sorted(log_files, key=lambda log_file: log_file['LastWritten']):
+        paginator = rds.get_paginator('download_db_log_file_portion')
+        for page in paginator.paginate(DBInstanceIdentifier=db_instance_id, LogFileName=log_file['LogFileName']):
+            messages.extend((page.get('LogFileData') or '').splitlines())
+
+    # The last recovery is the one that matters
+    for message in reversed(messages):
+        for pattern, first, second in RECOVERY_POSITION_PATTERNS:
+            match = pattern.search(message)
+            if match:
+                position = {first: match.group(1), second: match.group(2)}
+                return {'File': position['File'], 'Position': int(position['Position'])}
+    return None
+
+def find_coordinates(source, target, rds=None, target_id=None, binlog_file=None, binlog_position=None):
+    # Where the target starts replicating from, None meaning GTID auto-positioning
+    if binlog_file:
+        if binlog_position is None:
+            raise SystemExit("--binlog-position is required with --binlog-file")
+        return {'File': binlog_file, 'Position': binlog_position}
+    if gtid_enabled(source) and gtid_enabled(target):
+        return None
+    coordinates = recovery_position(rds, target_id) if rds else None
+    if coordinates is None:
+        raise SystemExit("Couldn't find the binlog position of the target's snapshot, give --binlog-file and --binlog-position")
+    return coordinates
+
+def start_replication(target, source_host, port, user, password, coordinates):
+    print(f"### Replicating from '{source_host}' at {format_coordinates(coordinates)}...")
+    with target.cursor() as cursor:
+        if is_rds(target):
+            if coordinates:
+                cursor.execute("CALL mysql.rds_set_external_master(%s, %s, %s, %s, %s, %s, 1)",
+                               (source_host, port, user, password, coordinates['File'], coordinates['Position']))
+            else:
+                cursor.execute("CALL mysql.rds_set_external_master_with_auto_position(%s, %s, %s, %s, 1, 0)",
+                               (source_host, port, user, password))
+            cursor.execute("CALL mysql.rds_start_replication")
+        else:
+            position = "SOURCE_LOG_FILE = %s, SOURCE_LOG_POS = %s" if coordinates else "SOURCE_AUTO_POSITION = 1"
+            cursor.execute(
+                "CHANGE REPLICATION SOURCE TO SOURCE_HOST = %s, SOURCE_PORT = %s, SOURCE_USER = %s, SOURCE_PASSWORD = %s, "
+                f"GET_SOURCE_PUBLIC_KEY = 1, {position}",
+                (source_host, port, user, password) + ((coordinates['File'], coordinates['Position']) if coordinates else ())
+            )
+            cursor.execute("START REPLICA")
+
+def stop_replication(target):
+    with target.cursor() as cursor:
+        if is_rds(target):
+            cursor.execute("CALL mysql.rds_stop_replication")
+            cursor.execute("CALL mysql.rds_reset_external_master")
+        else:
+            cursor.execute("STOP REPLICA")
+            cursor.execute("RESET REPLICA ALL")
+    print("Replication stopped, the target no longer follows the source\n")
+
+def print_status(target):
+    status = replica_status(target)
+    if status is None:
+        print("The target isn't replicating")
+        return
+    print(f"IO thread {status.get('Replica_IO_Running')}, SQL thread {status.get('Replica_SQL_Running')}, "
+          f"applied up to {status.get('Relay_Source_Log_File')}:{status.get('Exec_Source_Log_Pos')}, "
+          f"{status.get('Seconds_Behind_Source')}s behind")
+    for thread in ('IO', 'SQL'):
+        if status.get(f'Last_{thread}_Error'):
+            print(f"Last {thread} error: {status[f'Last_{thread}_Error']}")
+
+def prepare(region, db, user, password=None, retention_hours=DEFAULT_RETENTION_HOURS):
+    # Only needs the source, so it runs before the snapshot
+    source_host, password = source_endpoint(region, db, password=password)
+    source = connect(source_host, user, password)
+    try:
+        prepare_source(source, retention_hours)
+    finally:
+        source.close()
+
+def start(region, db, user, password=None, source_port=3306, target_port=None):
+    source_host, target_host, password = database_endpoints(region, db, password=password)
+    source = connect(source_host, user, password, source_port)
+    target = connect(target_host, user, password, target_port or source_port)
+    try:
+        coordinates = find_coordinates(source, target, clients.get_client('rds', region), f"{db}-encrypted")
+        with tracing.phase('start-replication', db):
+            # The target connects to the source, so it gets the source's port
+            start_replication(target, source_host, source_port, user, password, coordinates)
+        print_status(target)
+    finally:
+        source.close()
+        target.close()
+    return True
+
+def main(args):
+    if args.action == 'prepare':
+        source_host, password = source_endpoint(args.region, args.db, args.source_host, args.password)
+        source = connect(source_host, args.user, password, args.port)
+        try:
+            return prepare_source(source, args.retention_hours)
+        finally:
+            source.close()
+
+    source_host, target_host, password = database_endpoints(args.region, args.db, args.source_host, args.target_host, args.password)
+    target = connect(target_host, args.user, password, args.target_port or args.port)
+    try:
+        if args.action == 'status':
+            return print_status(target)
+        if args.action == 'stop':
+            return stop_replication(target)
+
+        source = connect(source_host, args.user, password, args.port)
+        try:
+            rds = clients.get_client('rds', args.region) if args.db and args.region else None
+            coordinates = find_coordinates(source, target, rds, f"{args.db}-encrypted", args.binlog_file, args.binlog_position)
+        finally:
+            source.close()
+        with tracing.phase('start-replication', args.db):
+            start_replication(target, args.replica_source_host or source_host, args.port, args.user, password, coordinates)
+        print_status(target)
+        return True
+    finally:
+        target.close()
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    with tracing.traced(args.trace):
+        main(args)
@@ -0,0 +1,209 @@
+# Usage
+# aws-vault exec <account> -- python3 bulk_load_parameter_group.py --db <cluster>-<stack>-<env> --region <aws-region> --action apply|restore|watch
+#
+# Runs the -encrypted target on a bulk-load parameter group during the DMS full load.
+#   apply   - copies the target's parameter group to <db>-encrypted-bulk-load with relaxed durability settings and
+#             larger log/insert buffers, attaches it and reboots the target. Run it before create_dms_stack.py, while the target is idle
+#   restore - sets the bulk-load group's parameters back to the original values (dynamic ones applied immediately)
+#             and attaches the original group again, so the target is back on production settings for CDC
+#   watch   - waits for the full load of the <db>-data-migration to finish, then does the restore
+
+import argparse
+import os
+import sys
+import time
+
+SCRIPTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(SCRIPTS_DIR)
+sys.path.append(os.path.join(SCRIPTS_DIR, 'snapshots-and-restoring-db-instance'))
+
+from common import clients
+from common.inventory import get_inventory
+from status_poller import MIN_DELAY, get_status_poller
+
+def add_arguments(parser):
+    parser.add_argument('--db', required=True, help='source database, cluster-stack-env')
+    parser.add_argument('--region', required=True, help='region')
+    parser.add_argument('--action', required=True, choices=['apply', 'restore', 'watch'], help='what to do with the target parameter group')
+
+parser = argparse.ArgumentParser(description="Bulk-load parameter group for the DMS full load")
+add_arguments(parser)
+
+# Dynamic parameters are switched back without rebooting the target mid CDC, static ones (depending on the engine
+# version, e.g. innodb_log_buffer_size) go back with the next reboot. bulk_insert_buffer_size only helps MyISAM tables
+BULK_LOAD_PARAMETERS = {
+    'innodb_flush_log_at_trx_commit': '2',
+    'sync_binlog': '0',
+    'innodb_io_capacity': '4000',
+    'innodb_io_capacity_max': '8000',
+    'innodb_log_buffer_size': '268435456',
+    'bulk_insert_buffer_size': '268435456',
+    'max_allowed_packet': '1073741824'
+}
+
+def bulk_load_group_name(db):
+    return f"{db}-encrypted-bulk-load"
+
+def get_instance(rds, db_instance_id):
+    response = rds.describe_db_instances(DBInstanceIdentifier=db_instance_id)
+    return response['DBInstances'][0]
+
+def describe_parameters(rds, parameter_group, names):
+    parameters = {}
+    paginator = rds.get_paginator('describe_db_parameters')
+    for page in paginator.paginate(DBParameterGroupName=parameter_group):
+        for parameter in page['Parameters']:
+            if parameter['ParameterName'] in names:
+                parameters[parameter['ParameterName']] = parameter
+    return parameters
+
+def get_parameter_values(rds, parameter_group, names):
+    # Current values of the given parameters, None for the ones left at the engine default
+    parameters = describe_parameters(rds, parameter_group, names)
+    return {name: parameters.get(name, {}).get('ParameterValue') for name in names}
+
+def get_apply_methods(rds, parameter_group, names):
+    parameters = describe_parameters(rds, parameter_group, names)
+    return {name: 'pending-reboot' if parameters.get(name, {}).get('ApplyType') == 'static' else 'immediate' for name in names}
+
+def wait_for_instance(poller, db_instance_id):
+    print(f"Waiting for DB instance '{db_instance_id}' to become available...")
+    if not poller.wait_for_db_instance(db_instance_id):
+        raise SystemExit(f"DB instance '{db_instance_id}' did not become available")
+    print("DB instance is now available.\n")
+
+def wait_for_parameter_group(rds, poller, db_instance_id, parameter_group):
+    # The status can read available before the new group is attached, it is only safe to reboot once it isn't applying
+    while True:
+        wait_for_instance(poller, db_instance_id)
+        group = get_instance(rds, db_instance_id)['DBParameterGroups'][0]
+        if group['DBParameterGroupName'] == parameter_group and group['ParameterApplyStatus'] != 'applying':
+            return
+        time.sleep(MIN_DELAY)
+
+def apply_bulk_load_group(rds, poller, db):
+    target_db = f"{db}-encrypted"
+    instance = get_instance(rds, target_db)
+    original_group = instance['DBParameterGroups'][0]['DBParameterGroupName']
+    bulk_group = bulk_load_group_name(db)
+    if original_group == bulk_group:
+        print(f"'{target_db}' is already on the bulk-load parameter group")
+        return bulk_group
+
+    print(f"### Creating parameter group '{bulk_group}' from '{original_group}'...")
+    try:
+        rds.copy_db_parameter_group(
+            SourceDBParameterGroupIdentifier=original_group,
+            TargetDBParameterGroupIdentifier=bulk_group,
+            TargetDBParameterGroupDescription=f"Bulk-load settings for the DMS full load into {target_db}",
+            Tags=[{'Key': 'original-parameter-group', 'Value': original_group}]
+        )
+    except rds.exceptions.DBParameterGroupAlreadyExistsFault:
+        print(f"Parameter group '{bulk_group}' already exists, reusing it")
+
+    apply_methods = get_apply_methods(rds, bulk_group, BULK_LOAD_PARAMETERS.keys())
+    rds.modify_db_parameter_group(
+        DBParameterGroupName=bulk_group,
+        Parameters=[
+            {'ParameterName': name, 'ParameterValue': value, 'ApplyMethod': apply_methods[name]}
+            for name, value in BULK_LOAD_PARAMETERS.items()
+        ]
+    )
+
+    # A newly attached parameter group only takes effect after a reboot
+    print(f"Attaching '{bulk_group}' to '{target_db}' and rebooting it...")
+    rds.modify_db_instance(
+        DBInstanceIdentifier=target_db,
+        DBParameterGroupName=bulk_group,
+        ApplyImmediately=True
+    )
+    wait_for_parameter_group(rds, poller, target_db, bulk_group)
+    rds.reboot_db_instance(DBInstanceIdentifier=target_db)
+    wait_for_instance(poller, target_db)
+    print(f"'{target_db}' is running with the bulk-load parameters, the original group was '{original_group}'")
+    return bulk_group
+
+def restore_original_group(rds, db):
+    target_db = f"{db}-encrypted"
+    bulk_group = bulk_load_group_name(db)
+    instance = get_instance(rds, target_db)
+    if instance['DBParameterGroups'][0]['DBParameterGroupName'] != bulk_group:
+        print(f"'{target_db}' isn't on the bulk-load parameter group, nothing to restore")
+        return True
+
+    group_arn = rds.describe_db_parameter_groups(DBParameterGroupName=bulk_group)['DBParameterGroups'][0]['DBParameterGroupArn']
+    tags = rds.list_tags_for_resource(ResourceName=group_arn)['TagList']
+    original_group = next(tag['Value'] for tag in tags if tag['Key'] == 'original-parameter-group')
+
+    # Putting the original values back on the attached group applies straight away, so the target is on
+    # production settings without a reboot. Attaching the original group itself waits for the next reboot,
+    # which is harmless since both groups then hold the same values
+    print(f"### Restoring the parameters of '{target_db}' to the values of '{original_group}'...")
+    original_values = get_parameter_values(rds, original_group, BULK_LOAD_PARAMETERS.keys())
+    apply_methods = get_apply_methods(rds, bulk_group, BULK_LOAD_PARAMETERS.keys())
+    to_reset = [name for name, value in original_values.items() if value is None]
+    to_set = {name: value for name, value in original_values.items() if value is not None}
+    if to_reset:
+        rds.reset_db_parameter_group(
+            DBParameterGroupName=bulk_group,
+            Parameters=[{'ParameterName': name, 'ApplyMethod': apply_methods[name]} for name in to_reset]
+        )
+    if to_set:
+        rds.modify_db_parameter_group(
+            DBParameterGroupName=bulk_group,
+            Parameters=[{'ParameterName': name, 'ParameterValue': value, 'ApplyMethod': apply_methods[name]} for name, value in to_set.items()]
+        )
+
+    rds.modify_db_instance(
+        DBInstanceIdentifier=target_db,
+        DBParameterGroupName=original_group,
+        ApplyImmediately=True
+    )
+    print(f"'{target_db}' is back on production settings, '{original_group}' will be fully in effect after the next reboot")
+    print(f"Delete '{bulk_group}' once the target has been rebooted\n")
+    return True
+
+def get_data_migration(dms, data_migration_name):
+    paginator = dms.get_paginator('describe_data_migrations')
+    for page in paginator.paginate(WithoutSettings=True):
+        for data_migration in page['DataMigrations']:
+            if data_migration['DataMigrationName'] == data_migration_name:
+                return data_migration
+    return None
+
+def wait_for_full_load(dms, db, delay=60):
+    data_migration_name = f"{db}-data-migration"
+    print(f"Waiting for the full load of '{data_migration_name}' to finish...")
+    while True:
+        data_migration = get_data_migration(dms, data_migration_name)
+        if data_migration is None:
+            print(f"Data migration '{data_migration_name}' not found")
+            return False
+        statistics = data_migration.get('DataMigrationStatistics', {})
+        status = data_migration.get('DataMigrationStatus')
+        if status in ('FAILED', 'STOPPED'):
+            print(f"Data migration '{data_migration_name}' is {status}: {data_migration.get('LastFailureMessage', '')}")
+            return False
+        if statistics.get('FullLoadPercentage') == 100 and not statistics.get('TablesLoading') and not statistics.get('TablesQueued'):
+            print(f"Full load finished, {statistics.get('TablesLoaded', 0)} tables loaded\n")
+            return True
+        print(f"Full load at {statistics.get('FullLoadPercentage', 0)}% ({statistics.get('TablesLoading', 0)} tables loading, {statistics.get('TablesQueued', 0)} queued)")
+        time.sleep(delay)
+
+def main(args):
+    rds = clients.get_client('rds', args.region)
+
+    try:
+        if args.action == 'apply':
+            return apply_bulk_load_group(rds, get_status_poller(args.region), args.db)
+        if args.action == 'restore':
+            return restore_original_group(rds, args.db)
+        dms = clients.get_client('dms', args.region)
+        if wait_for_full_load(dms, args.db):
+            return restore_original_group(rds, args.db)
+    finally:
+        # The target's parameter group may have changed
+        get_inventory(args.region).invalidate(f"{args.db}-encrypted")
+
+if __name__ == "__main__":
+    main(parser.parse_args())
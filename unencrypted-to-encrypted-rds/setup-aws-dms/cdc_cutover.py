@@ -0,0 +1,296 @@
+# Usage
+# aws-vault exec <account> -- python3 cdc_cutover.py --db <cluster>-<stack>-<env> --region <aws-region> --action monitor [--heartbeat-schema <schema>]
+# aws-vault exec <account> -- python3 cdc_cutover.py --db <cluster>-<stack>-<env> --region <aws-region> --action cutover --freeze-command "<cmd>" [--unfreeze-command "<cmd>"] [--max-lag 5]
+# aws-vault exec <account> -- python3 cdc_cutover.py --db <cluster>-<stack>-<env> --region <aws-region> --replication --action cutover --freeze-command "<cmd>"
+#
+# Follows the CDC lag of the <db>-data-migration once create_dms_stack.py has started it and drives the cutover.
+# The lag is the data migration's CDCLatency and, with --heartbeat-schema, the age of the oldest heartbeat row
+# written to the source that hasn't shown up on the -encrypted target yet. The heartbeat is written and read
+# from here, so it doesn't depend on the clocks of the instances. The table is only created on the source, so
+# the schema has to be one DMS or replication carries over to the target.
+# With --replication the target catches up with binlog replication (binlog_replication.py) instead of DMS. The
+# lag is then the replica's Seconds_Behind_Source, plus the heartbeat for sub-second readings, and once the
+# target has applied the source's binlog up to its current position after the freeze, replication is stopped.
+#   monitor - prints the lag every --interval seconds
+#   cutover - waits for the lag to stay under --max-lag for --stable-probes probes in a row, runs --freeze-command
+#             to stop the app's writes, waits for the lag to reach zero and prints how long writes were frozen.
+#             With --replication, zero lag means the target applied the source's binlog up to where it was after
+#             the freeze. Otherwise, with a heartbeat, it means the last row written after the freeze is on the
+#             target, without one it means CDCLatency read 0 twice in a row. If the target doesn't catch up within
+#             --confirm-timeout, --unfreeze-command is run and the cutover fails
+# Point the app at the target and unfreeze it once the cutover reports zero lag. With --db, a target restored with
+# create_encrypted_rds.py --boost-class is then put back on the source's shape, unless --no-scale-back is given.
+#
+# --source-host/--target-host/--password replace the endpoints from the inventory and the stack's MySQLPassword,
+# point both at a local MySQL to try the heartbeat or replication out, see the README. Needs PyMySQL for the heartbeat
+# and replication
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+SCRIPTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(SCRIPTS_DIR)
+
+from common import clients, tracing
+from common.databases import database_endpoints
+from common.mysql import connect, quote_identifier
+from binlog_replication import Replica
+from bulk_load_parameter_group import get_data_migration
+
+HEARTBEAT_TABLE = "_cutover_heartbeat"
+HEARTBEAT_SETUP_TIMEOUT = 300
+DMS_CONFIRM_INTERVAL = 5
+
+def add_arguments(parser):
+    parser.add_argument('--db', help='source database, cluster-stack-env')
+    parser.add_argument('--region', help='region')
+    parser.add_argument('--action', required=True, choices=['monitor', 'cutover'], help='follow the lag, or drive the cutover')
+    parser.add_argument('--replication', action='store_true', help='the target catches up with binlog replication instead of DMS (needs PyMySQL)')
+    parser.add_argument('--heartbeat-schema', help='schema replicated by DMS to write the heartbeat table to (needs PyMySQL)')
+    parser.add_argument('--db-user', default='cosmos', help='database user for the heartbeat, the password is read from the stack output MySQLPassword')
+    parser.add_argument('--password', help='database password, instead of the stack output')
+    parser.add_argument('--source-host', help='source endpoint, instead of the one from the inventory')
+    parser.add_argument('--target-host', help='target endpoint, instead of the one of <db>-encrypted')
+    parser.add_argument('--port', type=int, default=3306, help='database port')
+    parser.add_argument('--target-port', type=int, help='target port, defaults to --port')
+    parser.add_argument('--interval', type=float, default=5, help='seconds between lag probes')
+    parser.add_argument('--max-lag', type=float, default=5, help='lag in seconds under which writes are frozen')
+    parser.add_argument('--stable-probes', type=int, default=3, help='probes in a row that have to be under --max-lag before freezing')
+    parser.add_argument('--catch-up-timeout', type=float, default=3600, help='seconds to wait for the lag to get under --max-lag')
+    parser.add_argument('--confirm-timeout', type=float, default=300, help='seconds to wait for zero lag once writes are frozen')
+    parser.add_argument('--freeze-command', help='shell command that stops the app writing to the source, required for cutover')
+    parser.add_argument('--unfreeze-command', help='shell command run when the target doesn\'t catch up after the freeze')
+    parser.add_argument('--no-scale-back', action='store_true', help='leave a boosted target on its boost shape after the cutover, e.g. to scale it back in a quieter moment with create_encrypted_rds.py --scale-back')
+
+parser = argparse.ArgumentParser(description="Monitor the DMS CDC lag and drive the cutover")
+add_arguments(parser)
+parser.add_argument('--trace', help='write a Chrome trace of the phases and AWS API calls to this file and print a call summary')
+
+class Heartbeat:
+    # One row on the source, its sequence number bumped on every beat and read back from the target
+    def __init__(self, source, target, schema):
+        self.source = source
+        self.target = target
+        self.schema = schema
+        self.table = f"{quote_identifier(schema)}.{quote_identifier(HEARTBEAT_TABLE)}"
+        self.sequence = 0
+        self.sent = {}
+
+    def setup(self, timeout=HEARTBEAT_SETUP_TIMEOUT):
+        # Created on the source only and left to replicate, DDL run on the target itself would conflict
+        # with the replicated statements for the same table
+        for connection in (self.source, self.target):
+            connection.autocommit(True)
+        with self.source.cursor() as cursor:
+            cursor.execute(f"CREATE TABLE IF NOT EXISTS {self.table} (id INT PRIMARY KEY, sequence BIGINT NOT NULL)")
+        started = time.monotonic()
+        while not self.replicated():
+            if time.monotonic() - started > timeout:
+                raise RuntimeError(f"{self.table} didn't show up on the target within {timeout}s, is '{self.schema}' replicated?")
+            time.sleep(1)
+        with self.source.cursor() as cursor:
+            cursor.execute(f"SELECT sequence FROM {self.table} WHERE id = 1")
+            row = cursor.fetchone()
+        self.sequence = row[0] if row else 0
+
+    def replicated(self):
+        with self.target.cursor() as cursor:
+            cursor.execute(
+                "SELECT COUNT(*) FROM information_schema.TABLES WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s",
+                (self.schema, HEARTBEAT_TABLE)
+            )
+            return cursor.fetchone()[0] > 0
+
+    def beat(self):
+        self.sequence += 1
+        with self.source.cursor() as cursor:
+            cursor.execute(f"REPLACE INTO {self.table} (id, sequence) VALUES (1, %s)", (self.sequence,))
+        self.sent[self.sequence] = time.monotonic()
+        return self.sequence
+
+    def applied(self):
+        with self.target.cursor() as cursor:
+            cursor.execute(f"SELECT sequence FROM {self.table} WHERE id = 1")
+            row = cursor.fetchone()
+        return row[0] if row else 0
+
+    def lag(self):
+        # Age of the oldest beat the target hasn't got yet, 0 when it has them all
+        applied = self.applied()
+        for sequence in [sequence for sequence in self.sent if sequence <= applied]:
+            del self.sent[sequence]
+        if not self.sent:
+            return 0
+        return time.monotonic() - self.sent[min(self.sent)]
+
+class LagMonitor:
+    def __init__(self, dms=None, data_migration_name=None, heartbeat=None, replica=None):
+        self.dms = dms
+        self.data_migration_name = data_migration_name
+        self.heartbeat = heartbeat
+        self.replica = replica
+
+    def dms_lag(self):
+        if self.dms is None:
+            return None
+        data_migration = get_data_migration(self.dms, self.data_migration_name)
+        if data_migration is None:
+            raise RuntimeError(f"Data migration '{self.data_migration_name}' not found")
+        status = data_migration.get('DataMigrationStatus')
+        if status in ('FAILED', 'STOPPED'):
+            raise RuntimeError(f"Data migration '{self.data_migration_name}' is {status}: {data_migration.get('LastFailureMessage', '')}")
+        return data_migration.get('DataMigrationStatistics', {}).get('CDCLatency')
+
+    def probe(self):
+        # Returns the largest lag of the sources that have a reading, None when none has
+        readings = {}
+        if self.heartbeat:
+            self.heartbeat.beat()
+            readings['heartbeat'] = self.heartbeat.lag()
+        if self.replica:
+            replica_lag = self.replica.lag()
+            if replica_lag is not None:
+                readings['replication'] = replica_lag
+        dms_lag = self.dms_lag()
+        if dms_lag is not None:
+            readings['DMS CDCLatency'] = dms_lag
+        print("Lag: " + (", ".join(f"{name} {value:.1f}s" for name, value in readings.items()) or "no reading yet"))
+        return max(readings.values()) if readings else None
+
+def monitor(lag_monitor, interval):
+    while True:
+        lag_monitor.probe()
+        time.sleep(interval)
+
+def wait_for_catch_up(lag_monitor, max_lag, stable_probes, interval, timeout):
+    print(f"### Waiting for the lag to stay under {max_lag}s for {stable_probes} probes...")
+    started = time.monotonic()
+    stable = 0
+    while True:
+        lag = lag_monitor.probe()
+        stable = stable + 1 if lag is not None and lag <= max_lag else 0
+        if stable >= stable_probes:
+            return True
+        if time.monotonic() - started > timeout:
+            print(f"Lag didn't get under {max_lag}s within {timeout}s")
+            return False
+        time.sleep(interval)
+
+def confirm_zero_lag(lag_monitor, timeout, interval=0.5):
+    started = time.monotonic()
+    if lag_monitor.replica:
+        # The source's binlog doesn't move once writes are frozen, so this is where the target has to get to
+        while not lag_monitor.replica.caught_up():
+            if time.monotonic() - started > timeout:
+                return False
+            time.sleep(interval)
+        return True
+
+    if lag_monitor.heartbeat:
+        # Everything written before this beat is on the target once the beat is
+        marker = lag_monitor.heartbeat.beat()
+        while lag_monitor.heartbeat.applied() < marker:
+            if time.monotonic() - started > timeout:
+                return False
+            time.sleep(interval)
+        return True
+
+    # CDCLatency only changes every few seconds, so it has to read 0 twice
+    zero_readings = 0
+    while True:
+        zero_readings = zero_readings + 1 if lag_monitor.dms_lag() == 0 else 0
+        if zero_readings >= 2:
+            return True
+        if time.monotonic() - started > timeout:
+            return False
+        time.sleep(DMS_CONFIRM_INTERVAL)
+
+def run_command(command):
+    print(f"Running '{command}'...")
+    subprocess.run(command, shell=True, check=True)
+
+def cutover(lag_monitor, freeze_command, unfreeze_command=None, max_lag=5, stable_probes=3, interval=5, catch_up_timeout=3600, confirm_timeout=300):
+    # Returns the write-freeze duration in seconds, None when the cutover didn't happen
+    if not wait_for_catch_up(lag_monitor, max_lag, stable_probes, interval, catch_up_timeout):
+        return None
+
+    print("### Freezing writes...")
+    frozen = time.monotonic()
+    with tracing.phase('write-freeze'):
+        run_command(freeze_command)
+        confirmed = confirm_zero_lag(lag_monitor, confirm_timeout)
+    freeze_duration = time.monotonic() - frozen
+
+    if not confirmed:
+        print(f"Target didn't catch up within {confirm_timeout}s of the freeze")
+        if unfreeze_command:
+            run_command(unfreeze_command)
+        return None
+    print(f"Lag is zero, writes were frozen for {freeze_duration:.1f}s so far. Point the app at the target and unfreeze it\n")
+    return freeze_duration
+
+def scale_back_target(db, region):
+    # Puts a target restored with --boost-class back on the source's shape, a no-op when it already has it
+    encrypted_rds_dir = os.path.join(SCRIPTS_DIR, 'snapshots-and-restoring-db-instance')
+    if encrypted_rds_dir not in sys.path:
+        sys.path.append(encrypted_rds_dir)
+    from create_encrypted_rds import scale_back_instance
+
+    with tracing.phase('scale-back', db):
+        return scale_back_instance(db, region)
+
+def build_monitor(args):
+    dms = None
+    if args.db:
+        if not args.region:
+            raise SystemExit("--region is required with --db")
+        if not args.replication:
+            dms = clients.get_client('dms', args.region)
+
+    heartbeat = None
+    replica = None
+    if args.heartbeat_schema or args.replication:
+        source_host, target_host, password = database_endpoints(args.region, args.db, args.source_host, args.target_host, args.password)
+        source = connect(source_host, args.db_user, password, args.port)
+        target = connect(target_host, args.db_user, password, args.target_port or args.port)
+        if args.heartbeat_schema:
+            heartbeat = Heartbeat(source, target, args.heartbeat_schema)
+            heartbeat.setup()
+        if args.replication:
+            replica = Replica(source, target)
+
+    if dms is None and heartbeat is None and replica is None:
+        raise SystemExit("Nothing to measure the lag with, give --db and --region, --heartbeat-schema and/or --replication")
+    return LagMonitor(dms, f"{args.db}-data-migration" if dms else None, heartbeat, replica)
+
+def main(args):
+    if args.action == 'cutover' and not args.freeze_command:
+        raise SystemExit("--freeze-command is required for cutover")
+    lag_monitor = build_monitor(args)
+    try:
+        if args.action == 'monitor':
+            return monitor(lag_monitor, args.interval)
+        freeze_duration = cutover(lag_monitor, args.freeze_command, args.unfreeze_command, args.max_lag, args.stable_probes, args.interval, args.catch_up_timeout, args.confirm_timeout)
+        if freeze_duration is not None and lag_monitor.replica:
+            # Before the app writes to the target, so nothing the source does from now on is applied over it
+            lag_monitor.replica.stop()
+    finally:
+        # The heartbeat and the replica share the same two connections
+        databases = lag_monitor.heartbeat or lag_monitor.replica
+        if databases:
+            databases.source.close()
+            databases.target.close()
+
+    if freeze_duration is not None and args.db and not args.no_scale_back:
+        # The boost was only for the full load and catch-up. The class change restarts the target, and storage
+        # changes within 6 hours of the restore are retried until they are allowed
+        scale_back_target(args.db, args.region)
+    return freeze_duration
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    with tracing.traced(args.trace):
+        main(args)
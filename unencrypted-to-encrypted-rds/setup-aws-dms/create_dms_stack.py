@@ -1,34 +1,29 @@
 # Usage
-# aws-vault exec <account> -- python3 create_dms_stack.py --stack <cluster>-<stack>-<env> --template <template_url> --region <aws-region>
+# aws-vault exec <account> -- python3 create_dms_stack.py --stack <cluster>-<stack>-<env> --template <template_url> --region <aws-region> [--trace <file.json>]
 
-import boto3
 import argparse
+import os
+import sys
 
-parser = argparse.ArgumentParser(description="Create DMS stack")
-parser.add_argument('--stack', required=True, help='stack')
-parser.add_argument('--template', required=True, help='CF template URL')
-parser.add_argument('--region', required=True, help='region')
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-args = parser.parse_args()
+from common import clients, tracing
+from common.stack_events import StackEvents
+from common.stacks import stack_cache
 
-stack = args.stack
-cf_template_url = args.template
-aws_region = args.region
+def add_arguments(parser):
+    parser.add_argument('--stack', required=True, help='stack')
+    parser.add_argument('--template', required=True, help='CF template URL')
+    parser.add_argument('--region', required=True, help='region')
 
-cf = boto3.client('cloudformation', region_name=aws_region)
+parser = argparse.ArgumentParser(description="Create DMS stack")
+add_arguments(parser)
+parser.add_argument('--trace', help='write a Chrome trace of the phases and AWS API calls to this file and print a call summary')
 
-def fetch_db_password():
-    response = cf.describe_stacks(
-        StackName=stack
-        )
-    Outputs = response['Stacks'][0]['Outputs']
-    for output in Outputs:
-        if output['OutputKey'] == "MySQLPassword":
-            mysql_password = output['OutputValue']
-            
-    return mysql_password
+def fetch_db_password(cf, stack):
+    return stack_cache(cf).get_output(stack, "MySQLPassword")
 
-def create_dms_cf_stack(mysql_password, template_url):
+def create_dms_cf_stack(cf, stack, mysql_password, template_url):
     response = cf.create_stack(
         StackName=f"{stack}-dms-stack",
         TemplateURL=template_url,
@@ -42,23 +37,29 @@ def create_dms_cf_stack(mysql_password, template_url):
     )
     return response['StackId']
 
-def wait_for_cf_stack(cf_stack_id):
+def wait_for_cf_stack(cf, cf_stack_id):
     print(f"Waiting for CF stack '{cf_stack_id}' to finish creation...")
-    waiter = cf.get_waiter('stack_create_complete')
     try:
-        waiter.wait(
-            StackName=cf_stack_id,
-            WaiterConfig={
-                'Delay': 30,
-                'MaxAttempts': 20
-            }
-        )
+        StackEvents(cf, cf_stack_id).wait(timeout=600)
         print(f"CF stack '{cf_stack_id}' has been created successully")
+        return True
     except Exception as e:
         print(f"Error while waiting: {e}")
+        return False
 
-if __name__ == '__main__':
-    mysql_password = fetch_db_password()
-    dms_cf_stack_id = create_dms_cf_stack(mysql_password, cf_template_url)
+def main(args):
+    cf = clients.get_client('cloudformation', args.region)
+    mysql_password = fetch_db_password(cf, args.stack)
+    with tracing.phase('create-stack', args.stack):
+        dms_cf_stack_id = create_dms_cf_stack(cf, args.stack, mysql_password, args.template)
     if dms_cf_stack_id:
-        wait_for_cf_stack(dms_cf_stack_id)
+        with tracing.phase('wait-for-stack', args.stack):
+            if not wait_for_cf_stack(cf, dms_cf_stack_id):
+                # A stack that rolled back or timed out mustn't let run-all carry on to cf-changes
+                return None
+    return dms_cf_stack_id
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    with tracing.traced(args.trace):
+        main(args)
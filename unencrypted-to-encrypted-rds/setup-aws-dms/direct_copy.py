@@ -0,0 +1,266 @@
+# Usage
+# aws-vault exec <account> -- python3 direct_copy.py --db <cluster>-<stack>-<env> --region <aws-region> [--database <schema>] [--workers 8]
+# python3 direct_copy.py --source-host <host> --target-host <host> [--port 3306] [--target-port <port>] --user <user> --password <password> [--database <schema>]
+#
+# Copies the data of the source straight into its -encrypted copy without DMS. For a small database, standing up
+# the DMS stack takes longer than the copy itself. The tables are read from one consistent snapshot. --workers
+# source connections each start a transaction WITH CONSISTENT SNAPSHOT while the source's tables are held with
+# LOCK TABLES ... READ, which only lasts as long as starting them. --no-lock skips the lock when the app's writes
+# are frozen already. The binlog coordinates of the snapshot are printed, binlog_replication.py --binlog-file and
+# --binlog-position catch the target up from there.
+# Every table is split into primary key chunks of --chunk-rows rows, and the chunks of all the tables are copied
+# --workers at a time, largest tables first. Each chunk is streamed from the source, inserted --batch-rows rows
+# per statement and committed on its own, so nothing is written to disk. Tables without a primary key are
+# copied whole. The target's tables are emptied first, like the DMS full load does.
+# Writes to the source after the snapshot aren't copied, so freeze the app's writes before running it or replicate them.
+# migrate.py run-all uses this instead of DMS for sources under --direct-copy-threshold GiB when it is given --writes-frozen.
+#
+# Needs PyMySQL (pip install pymysql)
+
+import argparse
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import tracing
+from common.databases import database_endpoints, source_endpoint
+from common.mysql import connect, master_status, quote_identifier, stream
+from common.tables import chunk_boundaries, chunk_ranges, list_tables
+from dms_sizing import read_table_sizes
+
+DIRECT_COPY_THRESHOLD_GIB = 5
+
+# What mysqldump sets on the session loading a dump: 0 stays 0 in AUTO_INCREMENT columns and the
+# checks the source already did aren't done again
+TARGET_SESSION = (
+    "SET SESSION sql_mode = 'NO_AUTO_VALUE_ON_ZERO'",
+    "SET SESSION foreign_key_checks = 0",
+    "SET SESSION unique_checks = 0",
+    "SET SESSION time_zone = '+00:00'"
+)
+
+def add_arguments(parser):
+    parser.add_argument('--db', help='source database, cluster-stack-env, the target is <db>-encrypted')
+    parser.add_argument('--region', help='region')
+    parser.add_argument('--source-host', help='source endpoint, instead of the one of --db')
+    parser.add_argument('--target-host', help='target endpoint, instead of the one of <db>-encrypted')
+    parser.add_argument('--port', type=int, default=3306, help='database port')
+    parser.add_argument('--target-port', type=int, help='target port, defaults to --port')
+    parser.add_argument('--user', default='cosmos', help='database user')
+    parser.add_argument('--password', help='database password, instead of the stack output MySQLPassword')
+    parser.add_argument('--database', action='append', help='schema to copy, can be repeated, defaults to all non-system schemas')
+    add_copy_arguments(parser)
+
+def add_copy_arguments(parser):
+    # Shared with migrate.py run-all
+    parser.add_argument('--workers', type=int, default=8, help='number of chunks copied at once')
+    parser.add_argument('--chunk-rows', type=int, default=50000, help='rows per chunk, each chunk is committed on its own')
+    parser.add_argument('--batch-rows', type=int, default=1000, help='rows per INSERT')
+    parser.add_argument('--no-lock', action='store_true', help='don\'t lock the source\'s tables while the snapshot is taken, when writes are frozen already')
+
+parser = argparse.ArgumentParser(description="Copy the source's data straight into the encrypted target, without DMS")
+add_arguments(parser)
+parser.add_argument('--trace', help='write a Chrome trace of the phases and AWS API calls to this file and print a call summary')
+
+class SnapshotReaders:
+    # Source connections in the same consistent snapshot, each one lent to one worker at a time
+    def __init__(self, connections):
+        self.idle = queue.Queue()
+        for connection in connections:
+            self.idle.put(connection)
+
+    @contextmanager
+    def borrow(self):
+        connection = self.idle.get()
+        try:
+            yield connection
+        finally:
+            self.idle.put(connection)
+
+class TableCopy:
+    def __init__(self, spec):
+        self.spec = spec
+        self.ranges = []
+        self.chunks_done = 0
+        self.rows = 0
+        self.error = None
+
+def open_snapshot(coordinator, readers, specs, lock=True):
+    # Starts the readers' transactions at the same point, returns its binlog coordinates, None when binary logging is off
+    with coordinator.cursor() as cursor:
+        if lock:
+            cursor.execute("LOCK TABLES " + ", ".join(f"{spec.name} READ" for spec in specs))
+        try:
+            for reader in readers:
+                with reader.cursor() as reader_cursor:
+                    reader_cursor.execute("SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+                    reader_cursor.execute("SET SESSION time_zone = '+00:00'")
+                    reader_cursor.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT, READ ONLY")
+            coordinates = master_status(coordinator)
+        finally:
+            if lock:
+                cursor.execute("UNLOCK TABLES")
+    return coordinates
+
+def prepare_target(connection, specs):
+    with connection.cursor() as cursor:
+        for statement in TARGET_SESSION:
+            cursor.execute(statement)
+        for spec in specs:
+            cursor.execute(f"TRUNCATE TABLE {spec.name}")
+
+def copy_chunk(reader, writer, spec, low, high, batch_rows):
+    columns = ", ".join(quote_identifier(column) for column in spec.stored_columns())
+    condition, params = spec.range_condition(low, high)
+    order = f" ORDER BY {', '.join(quote_identifier(column) for column in spec.key_columns)}" if spec.key_columns else ""
+    insert = f"INSERT INTO {spec.name} ({columns}) VALUES ({', '.join(['%s'] * len(spec.stored_columns()))})"
+    copied = 0
+    try:
+        with writer.cursor() as cursor:
+            # In key order, so the target's primary key index is appended to
+            for rows in stream(reader, f"SELECT {columns} FROM {spec.name} WHERE {condition}{order}", params, batch_rows):
+                cursor.executemany(insert, rows)
+                copied += len(rows)
+        writer.commit()
+    except Exception:
+        writer.rollback()
+        raise
+    return copied
+
+def direct_copy(source_host, target_host, user, password, port=3306, target_port=None, databases=None, workers=8, chunk_rows=50000, batch_rows=1000, lock=True):
+    print(f"### Copying '{source_host}' to '{target_host}'...")
+    start = time.monotonic()
+    coordinator = connect(source_host, user, password, port)
+    target = connect(target_host, user, password, target_port or port)
+    readers = []
+    writers = []
+    writers_lock = threading.Lock()
+    local = threading.local()
+
+    def writer():
+        # One target connection per worker thread, PyMySQL connections can't be shared
+        if not hasattr(local, 'connection'):
+            local.connection = connect(target_host, user, password, target_port or port)
+            with local.connection.cursor() as cursor:
+                for statement in TARGET_SESSION:
+                    cursor.execute(statement)
+            with writers_lock:
+                writers.append(local.connection)
+        return local.connection
+
+    def boundaries(spec):
+        with snapshot.borrow() as reader:
+            return chunk_boundaries(reader, spec, chunk_rows)
+
+    def copy(table, low, high):
+        with snapshot.borrow() as reader:
+            return copy_chunk(reader, writer(), table.spec, low, high, batch_rows)
+
+    try:
+        specs = list_tables(coordinator, databases)
+        target_tables = {(spec.schema, spec.table) for spec in list_tables(target, databases)}
+        missing = [spec.name for spec in specs if (spec.schema, spec.table) not in target_tables]
+        if missing:
+            print(f"Tables missing from the target: {', '.join(missing)}")
+            return False
+        if not specs:
+            print("Nothing to copy")
+            return True
+
+        with tracing.phase('empty-target'):
+            prepare_target(target, specs)
+
+        readers = [connect(source_host, user, password, port) for _ in range(workers)]
+        coordinates = open_snapshot(coordinator, readers, specs, lock)
+        snapshot = SnapshotReaders(readers)
+        if coordinates:
+            print(f"Snapshot taken at {coordinates['File']}:{coordinates['Position']}")
+
+        tables = [TableCopy(spec) for spec in specs]
+        with tracing.phase('copy-data'), ThreadPoolExecutor(max_workers=workers) as executor:
+            # Boundaries are read from the snapshot too, so the chunks cover exactly what is copied
+            futures = {executor.submit(boundaries, table.spec): table for table in tables}
+            for future in as_completed(futures):
+                table = futures[future]
+                try:
+                    table.ranges = chunk_ranges(future.result())
+                except Exception as e:
+                    table.error = str(e)
+
+            # Largest tables first so they aren't left running on their own at the end
+            chunks = [(table, low, high) for table in tables for low, high in table.ranges]
+            futures = {executor.submit(copy, *chunk): chunk[0] for chunk in chunks}
+            done = 0
+            for future in as_completed(futures):
+                table = futures[future]
+                try:
+                    table.rows += future.result()
+                except Exception as e:
+                    table.error = table.error or str(e)
+                table.chunks_done += 1
+                if table.chunks_done == len(table.ranges):
+                    done += 1
+                    if table.error:
+                        print(f"[{done}/{len(tables)}] Error copying {table.spec.schema}.{table.spec.table}: {table.error}")
+                    else:
+                        print(f"[{done}/{len(tables)}] {table.spec.schema}.{table.spec.table}: {table.rows} rows")
+    finally:
+        for connection in [coordinator, target] + readers + writers:
+            connection.close()
+
+    failed = [table for table in tables if table.error]
+    for table in failed:
+        if not table.ranges:
+            print(f"Error splitting {table.spec.schema}.{table.spec.table}: {table.error}")
+    elapsed = time.monotonic() - start
+    rows = sum(table.rows for table in tables)
+    print(f"Copy finished in {elapsed:.1f}s, {rows} rows ({rows / max(elapsed, 0.001):.0f}/s), {len(tables) - len(failed)} of {len(tables)} tables copied\n")
+    return not failed
+
+def source_size(host, user, password, port=3306, databases=None):
+    connection = connect(host, user, password, port)
+    try:
+        return sum(table['bytes'] for table in read_table_sizes(connection, databases))
+    finally:
+        connection.close()
+
+def choose_copy_mode(region, db, user, threshold_gib=DIRECT_COPY_THRESHOLD_GIB, writes_frozen=False):
+    # 'direct' for sources under threshold_gib whose writes are frozen, 'dms' otherwise or when the source can't
+    # be read from here. Nothing catches the target up after a direct copy, so it is never picked for a source
+    # that is still being written to
+    if not writes_frozen:
+        print(f"Copying '{db}' with DMS, writes aren't frozen so direct copy would lose the ones made after its snapshot")
+        return 'dms'
+    source_host, password = source_endpoint(region, db)
+    try:
+        size = source_size(source_host, user, password)
+    except Exception as e:
+        print(f"Couldn't read the size of '{db}', copying with DMS: {e}")
+        return 'dms'
+    mode = 'direct' if size < threshold_gib * 1024 ** 3 else 'dms'
+    print(f"'{db}' holds {size / 1024 ** 3:.1f} GiB, copying {'directly' if mode == 'direct' else 'with DMS'} (threshold {threshold_gib} GiB)")
+    return mode
+
+def copy_to_encrypted(region, db, user, password=None, databases=None, workers=8, chunk_rows=50000, batch_rows=1000, lock=True):
+    source_host, target_host, password = database_endpoints(region, db, password=password)
+    with tracing.phase('direct-copy', db):
+        return direct_copy(source_host, target_host, user, password, databases=databases, workers=workers,
+                           chunk_rows=chunk_rows, batch_rows=batch_rows, lock=lock)
+
+def main(args):
+    source_host, target_host, password = database_endpoints(args.region, args.db, args.source_host, args.target_host, args.password)
+    with tracing.phase('direct-copy', args.db):
+        return direct_copy(source_host, target_host, args.user, password, args.port, args.target_port, args.database,
+                           args.workers, args.chunk_rows, args.batch_rows, not args.no_lock)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    with tracing.traced(args.trace):
+        if not main(args):
+            sys.exit(1)
@@ -0,0 +1,182 @@
+# Usage
+# python3 dms_sizing.py --host <endpoint> --user <user> --password <password> [--port 3306] [--database <schema>] [--instance-class <db-class>] [--table-mappings <file.json>]
+#
+# Sizes the DMS data migration from the source's schema instead of using the same NumberOfJobs for every
+# database. Table sizes and row counts come from information_schema. Tables bigger than SEGMENT_BYTES are
+# split into segments, one per SEGMENT_BYTES up to MAX_SEGMENTS, and every segment and every smaller table
+# is a unit of work. NumberOfJobs is the number of units, capped by the instance class's vCPUs and
+# MAX_NUMBER_OF_JOBS so the source isn't overloaded while serving traffic.
+# The selection rules include every non-system schema. The table mappings add parallel-load ranges for
+# the segmented tables that have a single integer primary key, split evenly between its MIN and MAX. They are
+# only written to --table-mappings, the homogeneous data migration of the DMS template takes selection rules
+# only, so the file is applied by hand, e.g. to a classic DMS replication task.
+# generate_dms_cf_template.py --size-from-schema uses this, run it on its own against a local MySQL
+# to see what it would generate, see the README.
+#
+# Needs PyMySQL (pip install pymysql)
+
+import argparse
+import json
+import math
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.mysql import connect, schema_filter
+from common.tables import list_tables, split_integer_key
+
+# What the DMS template used before it was sized, used when the schema can't be read
+DEFAULT_NUMBER_OF_JOBS = 8
+MAX_NUMBER_OF_JOBS = 32
+JOBS_PER_VCPU = 2
+
+SEGMENT_BYTES = 10 * 1024 ** 3
+MAX_SEGMENTS = 16
+
+# vCPUs of the RDS instance sizes, "<n>xlarge" sizes have 4 * n
+SIZE_VCPUS = {
+    'micro': 2,
+    'small': 2,
+    'medium': 2,
+    'large': 2,
+    'xlarge': 4
+}
+
+parser = argparse.ArgumentParser(description="Size the DMS data migration from the source's schema")
+parser.add_argument('--host', required=True, help='database endpoint')
+parser.add_argument('--port', type=int, default=3306, help='database port')
+parser.add_argument('--user', required=True, help='database user')
+parser.add_argument('--password', required=True, help='database password')
+parser.add_argument('--database', action='append', help='schema to migrate, can be repeated, defaults to all non-system schemas')
+parser.add_argument('--instance-class', help='class of the source instance, caps the number of jobs')
+parser.add_argument('--table-mappings', help='write the DMS table mappings with parallel-load ranges to this file, to apply by hand')
+
+class DmsSizing:
+    def __init__(self, tables, segments, number_of_jobs, boundaries):
+        self.tables = tables
+        self.segments = segments
+        self.number_of_jobs = number_of_jobs
+        self.boundaries = boundaries
+
+    def selection_rules(self):
+        schemas = sorted({table['schema'] for table in self.tables})
+        return {
+            'rules': [
+                {
+                    'rule-type': 'selection',
+                    'rule-id': str(i),
+                    'rule-name': str(i),
+                    'object-locator': {'schema-name': schema, 'table-name': '%'},
+                    'rule-action': 'include'
+                }
+                for i, schema in enumerate(schemas, 1)
+            ]
+        }
+
+    def table_mappings(self):
+        rules = self.selection_rules()['rules']
+        for (schema, table), (column, boundaries) in self.boundaries.items():
+            rule_id = str(len(rules) + 1)
+            rules.append({
+                'rule-type': 'table-settings',
+                'rule-id': rule_id,
+                'rule-name': rule_id,
+                'object-locator': {'schema-name': schema, 'table-name': table},
+                'parallel-load': {
+                    'type': 'ranges',
+                    'columns': [column],
+                    'boundaries': [[str(boundary)] for boundary in boundaries]
+                }
+            })
+        return {'rules': rules}
+
+def instance_vcpus(instance_class):
+    # None when the class isn't known, e.g. db.r5.2xlarge has 8
+    if not instance_class:
+        return None
+    size = instance_class.rsplit('.', 1)[-1]
+    if size in SIZE_VCPUS:
+        return SIZE_VCPUS[size]
+    if size.endswith('xlarge') and size[:-len('xlarge')].isdigit():
+        return 4 * int(size[:-len('xlarge')])
+    return None
+
+def read_table_sizes(connection, databases=None):
+    # Largest first, information_schema's figures are estimates but good enough to size the migration
+    condition, params = schema_filter(databases)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT TABLE_SCHEMA, TABLE_NAME, COALESCE(DATA_LENGTH, 0) + COALESCE(INDEX_LENGTH, 0), COALESCE(TABLE_ROWS, 0) "
+            "FROM information_schema.TABLES "
+            f"WHERE TABLE_TYPE = 'BASE TABLE' AND TABLE_SCHEMA {condition} "
+            "ORDER BY 3 DESC, TABLE_SCHEMA, TABLE_NAME",
+            params
+        )
+        return [
+            {'schema': schema, 'table': table, 'bytes': int(size), 'rows': int(rows)}
+            for schema, table, size, rows in cursor.fetchall()
+        ]
+
+def plan_segments(tables, segment_bytes=SEGMENT_BYTES, max_segments=MAX_SEGMENTS):
+    return {
+        (table['schema'], table['table']): min(max_segments, math.ceil(table['bytes'] / segment_bytes))
+        for table in tables
+        if table['bytes'] > segment_bytes
+    }
+
+def number_of_jobs(tables, segments, vcpus=None):
+    work_units = len(tables) - len(segments) + sum(segments.values())
+    limit = min(MAX_NUMBER_OF_JOBS, vcpus * JOBS_PER_VCPU) if vcpus else MAX_NUMBER_OF_JOBS
+    return max(1, min(work_units, limit))
+
+def read_range_boundaries(connection, spec, segments):
+    # (column, boundaries) splitting the table evenly on its primary key, None when it hasn't got a single integer one
+    if not spec.has_integer_key():
+        return None
+    boundaries = split_integer_key(connection, spec, segments)
+    if not boundaries:
+        return None
+    return spec.key_columns[0], boundaries
+
+def size_migration(connection, instance_class=None, databases=None):
+    tables = read_table_sizes(connection, databases)
+    segments = plan_segments(tables)
+    boundaries = {}
+    specs = {(spec.schema, spec.table): spec for spec in list_tables(connection, databases)} if segments else {}
+    for key, count in segments.items():
+        table_boundaries = read_range_boundaries(connection, specs[key], count) if key in specs else None
+        if table_boundaries:
+            boundaries[key] = table_boundaries
+    return DmsSizing(tables, segments, number_of_jobs(tables, segments, instance_vcpus(instance_class)), boundaries)
+
+def size_from_database(host, user, password, port=3306, instance_class=None, databases=None):
+    connection = connect(host, user, password, port)
+    try:
+        return size_migration(connection, instance_class, databases)
+    finally:
+        connection.close()
+
+def print_sizing(sizing, limit=10):
+    total_bytes = sum(table['bytes'] for table in sizing.tables)
+    print(f"{len(sizing.tables)} tables, {total_bytes / 1024 ** 3:.1f} GiB, NumberOfJobs {sizing.number_of_jobs}")
+    for table in sizing.tables[:limit]:
+        key = (table['schema'], table['table'])
+        line = f"  {table['schema']}.{table['table']}: {table['bytes'] / 1024 ** 3:.1f} GiB, ~{table['rows']} rows"
+        if key in sizing.segments:
+            line += f", {sizing.segments[key]} segments"
+            if key not in sizing.boundaries:
+                line += " (no single integer primary key, loaded whole)"
+        print(line)
+
+def write_table_mappings(sizing, path):
+    with open(path, 'w') as f:
+        json.dump(sizing.table_mappings(), f, indent=2)
+    print(f"Table mappings written to '{path}'")
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    sizing = size_from_database(args.host, args.user, args.password, args.port, args.instance_class, args.database)
+    print_sizing(sizing)
+    if args.table_mappings:
+        write_table_mappings(sizing, args.table_mappings)
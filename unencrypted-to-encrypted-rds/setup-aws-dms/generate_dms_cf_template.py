@@ -1,25 +1,41 @@
 # Usage
-# aws-vault exec <account> -- python3 generate_dms_cf_template.py --db <cluster>-<stack>-<env> --bucket <s3-bucket> --region <aws-region>
+# aws-vault exec <account> -- python3 generate_dms_cf_template.py --db <cluster>-<stack>-<env> --bucket <s3-bucket> --region <aws-region> [--trace <file.json>]
+#
+# With --size-from-schema the source's table sizes are read to work out NumberOfJobs and the selection rules
+# (see dms_sizing.py), it needs PyMySQL and network access to the source. --table-mappings <file.json> also
+# writes the table mappings with parallel-load ranges for the largest tables. The data migration only takes
+# selection rules, so the ranges stay out of the template and the file has to be applied by hand
 
-import boto3
 import json
 import argparse
 import os
+import sys
 
-parser = argparse.ArgumentParser(description="Generate Cloudformation template for DMS")
-parser.add_argument('--db', required=True, help='environment, cluster-stack-env')
-parser.add_argument('--bucket', required=True, help='S3 bucket to store the DMS CF templates')
-parser.add_argument('--region', required=True, help='region')
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import clients, tracing
+from common.inventory import get_inventory
+from common.stacks import stack_cache
+from dms_sizing import DEFAULT_NUMBER_OF_JOBS, print_sizing, size_from_database, write_table_mappings
 
-args = parser.parse_args()
+def add_arguments(parser):
+    parser.add_argument('--db', required=True, help='environment, cluster-stack-env')
+    parser.add_argument('--bucket', required=True, help='S3 bucket to store the DMS CF templates')
+    parser.add_argument('--region', required=True, help='region')
+    parser.add_argument('--db-user', default='cosmos', help='database user for --size-from-schema, the password is read from the stack output MySQLPassword')
+    add_sizing_arguments(parser)
 
-source_db = args.db
-s3_bucket = args.bucket
-aws_region = args.region
+def add_sizing_arguments(parser):
+    # Shared with migrate.py run-all
+    parser.add_argument('--size-from-schema', action='store_true', help='size NumberOfJobs and the selection rules from the source\'s tables (needs PyMySQL)')
+    parser.add_argument('--table-mappings', help='with --size-from-schema, also write the DMS table mappings with parallel-load ranges to this file, to apply by hand')
 
-target_db = f"{args.db}-encrypted"
+parser = argparse.ArgumentParser(description="Generate Cloudformation template for DMS")
+add_arguments(parser)
+parser.add_argument('--trace', help='write a Chrome trace of the AWS API calls to this file and print a call summary')
 
-def generate_dms_template():
+def generate_dms_template(source_db, source_db_endpoint, target_db_endpoint, subnet_ids, default_vpc_sg, dms_iam_role, sizing=None):
+    target_db = f"{source_db}-encrypted"
 
     template = {
         "AWSTemplateFormatVersion": "2010-09-09",
@@ -138,7 +154,7 @@ def generate_dms_template():
                     "DataMigrationName" : f"{source_db}-data-migration",
                     "DataMigrationSettings" : {
                         "CloudwatchLogsEnabled" : True,
-                        "NumberOfJobs" : 8
+                        "NumberOfJobs" : sizing.number_of_jobs if sizing else DEFAULT_NUMBER_OF_JOBS
                         },
                     "DataMigrationType" : "full-load-and-cdc",
                     "MigrationProjectIdentifier" : {"Ref": "MigrationProject"},
@@ -148,14 +164,15 @@ def generate_dms_template():
         },
     }
 
+    if sizing:
+        template['Resources']['DataMigration']['Properties']['DataMigrationSettings']['SelectionRules'] = json.dumps(sizing.selection_rules())
+
     with open(f"{source_db}-dms-migration-template.json", "w") as f:
         json.dump(template, f, indent=2)
     print(f"CloudFormation template written to '{source_db}-dms-migration-template.json'.")
     return f"{source_db}-dms-migration-template.json"
 
-def get_default_security_group(vpc_id, region_name):
-    ec2 = boto3.client('ec2', region_name=region_name)
-
+def get_default_security_group(ec2, vpc_id):
     try:
         response = ec2.describe_security_groups(
             Filters=[
@@ -175,8 +192,7 @@ def get_default_security_group(vpc_id, region_name):
         print(f"Error fetching security group: {e}")
         return None
     
-def get_dms_iam_role_arn():
-    iam = boto3.client('iam')
+def get_dms_iam_role_arn(iam):
     try:
         response = iam.get_role(RoleName="HomogeneousDataMigrationsRole")
         arn = response['Role']['Arn']
@@ -185,11 +201,12 @@ def get_dms_iam_role_arn():
         print(f"Error retrieving role ARN: {e}")
         return None
 
-def gather_env_data(db):
-    rds = boto3.client('rds', region_name=aws_region)
+def gather_env_data(inventory, db):
     try:
-        response = rds.describe_db_instances(DBInstanceIdentifier=db)
-        instance = response['DBInstances'][0]
+        instance = inventory.get(db)
+        if instance is None:
+            print(f"Error describing DB instance: '{db}' not found")
+            return None
 
         info = {
             'Endpoint':instance['Endpoint']['Address'],
@@ -202,26 +219,71 @@ def gather_env_data(db):
     except Exception as e:
         print(f"Error describing DB instance: {e}")
 
-def upload_template_to_s3(template_path, bucket_name, key_prefix="dms-cf-templates"):
-    s3 = boto3.client('s3', region_name=aws_region)
+def upload_template_to_s3(s3, template_path, bucket_name, key_prefix="dms-cf-templates"):
     key = f"{key_prefix}/{template_path}"
     s3.upload_file(template_path, bucket_name, key)
     url = f"https://{bucket_name}.s3.amazonaws.com/{key}"
     return url
 
-if __name__ == "__main__":
-    source_rds_info = gather_env_data(source_db)
-    target_rds_info = gather_env_data(target_db)
-    subnet_ids = source_rds_info['DBSubnets']
-    vpc_id = source_rds_info['VPC']
-    default_vpc_sg = get_default_security_group(vpc_id, aws_region)
-    source_db_endpoint = source_rds_info['Endpoint']
-    target_db_endpoint = target_rds_info['Endpoint']
-    dms_iam_role = get_dms_iam_role_arn()
-
-    template_file = generate_dms_template()
-
-    cf_template_url = upload_template_to_s3(template_file, s3_bucket)
+def predict_endpoint(source_db_endpoint, db_instance_id):
+    # RDS endpoints are <identifier>.<account/region hash>.<region>.rds.amazonaws.com, so the endpoint
+    # of an instance that hasn't been restored yet can be worked out from any instance next to it
+    return f"{db_instance_id}.{source_db_endpoint.split('.', 1)[1]}"
+
+def size_source(inventory, cf, db, db_user):
+    # None when the source can't be read from here, the template then gets the default NumberOfJobs
+    try:
+        instance = inventory.get(db)
+        password = stack_cache(cf).get_output(db, "MySQLPassword")
+        sizing = size_from_database(instance['Endpoint']['Address'], db_user, password, instance_class=instance['DBInstanceClass'])
+    except Exception as e:
+        print(f"Couldn't read the table sizes of '{db}', using NumberOfJobs {DEFAULT_NUMBER_OF_JOBS}: {e}")
+        return None
+    print_sizing(sizing)
+    return sizing
+
+def prepare_dms_template(inventory, ec2, iam, s3, source_db, bucket, target_exists=True, sizing=None):
+    # Gathers everything the DMS template needs, writes it, uploads it and returns the template URL.
+    # With target_exists=False the target endpoint is predicted, so this can run before the restore
+    source_rds_info = gather_env_data(inventory, source_db)
+    if not source_rds_info:
+        return None
+    if target_exists:
+        target_rds_info = gather_env_data(inventory, f"{source_db}-encrypted")
+        if not target_rds_info:
+            return None
+        target_db_endpoint = target_rds_info['Endpoint']
+    else:
+        target_db_endpoint = predict_endpoint(source_rds_info['Endpoint'], f"{source_db}-encrypted")
+
+    default_vpc_sg = get_default_security_group(ec2, source_rds_info['VPC'])
+    dms_iam_role = get_dms_iam_role_arn(iam)
+
+    template_file = generate_dms_template(source_db, source_rds_info['Endpoint'], target_db_endpoint, source_rds_info['DBSubnets'], default_vpc_sg, dms_iam_role, sizing)
+
+    cf_template_url = upload_template_to_s3(s3, template_file, bucket)
     if cf_template_url:
         print(f"The Cloudformation template has been uploaded to {cf_template_url}")
-    os.remove(template_file)
\ No newline at end of file
+    os.remove(template_file)
+    return cf_template_url
+
+def main(args):
+    inventory = get_inventory(args.region)
+    ec2 = clients.get_client('ec2', args.region)
+    iam = clients.get_client('iam')
+    s3 = clients.get_client('s3', args.region)
+
+    sizing = None
+    if args.size_from_schema:
+        with tracing.phase('size-dms-migration', args.db):
+            sizing = size_source(inventory, clients.get_client('cloudformation', args.region), args.db, args.db_user)
+        if sizing and args.table_mappings:
+            write_table_mappings(sizing, args.table_mappings)
+
+    with tracing.phase('prepare-dms-template', args.db):
+        return prepare_dms_template(inventory, ec2, iam, s3, args.db, args.bucket, sizing=sizing)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    with tracing.traced(args.trace):
+        main(args)
@@ -1,16 +1,18 @@
 # Usage
 # aws-vault exec <account> -- python3 create_iam_role_and_policy.py
 
-import boto3
 import json
-from botocore.exceptions import ClientError
+import os
+import sys
 
-iam = boto3.client('iam')
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import clients
 
 # https://docs.aws.amazon.com/dms/latest/userguide/dm-iam-resources.html
 
 # Create the IAM policy
-def create_iam_policy(policy_document):
+def create_iam_policy(iam, policy_document):
     try:
         response = iam.create_policy(
             PolicyName="HomogeneousDataMigrationsPolicy",
@@ -20,11 +22,11 @@ def create_iam_policy(policy_document):
         return response
     except iam.exceptions.EntityAlreadyExistsException as e:
         print("The IAM policy already exists")
-    except ClientError as e:
+    except iam.exceptions.ClientError as e:
           print(f"Failed to create policy: {e}")
     
 # Create the IAM role
-def create_iam_role(assumed_role_policy_document):
+def create_iam_role(iam, assumed_role_policy_document):
     try:
         response = iam.create_role(
             RoleName='HomogeneousDataMigrationsRole',
@@ -35,20 +37,22 @@ def create_iam_role(assumed_role_policy_document):
         return response
     except iam.exceptions.EntityAlreadyExistsException as e:
         print("The IAM Role already exists")
-    except ClientError as e:
+    except iam.exceptions.ClientError as e:
           print(f"Failed to create policy: {e}")
 
 # Attach policy to role
-def attach_policy_to_iam_role(iam_policy_arn):
+def attach_policy_to_iam_role(iam, iam_policy_arn):
     try:
         iam.attach_role_policy(
             RoleName='HomogeneousDataMigrationsRole',
             PolicyArn=iam_policy_arn
         )  
-    except ClientError as e:
+    except iam.exceptions.ClientError as e:
         print(f"Failed to attach policy: {e}")  
 
-if __name__ == "__main__":
+def main(args=None):
+    iam = clients.get_client('iam')
+
     iam_policy_document = {
     "Version": "2012-10-17",
     "Statement": [
@@ -165,7 +169,7 @@ if __name__ == "__main__":
 }
     
     
-    dms_iam_policy = create_iam_policy(iam_policy_document)
+    dms_iam_policy = create_iam_policy(iam, iam_policy_document)
     if dms_iam_policy != None:
         print(f"Created IAM policy {dms_iam_policy['Policy']['PolicyName']}")
         dms_iam_policy_arn = dms_iam_policy['Policy']['Arn']
@@ -179,12 +183,15 @@ if __name__ == "__main__":
                         
     managed_policy_arn = "arn:aws:iam::aws:policy/SecretsManagerReadWrite"
     
-    dms_iam_role = create_iam_role(assumed_role_policy_document)
+    dms_iam_role = create_iam_role(iam, assumed_role_policy_document)
     if dms_iam_role != None:
-        attach_policy_to_iam_role(dms_iam_policy_arn)
-        attach_policy_to_iam_role(managed_policy_arn)
+        attach_policy_to_iam_role(iam, dms_iam_policy_arn)
+        attach_policy_to_iam_role(iam, managed_policy_arn)
         print(f"Created IAM Role {dms_iam_role['Role']['RoleName']} with required policies")
     else:
-        attach_policy_to_iam_role(dms_iam_policy_arn)
-        attach_policy_to_iam_role(managed_policy_arn)
-        print(f"Attached required policies to role HomogeneousDataMigrationsRole")
\ No newline at end of file
+        attach_policy_to_iam_role(iam, dms_iam_policy_arn)
+        attach_policy_to_iam_role(iam, managed_policy_arn)
+        print(f"Attached required policies to role HomogeneousDataMigrationsRole")
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
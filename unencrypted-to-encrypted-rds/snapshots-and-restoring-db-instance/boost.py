@@ -0,0 +1,114 @@
+# Temporary "boost" shape for the restored -encrypted instance
+#
+# The restore and the DMS full load are the heavy phases of a migration, so the new instance can be
+# restored onto a bigger class and gp3 storage with raised IOPS/throughput, then put back to the
+# source's shape once CDC has caught up. cdc_cutover.py does that once the cutover reaches zero lag,
+# create_encrypted_rds.py --scale-back does it on its own.
+
+import time
+
+# gp3 on RDS MySQL only allows IOPS/throughput above the baseline from 400 GiB upwards
+GP3_PROVISIONED_MIN_STORAGE = 400
+GP3_BASELINE_IOPS = 3000
+GP3_BASELINE_THROUGHPUT = 125
+
+# Storage modifications are refused for 6 hours after the last one
+STORAGE_RETRY_INTERVAL = 1800
+STORAGE_RETRY_TIMEOUT = 7 * 3600
+
+def boost_profile(rds_info, instance_class, iops=None, throughput=None):
+    # Restore parameters overriding the source's shape
+    profile = {
+        'DBInstanceClass': instance_class,
+        'StorageType': 'gp3'
+    }
+    if rds_info['AllocatedStorage (GB)'] >= GP3_PROVISIONED_MIN_STORAGE:
+        if iops:
+            profile['Iops'] = max(iops, GP3_BASELINE_IOPS)
+        if throughput:
+            profile['StorageThroughput'] = max(throughput, GP3_BASELINE_THROUGHPUT)
+    elif iops or throughput:
+        print(f"Storage is below {GP3_PROVISIONED_MIN_STORAGE} GiB, gp3 stays at its baseline of {GP3_BASELINE_IOPS} IOPS / {GP3_BASELINE_THROUGHPUT} MiBps")
+    return profile
+
+def source_shape(rds_info, allocated_storage):
+    # The modify parameters putting an instance of allocated_storage GiB back on the source's shape. io1/io2 always
+    # take their IOPS, gp3 only above GP3_PROVISIONED_MIN_STORAGE and gp2 never
+    shape = {
+        'DBInstanceClass': rds_info['DBInstanceClass'],
+        'StorageType': rds_info['StorageType']
+    }
+    provisioned = rds_info['StorageType'] in ('io1', 'io2') or (rds_info['StorageType'] == 'gp3' and allocated_storage >= GP3_PROVISIONED_MIN_STORAGE)
+    if provisioned and rds_info.get('Iops'):
+        shape['Iops'] = rds_info['Iops']
+    if provisioned and rds_info['StorageType'] == 'gp3' and rds_info.get('StorageThroughput'):
+        shape['StorageThroughput'] = rds_info['StorageThroughput']
+    return shape
+
+def is_storage_lock_error(error):
+    # A storage change is refused within 6 hours of the last one, or while its optimization is still running
+    message = str(error).lower()
+    return 'storage' in message and ('6 hours' in message or 'six hours' in message or 'optimiz' in message)
+
+def modify_instance(rds, db_instance_id, modify_params):
+    rds.modify_db_instance(
+        DBInstanceIdentifier=db_instance_id,
+        ApplyImmediately=True,
+        **modify_params
+    )
+
+def scale_back(rds, poller, db_instance_id, rds_info, storage_retry_interval=STORAGE_RETRY_INTERVAL, storage_retry_timeout=STORAGE_RETRY_TIMEOUT):
+    # Puts the instance back on the source's class, storage type, IOPS and throughput. Allocated storage can't
+    # shrink. The storage is refused within 6 hours of the last storage modification, e.g. the restore or the
+    # boost, so the class goes back straight away and the storage is retried every storage_retry_interval
+    # seconds until storage_retry_timeout
+    try:
+        response = rds.describe_db_instances(DBInstanceIdentifier=db_instance_id)
+        instance = response['DBInstances'][0]
+    except Exception as e:
+        print(f"Error describing DB instance: {e}")
+        return None
+
+    shape = source_shape(rds_info, instance['AllocatedStorage'])
+    class_params = {}
+    if instance['DBInstanceClass'] != shape['DBInstanceClass']:
+        class_params['DBInstanceClass'] = shape['DBInstanceClass']
+    storage_params = {}
+    if any(instance.get(name) != value for name, value in shape.items() if name != 'DBInstanceClass'):
+        # Sent together, e.g. moving to io1 needs its IOPS in the same call
+        storage_params = {name: value for name, value in shape.items() if name != 'DBInstanceClass'}
+    if not class_params and not storage_params:
+        print(f"DB instance '{db_instance_id}' already has the source's shape")
+        return True
+
+    print(f"### Scaling '{db_instance_id}' back to {shape}...")
+    started = time.monotonic()
+    while True:
+        try:
+            modify_instance(rds, db_instance_id, {**class_params, **storage_params})
+            break
+        except Exception as e:
+            if not storage_params or not is_storage_lock_error(e):
+                print(f"Error scaling back DB instance: {e}")
+                return None
+            if time.monotonic() - started + storage_retry_interval > storage_retry_timeout:
+                print(f"Storage of '{db_instance_id}' is still locked after {storage_retry_timeout / 3600:.1f} hours, rerun with --scale-back later: {e}")
+                return None
+        if class_params:
+            # The class doesn't have to wait for the storage
+            try:
+                modify_instance(rds, db_instance_id, class_params)
+            except Exception as e:
+                print(f"Error scaling back DB instance: {e}")
+                return None
+            if not poller.wait_for_db_instance(db_instance_id):
+                print(f"Error while waiting: DB instance '{db_instance_id}' did not become available")
+                return None
+            class_params = {}
+        print(f"Storage of '{db_instance_id}' was modified less than 6 hours ago, retrying in {storage_retry_interval / 60:.0f} minutes")
+        time.sleep(storage_retry_interval)
+
+    if poller.wait_for_db_instance(db_instance_id):
+        print(f"DB instance '{db_instance_id}' has been scaled back.\n")
+        return True
+    print(f"Error while waiting: DB instance '{db_instance_id}' did not become available")
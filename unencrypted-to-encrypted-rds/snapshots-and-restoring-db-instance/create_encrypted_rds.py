@@ -1,20 +1,80 @@
 # Usage
 # aws-vault exec <account> -- python3 create_encrypted_rds.py --db <cluster>-<stack>-<env> --region <aws-region>
+# aws-vault exec <account> -- python3 create_encrypted_rds.py --fleet <fleet-file> [--region <default-region>] [--max-workers 10]
+#
+# The fleet file lists one instance per line as "<cluster>-<stack>-<env> [<aws-region>]", lines starting with # are ignored
+#
+# With --pipeline-bucket <s3-bucket> the KMS/instance lookups, the CF template backup (cf_changes.py) and the
+# DMS template (generate_dms_cf_template.py) are done while the snapshot is in flight
+#
+# With --max-automated-snapshot-age <hours> the newest automated snapshot is copied directly when it is recent
+# enough, which skips the manual snapshot. Only use it when DMS CDC will catch the target up afterwards
+#
+# With --warm-up every table and index of the restored instance is read once it is available (see warm_up.py)
+#
+# With --boost-class <class> [--boost-iops N --boost-throughput N] the new instance is restored onto a bigger class
+# and gp3 storage for the restore and DMS full load. cdc_cutover.py puts it back on the source's class, storage
+# type, IOPS and throughput once the cutover reaches zero lag, or rerun with --scale-back to do it yourself
+#
+# Phase durations are appended to --history-file (default .migration-history.jsonl) and used to print a per-phase
+# and total ETA before each migration starts, to time the status checks and to warn about phases running late
+#
+# With --trace <file.json> the phases and every AWS API call are written out as a Chrome trace, and a summary of
+# call counts, retries, throttling and latency percentiles is printed at the end
+#
+# Progress is checkpointed under --state-dir (default .migration-state), rerunning the same command resumes
+# from the first phase that didn't complete. Remove the instance's state file to start from scratch.
 
-import boto3
 import argparse
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from datetime import datetime, timedelta, timezone
 
-parser = argparse.ArgumentParser(description="Create encrypted database")
-parser.add_argument('--db', required=True, help='database')
-parser.add_argument('--region', required=True, help='region')
+SCRIPTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(SCRIPTS_DIR)
+
+from common import clients, tracing
+from common.fleet import read_fleet_file
+from common.inventory import get_inventory
+from boost import boost_profile, scale_back
+from duration_history import DEFAULT_HISTORY_FILE, PREDICTED_PHASES, load_history, predict, print_prediction, record_phase
+from fleet_scheduler import PHASE_QUOTA_USAGE, FleetScheduler, print_fleet_summary
+from migration_state import DEFAULT_STATE_DIR, PHASES, MigrationState
+from status_poller import get_status_poller
+from warm_up import get_stack_password, warm_up
 
-args = parser.parse_args()
-db_instance_id = args.db
-aws_region = args.region
+def add_migration_arguments(parser):
+    # Options of a single migration, shared with migrate.py run-all
+    parser.add_argument('--pipeline-bucket', help='S3 bucket for the CF/DMS templates, backs up the CF template and prepares the DMS template while the snapshot runs')
+    parser.add_argument('--max-automated-snapshot-age', type=float, help='copy from the newest automated snapshot if it is at most this many hours old, instead of taking a manual snapshot')
+    parser.add_argument('--warm-up', action='store_true', help='read every table and index of the restored instance to pull its blocks in from S3 (needs PyMySQL)')
+    parser.add_argument('--warm-up-concurrency', type=int, default=8, help='number of tables/indexes read at once during the warm-up')
+    parser.add_argument('--db-user', default='cosmos', help='database user for the warm-up, the password is read from the stack output MySQLPassword')
+    parser.add_argument('--boost-class', help='restore onto this instance class and gp3 storage for the restore and DMS full load')
+    parser.add_argument('--boost-iops', type=int, help='gp3 IOPS for the boosted instance (400 GiB and up)')
+    parser.add_argument('--boost-throughput', type=int, help='gp3 throughput in MiBps for the boosted instance (400 GiB and up)')
+    parser.add_argument('--history-file', default=DEFAULT_HISTORY_FILE, help='phase duration history used to predict how long a migration will take')
+    parser.add_argument('--state-dir', default=DEFAULT_STATE_DIR, help='directory holding the per-migration checkpoint files')
 
-rds = boto3.client('rds', region_name=aws_region)
+def add_arguments(parser):
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--db', help='database')
+    target.add_argument('--fleet', help='file listing the databases to convert, one "<db> [<region>]" per line')
+    parser.add_argument('--region', help='region, default region for fleet entries without one')
+    parser.add_argument('--max-workers', type=int, default=10, help='number of migrations to run at once in fleet mode')
+    parser.add_argument('--max-snapshots', type=int, default=5, help='concurrent manual snapshots per region in fleet mode')
+    parser.add_argument('--max-copies', type=int, default=5, help='concurrent snapshot copies per region in fleet mode')
+    parser.add_argument('--max-restores', type=int, default=5, help='concurrent restores per region in fleet mode')
+    add_migration_arguments(parser)
+    parser.add_argument('--scale-back', action='store_true', help='only put the -encrypted instance back on the source\'s class and storage, run once CDC has caught up')
+
+parser = argparse.ArgumentParser(description="Create encrypted database")
+add_arguments(parser)
+parser.add_argument('--trace', help='write a Chrome trace of the phases and AWS API calls to this file and print a call summary')
 
-def create_snapshot(snapshot_id):
+def create_snapshot(rds, db_instance_id, snapshot_id):
     print(f"### Creating snapshot for RDS instance '{db_instance_id}'...")
     try:
         response = rds.create_db_snapshot(
@@ -26,7 +86,7 @@ def create_snapshot(snapshot_id):
     except Exception as e:
         print(f"Error creating snapshot: {e}")
 
-def copy_and_encrypt_snapshot(source_id, dest_id, kms_key=None):
+def copy_and_encrypt_snapshot(rds, source_id, dest_id, kms_key=None):
     print(f"### Copying and encrypting snapshot '{source_id}' to '{dest_id}'...")
     try:
         copy_params = {
@@ -43,10 +103,16 @@ def copy_and_encrypt_snapshot(source_id, dest_id, kms_key=None):
     except Exception as e:
         print(f"Failed to copy/encrypt snapshot: {e}")
 
-def describe_rds_instance(db_instance_identifier):
+# The phase creating what each predicted phase times, the wait times the instance the restore started.
+# The warm-up always reads the whole instance
+PHASE_RESOURCES = {'snapshot': 'snapshot', 'copy': 'copy', 'wait': 'restore'}
+
+def describe_rds_instance(inventory, db_instance_identifier):
     try:
-        response = rds.describe_db_instances(DBInstanceIdentifier=db_instance_identifier)
-        instance = response['DBInstances'][0]
+        instance = inventory.get(db_instance_identifier)
+        if instance is None:
+            print(f"Error describing DB instance: '{db_instance_identifier}' not found")
+            return None
 
         info = {
             'DBInstanceIdentifier': instance['DBInstanceIdentifier'],
@@ -55,6 +121,8 @@ def describe_rds_instance(db_instance_identifier):
             'DBInstanceClass': instance['DBInstanceClass'],
             'StorageType': instance['StorageType'],
             'AllocatedStorage (GB)': instance['AllocatedStorage'],
+            'Iops': instance.get('Iops'),
+            'StorageThroughput': instance.get('StorageThroughput'),
             'VPC': instance['DBSubnetGroup']['VpcId'],
             'DBSubnetGroup': instance['DBSubnetGroup']['DBSubnetGroupName'],
             'VpcSecurityGroups': [sg['VpcSecurityGroupId'] for sg in instance['VpcSecurityGroups']],
@@ -67,28 +135,31 @@ def describe_rds_instance(db_instance_identifier):
         print(f"Error describing DB instance: {e}")
 
 
-def restore_db_instance_from_snapshot():
+def restore_db_instance_from_snapshot(rds, new_db_instance_id, encrypted_snapshot_id, rds_info, boost=None):
     try:
         print(f"### Restoring RDS instance '{new_db_instance_id}' from snapshot '{encrypted_snapshot_id}'...")
 
         restore_params = {
             'DBInstanceIdentifier': new_db_instance_id,
             'DBSnapshotIdentifier': encrypted_snapshot_id,
-            'MultiAZ': multi_az,
-            'AvailabilityZone': availability_zone,
-            'DBInstanceClass': db_instance_class,
+            'MultiAZ': rds_info['MultiAZ'],
+            'AvailabilityZone': rds_info['AvailabilityZone'],
+            'DBInstanceClass': rds_info['DBInstanceClass'],
             'PubliclyAccessible': False,
-            'StorageType': storage_type,
-            'AllocatedStorage': allocated_storage,
+            'StorageType': rds_info['StorageType'],
+            'AllocatedStorage': rds_info['AllocatedStorage (GB)'],
             'AutoMinorVersionUpgrade': True,
-            'DBParameterGroupName': db_parameter_group,  
+            'DBParameterGroupName': ", ".join(rds_info['DBParameterGroups']),
             'CopyTagsToSnapshot': True,
         }
 
-        if db_subnet_group_name:
-            restore_params['DBSubnetGroupName'] = db_subnet_group_name
-        if vpc_security_group_ids:
-            restore_params['VpcSecurityGroupIds'] = vpc_security_group_ids
+        if rds_info['DBSubnetGroup']:
+            restore_params['DBSubnetGroupName'] = rds_info['DBSubnetGroup']
+        if rds_info['VpcSecurityGroups']:
+            restore_params['VpcSecurityGroupIds'] = rds_info['VpcSecurityGroups']
+        if boost:
+            print(f"Restoring onto the boost shape {boost}")
+            restore_params.update(boost)
 
         response = rds.restore_db_instance_from_db_snapshot(**restore_params)
         print(f"Restore initiated. DB Instance ID: {response['DBInstance']['DBInstanceIdentifier']}")
@@ -96,74 +167,311 @@ def restore_db_instance_from_snapshot():
     except Exception as e:
         print(f"Error restoring DB instance: {e}")
 
-def get_rds_kms_arn(region=aws_region):
-    kms = boto3.client('kms', region_name=region)
+def get_rds_kms_arn(kms, db_instance_id):
     try:
         response = kms.describe_key(KeyId=f'alias/{db_instance_id}/rds')
         return response['KeyMetadata']['Arn']
     except Exception as e:
         print(f"Error fetching database RDS KMS key: {e}")
 
-def wait_for_db_instance(db_instance_id):
+def wait_for_db_instance(poller, db_instance_id, expected=None):
     print(f"Waiting for encrypted DB instance '{db_instance_id}' to become available...")
-    waiter = rds.get_waiter('db_instance_available')
-    try:
-        waiter.wait(
-            DBInstanceIdentifier=db_instance_id,
-            WaiterConfig={
-                'Delay': 30,
-                'MaxAttempts': 20
-            }
-        )
+    if poller.wait_for_db_instance(db_instance_id, expected):
         print("Encrypted DB instance is now available.\n")
-    except Exception as e:
-        print(f"Error while waiting: {e}")        
+        return True
+    print(f"Error while waiting: DB instance '{db_instance_id}' did not become available")
 
-def wait_for_snapshot(snapshot_id, snap_type=None):
+def wait_for_snapshot(poller, snapshot_id, snap_type=None, expected=None):
     if snap_type != None:
         print(f"Waiting for {snap_type} snapshot '{snapshot_id}' to become available...")
     else:
         print(f"Waiting for snapshot '{snapshot_id}' to become available...")
-    waiter = rds.get_waiter('db_snapshot_available')
-    try:
-        waiter.wait(
-            DBSnapshotIdentifier=snapshot_id,
-            WaiterConfig={
-                'Delay': 30,  
-                'MaxAttempts': 20  
-            }
-        )
+    if poller.wait_for_snapshot(snapshot_id, expected):
         print("Snapshot is now available.\n")
+        return True
+    print(f"Error while waiting for snapshot: '{snapshot_id}' did not become available")
+
+def get_snapshot_status(rds, snapshot_id):
+    try:
+        response = rds.describe_db_snapshots(DBSnapshotIdentifier=snapshot_id)
+        return response['DBSnapshots'][0]['Status']
+    except rds.exceptions.DBSnapshotNotFoundFault:
+        return None
+
+def get_db_instance_status(rds, db_instance_id):
+    try:
+        response = rds.describe_db_instances(DBInstanceIdentifier=db_instance_id)
+        return response['DBInstances'][0]['DBInstanceStatus']
+    except rds.exceptions.DBInstanceNotFoundFault:
+        return None
+
+def find_automated_snapshot(rds, db_instance_id, max_age_hours):
+    # Newest available automated snapshot of the instance, if it's no older than max_age_hours
+    paginator = rds.get_paginator('describe_db_snapshots')
+    snapshots = []
+    try:
+        for page in paginator.paginate(DBInstanceIdentifier=db_instance_id, SnapshotType='automated'):
+            snapshots.extend(snapshot for snapshot in page['DBSnapshots'] if snapshot['Status'] == 'available')
     except Exception as e:
-        print(f"Error while waiting for snapshot: {e}")
+        print(f"Error listing automated snapshots: {e}")
+        return None
+
+    if not snapshots:
+        return None
+    newest = max(snapshots, key=lambda snapshot: snapshot['SnapshotCreateTime'])
+    age = datetime.now(timezone.utc) - newest['SnapshotCreateTime']
+    if age > timedelta(hours=max_age_hours):
+        print(f"Newest automated snapshot '{newest['DBSnapshotIdentifier']}' is {age.total_seconds() / 3600:.1f} hours old, older than {max_age_hours} hours")
+        return None
+    return newest['DBSnapshotIdentifier']
+
+def take_snapshot(rds, poller, db_instance_id, snapshot_id, max_automated_snapshot_age=None, expected=None, created=None):
+    # With max_automated_snapshot_age set, a recent enough automated snapshot is used as the copy source
+    # and the manual snapshot is only taken when there isn't one. 'snapshot' is added to the created set
+    # when the snapshot is taken here rather than reused
+    if max_automated_snapshot_age is not None:
+        automated_snapshot_id = find_automated_snapshot(rds, db_instance_id, max_automated_snapshot_age)
+        if automated_snapshot_id:
+            print(f"Using automated snapshot '{automated_snapshot_id}' as the copy source\n")
+            return automated_snapshot_id
+        print("No suitable automated snapshot found, taking a manual snapshot")
+
+    status = get_snapshot_status(rds, snapshot_id)
+    if status:
+        print(f"Snapshot '{snapshot_id}' already exists ({status}), reusing it")
+    else:
+        snapshot_id = create_snapshot(rds, db_instance_id, snapshot_id)
+        if snapshot_id and created is not None:
+            created.add('snapshot')
+    if snapshot_id and wait_for_snapshot(poller, snapshot_id, expected=expected):
+        return snapshot_id
+
+def take_encrypted_copy(rds, poller, snapshot_id, encrypted_snapshot_id, kms_key_id, expected=None, created=None):
+    status = get_snapshot_status(rds, encrypted_snapshot_id)
+    if status:
+        print(f"Encrypted snapshot '{encrypted_snapshot_id}' already exists ({status}), reusing it")
+        copied_snapshot_id = encrypted_snapshot_id
+    else:
+        copied_snapshot_id = copy_and_encrypt_snapshot(rds, snapshot_id, encrypted_snapshot_id, kms_key_id)
+        if copied_snapshot_id and created is not None:
+            created.add('copy')
+    if copied_snapshot_id and wait_for_snapshot(poller, copied_snapshot_id, "encrypted", expected):
+        return copied_snapshot_id
+
+def start_restore(rds, inventory, new_db_instance_id, encrypted_snapshot_id, rds_info, boost=None, created=None):
+    status = get_db_instance_status(rds, new_db_instance_id)
+    if status:
+        print(f"DB instance '{new_db_instance_id}' already exists ({status}), reusing it")
+        return new_db_instance_id
+    restored_id = restore_db_instance_from_snapshot(rds, new_db_instance_id, encrypted_snapshot_id, rds_info, boost)
+    inventory.invalidate(new_db_instance_id)
+    if restored_id and created is not None:
+        created.add('restore')
+    return restored_id
+
+def start_side_tasks(executor, state, db_instance_id, region, bucket):
+    # Work that doesn't depend on the snapshot: backing up the CF template and preparing the DMS
+    # template. The DMS template predicts the target endpoint since the instance isn't restored yet
+    for script_dir in ('cloudformation-changes', 'setup-aws-dms'):
+        if os.path.join(SCRIPTS_DIR, script_dir) not in sys.path:
+            sys.path.append(os.path.join(SCRIPTS_DIR, script_dir))
+    import cf_changes
+    import generate_dms_cf_template
+
+    cf = clients.get_client('cloudformation', region)
+    s3 = clients.get_client('s3', region)
+    ec2 = clients.get_client('ec2', region)
+    iam = clients.get_client('iam')
+    inventory = get_inventory(region)
+
+    return {
+        'cf-backup': executor.submit(state.run, 'cf-backup', lambda: cf_changes.backup_original_template(cf, s3, db_instance_id, bucket)),
+        'dms-template': executor.submit(state.run, 'dms-template', lambda: generate_dms_cf_template.prepare_dms_template(inventory, ec2, iam, s3, db_instance_id, bucket, target_exists=False))
+    }
+
+def warm_up_restored_instance(inventory, cf, stack_name, new_db_instance_id, db_user, concurrency):
+    password = get_stack_password(cf, stack_name)
+    if not password:
+        return None
+    try:
+        endpoint = inventory.get(new_db_instance_id)['Endpoint']['Address']
+        return warm_up(endpoint, db_user, password, concurrency=concurrency)
+    except Exception as e:
+        print(f"Error warming up DB instance: {e}")
+
+def migrate_instance(db_instance_id, region, limits=None, state_dir=DEFAULT_STATE_DIR, pipeline_bucket=None, max_automated_snapshot_age=None,
+                     warm_up_concurrency=None, db_user='cosmos', boost_class=None, boost_iops=None, boost_throughput=None,
+                     history_file=DEFAULT_HISTORY_FILE, until=None):
+    # One snapshot -> copy/encrypt -> restore chain, checkpointed phase by phase so a rerun resumes
+    # where the last run stopped. limits is the fleet scheduler's RegionLimits, when set every stage
+    # that counts against an RDS limit runs inside one of its slots. With pipeline_bucket set, the
+    # lookups and template preparation run while the snapshot is in flight. With max_automated_snapshot_age
+    # set, a recent automated snapshot replaces the manual one. With warm_up_concurrency set, the restored
+    # instance's tables and indexes are read once it is available. With boost_class set, the instance is
+    # restored onto that class and gp3 storage, scale_back_instance() puts it back on the source's shape.
+    # Phase durations are recorded to history_file and used to predict this run's. With until set to
+    # 'snapshot' or 'copy', the chain stops after that phase and a later call picks up from there
+    def slot(name):
+        return limits.slot(name) if limits else nullcontext()
+
+    # Clients are shared with every other migration in the region
+    rds = clients.get_client('rds', region)
+    kms = clients.get_client('kms', region)
+    inventory = get_inventory(region)
+    poller = get_status_poller(region)
+
+    state = MigrationState.load(db_instance_id, region, state_dir)
+    state.label = f"{region}/{db_instance_id}"
+    resume_phase = state.first_incomplete_phase()
+    if resume_phase is None:
+        print(f"### Migration of '{db_instance_id}' already completed, only optional steps left to check")
+    elif resume_phase != PHASES[0]:
+        print(f"### Resuming migration of '{db_instance_id}' from phase '{resume_phase}'")
 
-if __name__ == "__main__":
     snapshot_id = f"{db_instance_id}-snapshot"
     encrypted_snapshot_id = f"{snapshot_id}-encrypted"
     new_db_instance_id = f"{db_instance_id}-encrypted"
 
-    # Take RDS snapshot
-    snapshot_id = create_snapshot(snapshot_id)
-    if snapshot_id:
-        wait_for_snapshot(snapshot_id)
-
-    # Copy snapshot and encrypt
-    kms_key_id = get_rds_kms_arn(aws_region)
-    copied_snapshot_id = copy_and_encrypt_snapshot(snapshot_id, encrypted_snapshot_id, kms_key_id)
-    if copied_snapshot_id:
-        wait_for_snapshot(copied_snapshot_id, "encrypted")
-
-    # Restore snapshot to encrypted RDS instance
-    rds_info = describe_rds_instance(db_instance_id)
-    multi_az = rds_info['MultiAZ']
-    availability_zone = rds_info['AvailabilityZone']
-    db_instance_class = rds_info['DBInstanceClass']
-    storage_type = rds_info['StorageType']
-    allocated_storage = rds_info['AllocatedStorage (GB)']
-    db_subnet_group_name = rds_info['DBSubnetGroup']
-    vpc_security_group_ids = rds_info['VpcSecurityGroups']
-    db_parameter_group = ", ".join(rds_info['DBParameterGroups'])
-
-    db_instance_id = restore_db_instance_from_snapshot()
-    if db_instance_id:
-        wait_for_db_instance(db_instance_id)
\ No newline at end of file
+    lookups = {
+        'kms': lambda: state.run('kms', lambda: get_rds_kms_arn(kms, db_instance_id)),
+        'describe': lambda: state.run('describe', lambda: describe_rds_instance(inventory, db_instance_id))
+    }
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = {}
+        if pipeline_bucket:
+            futures = {name: executor.submit(lookup) for name, lookup in lookups.items()}
+            futures.update(start_side_tasks(executor, state, db_instance_id, region, pipeline_bucket))
+
+        def lookup(name):
+            return futures[name].result() if name in futures else lookups[name]()
+
+        # The source's shape drives the snapshot/copy predictions, the restored instance's the later ones
+        rds_info = lookup('describe')
+        if not rds_info:
+            return None
+        boost = boost_profile(rds_info, boost_class, boost_iops, boost_throughput) if boost_class else None
+        target_info = {**rds_info, **boost} if boost else rds_info
+
+        history = load_history(history_file)
+        predictions = predict(history, rds_info, region)
+        predictions.update({phase: seconds for phase, seconds in predict(history, target_info, region).items() if phase in ('wait', 'warm-up')})
+        if not warm_up_concurrency:
+            predictions.pop('warm-up', None)
+        print_prediction(db_instance_id, predictions)
+
+        # Phases whose resource was created by this run. A reused snapshot or instance, an automated snapshot or
+        # a wait picking up after a crash only takes a fraction of the real time and would drag the predictions down
+        created = set()
+
+        def on_phase_done(phase, duration, result):
+            resource = PHASE_RESOURCES.get(phase)
+            if phase not in PREDICTED_PHASES or (resource and resource not in created):
+                return
+            record_phase(history_file, phase, duration, target_info if phase in ('wait', 'warm-up') else rds_info, region)
+        state.on_phase_done = on_phase_done
+
+        # Take RDS snapshot
+        with slot('snapshot'):
+            snapshot_id = state.run('snapshot', lambda: take_snapshot(rds, poller, db_instance_id, snapshot_id, max_automated_snapshot_age, predictions.get('snapshot'), created))
+        if not snapshot_id or until == 'snapshot':
+            return snapshot_id
+
+        # Copy snapshot and encrypt
+        kms_key_id = lookup('kms')
+        if not kms_key_id:
+            return None
+        with slot('copy'):
+            copied_snapshot_id = state.run('copy', lambda: take_encrypted_copy(rds, poller, snapshot_id, encrypted_snapshot_id, kms_key_id, predictions.get('copy'), created))
+        if not copied_snapshot_id or until == 'copy':
+            return copied_snapshot_id
+
+        # Restore snapshot to encrypted RDS instance
+        with slot('restore'):
+            new_db_instance_id = state.run('restore', lambda: start_restore(rds, inventory, new_db_instance_id, copied_snapshot_id, rds_info, boost, created))
+            if not new_db_instance_id:
+                return None
+            new_db_instance_id = state.run('wait', lambda: wait_for_db_instance(poller, new_db_instance_id, predictions.get('wait')) and new_db_instance_id)
+            if new_db_instance_id:
+                # Another job's listing may have cached it while it was still being created
+                inventory.invalidate(new_db_instance_id)
+
+        if new_db_instance_id and warm_up_concurrency:
+            cf = clients.get_client('cloudformation', region)
+            if not state.run('warm-up', lambda: warm_up_restored_instance(inventory, cf, db_instance_id, new_db_instance_id, db_user, warm_up_concurrency)):
+                print(f"Warning: warm-up of '{new_db_instance_id}' didn't complete, rerun to retry it")
+
+        for name in ('cf-backup', 'dms-template'):
+            if name in futures and not futures[name].result():
+                print(f"Warning: '{name}' step failed for '{db_instance_id}', run it separately before the CF changes")
+
+    return new_db_instance_id
+
+def pending_quota_phases(db_instance_id, region, state_dir=DEFAULT_STATE_DIR, max_automated_snapshot_age=None, until=None):
+    # The phases that count against RDS quotas the migration still has to run, with their last recorded status
+    state = MigrationState.load(db_instance_id, region, state_dir)
+    phases = PHASES[:PHASES.index(until) + 1] if until else PHASES
+    pending = {phase: state.status(phase) for phase in PHASE_QUOTA_USAGE if phase in phases and not state.is_done(phase)}
+    if 'snapshot' in pending and max_automated_snapshot_age is not None:
+        # The automated snapshot is copied instead of taking a manual one
+        if find_automated_snapshot(clients.get_client('rds', region), db_instance_id, max_automated_snapshot_age):
+            del pending['snapshot']
+    return pending
+
+def scale_back_instance(db_instance_id, region):
+    rds = clients.get_client('rds', region)
+    inventory = get_inventory(region)
+    rds_info = describe_rds_instance(inventory, db_instance_id)
+    if not rds_info:
+        return None
+    scaled_back = scale_back(rds, get_status_poller(region), f"{db_instance_id}-encrypted", rds_info)
+    inventory.invalidate(f"{db_instance_id}-encrypted")
+    return scaled_back
+
+def migration_options(args):
+    return {
+        'state_dir': args.state_dir,
+        'pipeline_bucket': args.pipeline_bucket,
+        'max_automated_snapshot_age': args.max_automated_snapshot_age,
+        'warm_up_concurrency': args.warm_up_concurrency if args.warm_up else None,
+        'db_user': args.db_user,
+        'boost_class': args.boost_class,
+        'boost_iops': args.boost_iops,
+        'boost_throughput': args.boost_throughput,
+        'history_file': args.history_file
+    }
+
+def pool_size(max_workers):
+    # Up to 4 threads per migration share each region's clients, plus the status poller
+    return max(clients.DEFAULT_MAX_POOL_CONNECTIONS, max_workers * 4 + 1)
+
+def main(args, until=None):
+    if args.db and not args.region:
+        raise SystemExit("--region is required with --db")
+    options = migration_options(args)
+
+    if args.scale_back:
+        jobs = [(args.db, args.region)] if args.db else read_fleet_file(args.fleet, args.region)
+        with ThreadPoolExecutor(max_workers=args.max_workers) as executor:
+            return list(executor.map(lambda job: scale_back_instance(*job), jobs))
+    if args.db:
+        return migrate_instance(args.db, args.region, until=until, **options)
+
+    jobs = read_fleet_file(args.fleet, args.region)
+    region_limits = {
+        'snapshot': args.max_snapshots,
+        'copy': args.max_copies,
+        'restore': args.max_restores
+    }
+    rds_clients = {region: clients.get_client('rds', region) for region in {region for _, region in jobs}}
+    scheduler = FleetScheduler(rds_clients, region_limits, args.max_workers,
+                               lambda db, region: pending_quota_phases(db, region, options['state_dir'], options['max_automated_snapshot_age'], until))
+    results = scheduler.run(jobs, lambda db, region, limits: migrate_instance(db, region, limits, until=until, **options))
+    print_fleet_summary(results)
+    return results
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    clients.configure(max_pool_connections=pool_size(args.max_workers))
+    with tracing.traced(args.trace):
+        main(args)
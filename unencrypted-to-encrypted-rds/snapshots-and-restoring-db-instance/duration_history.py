@@ -0,0 +1,89 @@
+# Phase duration history and ETA predictions for create_encrypted_rds.py
+#
+# Every completed phase is appended to a JSON lines file together with the instance's storage size,
+# storage type, class and region. Before a run, the durations of the closest matching past runs are
+# fitted against storage size to predict each phase, the poller then uses those predictions to time
+# its checks and to warn when a phase runs well past its prediction.
+
+import json
+import os
+import threading
+from datetime import datetime, timezone
+
+DEFAULT_HISTORY_FILE = ".migration-history.jsonl"
+
+# Phases worth predicting, the others are single API calls
+PREDICTED_PHASES = ['snapshot', 'copy', 'wait', 'warm-up']
+
+_history_lock = threading.Lock()
+
+def record_phase(history_file, phase, duration, rds_info, region):
+    record = {
+        'phase': phase,
+        'duration': round(duration, 1),
+        'AllocatedStorage': rds_info['AllocatedStorage (GB)'],
+        'StorageType': rds_info['StorageType'],
+        'DBInstanceClass': rds_info['DBInstanceClass'],
+        'region': region,
+        'recorded': datetime.now(timezone.utc).isoformat()
+    }
+    with _history_lock:
+        with open(history_file, 'a') as f:
+            f.write(json.dumps(record) + "\n")
+
+def load_history(history_file):
+    if not os.path.exists(history_file):
+        return []
+    with open(history_file, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def fit_duration(samples, storage):
+    # Least squares fit of duration = a + b * storage, or plain scaling by size when all samples share one size
+    sizes = [sample['AllocatedStorage'] for sample in samples]
+    durations = [sample['duration'] for sample in samples]
+    mean_size = sum(sizes) / len(sizes)
+    mean_duration = sum(durations) / len(durations)
+
+    variance = sum((size - mean_size) ** 2 for size in sizes)
+    if variance == 0:
+        return mean_duration * storage / mean_size if mean_size else mean_duration
+
+    slope = sum((size - mean_size) * (duration - mean_duration) for size, duration in zip(sizes, durations)) / variance
+    slope = max(slope, 0)
+    return max(mean_duration + slope * (storage - mean_size), 0)
+
+def predict_phase(history, phase, rds_info, region):
+    samples = [record for record in history if record['phase'] == phase]
+    # Narrow down to the closest matching runs, dropping criteria until something matches
+    criteria = [
+        lambda r: r['region'] == region and r['DBInstanceClass'] == rds_info['DBInstanceClass'] and r['StorageType'] == rds_info['StorageType'],
+        lambda r: r['DBInstanceClass'] == rds_info['DBInstanceClass'] and r['StorageType'] == rds_info['StorageType'],
+        lambda r: r['StorageType'] == rds_info['StorageType'],
+        lambda r: True
+    ]
+    for matches in criteria:
+        subset = [record for record in samples if matches(record)]
+        if subset:
+            return fit_duration(subset, rds_info['AllocatedStorage (GB)'])
+    return None
+
+def predict(history, rds_info, region):
+    predictions = {}
+    for phase in PREDICTED_PHASES:
+        predicted = predict_phase(history, phase, rds_info, region)
+        if predicted is not None:
+            predictions[phase] = predicted
+    return predictions
+
+def format_duration(seconds):
+    minutes = int(round(seconds / 60))
+    if minutes < 60:
+        return f"{minutes} min"
+    return f"{minutes // 60} h {minutes % 60} min"
+
+def print_prediction(db_instance_id, predictions):
+    if not predictions:
+        print(f"No migration history yet, no ETA for '{db_instance_id}'")
+        return
+    phases = ", ".join(f"{phase} ~{format_duration(seconds)}" for phase, seconds in predictions.items())
+    print(f"### Predicted duration for '{db_instance_id}': ~{format_duration(sum(predictions.values()))} ({phases})")
@@ -0,0 +1,175 @@
+# Quota-aware job scheduler used by create_encrypted_rds.py --fleet
+#
+# Each job is one snapshot -> copy/encrypt -> restore chain. Jobs run concurrently, but every
+# stage that counts against an RDS limit has to take a per-region slot first, so jobs queue
+# behind each other instead of failing with SnapshotQuotaExceeded and friends. A job that can't reserve
+# its share of the account quotas waits in its region's queue and is retried whenever another job of the
+# region finishes and gives headroom back. It is only reported as deferred once nothing else in the region
+# is running, as nothing could free any more headroom then.
+
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+
+# Concurrent operations allowed per region
+DEFAULT_REGION_LIMITS = {
+    'snapshot': 5,
+    'copy': 5,
+    'restore': 5
+}
+
+# Account quotas consumed by the phases of one migration: the manual snapshot, its encrypted copy and the new instance
+PHASE_QUOTA_USAGE = {
+    'snapshot': {'ManualSnapshots': 1},
+    'copy': {'ManualSnapshots': 1},
+    'restore': {'DBInstances': 1}
+}
+
+def quota_usage(phases):
+    usage = {}
+    for phase in phases:
+        for quota, amount in PHASE_QUOTA_USAGE.get(phase, {}).items():
+            usage[quota] = usage.get(quota, 0) + amount
+    return usage
+
+JOB_QUOTA_USAGE = quota_usage(PHASE_QUOTA_USAGE)
+
+class RegionLimits:
+    def __init__(self, region, rds, limits=None):
+        self.region = region
+        self.semaphores = {name: threading.BoundedSemaphore(count) for name, count in (limits or DEFAULT_REGION_LIMITS).items()}
+        self.headroom = get_quota_headroom(rds)
+        self.lock = threading.Lock()
+        # Only touched by FleetScheduler.run's thread: jobs waiting for headroom, oldest first, and the jobs started
+        self.waiting = []
+        self.running = 0
+
+    @contextmanager
+    def slot(self, name):
+        semaphore = self.semaphores[name]
+        if not semaphore.acquire(blocking=False):
+            print(f"[{self.region}] Waiting for a free '{name}' slot...")
+            semaphore.acquire()
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+    def reserve(self, usage=JOB_QUOTA_USAGE):
+        # Quotas like ManualSnapshots are only freed by deleting resources, so a job that can't
+        # reserve its share up front is deferred rather than left to fail half way through
+        with self.lock:
+            for quota, amount in usage.items():
+                if quota in self.headroom and self.headroom[quota] < amount:
+                    return False
+            for quota, amount in usage.items():
+                if quota in self.headroom:
+                    self.headroom[quota] -= amount
+            return True
+
+    def release(self, usage):
+        with self.lock:
+            for quota, amount in usage.items():
+                if quota in self.headroom:
+                    self.headroom[quota] += amount
+
+def get_quota_headroom(rds):
+    try:
+        response = rds.describe_account_attributes()
+        return {
+            quota['AccountQuotaName']: quota['Max'] - quota['Used']
+            for quota in response['AccountQuotas']
+            if quota['AccountQuotaName'] in JOB_QUOTA_USAGE
+        }
+    except Exception as e:
+        print(f"Error fetching RDS account quotas: {e}")
+        return {}
+
+class FleetScheduler:
+    def __init__(self, rds_clients, limits=None, max_workers=10, pending_phases=None):
+        # pending_phases(db_instance_id, region) returns the phases of PHASE_QUOTA_USAGE the job still has to
+        # run, each with its last recorded status or None when it was never started. Without it every job
+        # reserves all of them
+        self.region_limits = {region: RegionLimits(region, rds, limits) for region, rds in rds_clients.items()}
+        self.max_workers = max_workers
+        self.pending_phases = pending_phases
+
+    def _pending_phases(self, db_instance_id, region):
+        if self.pending_phases:
+            return self.pending_phases(db_instance_id, region)
+        return {phase: None for phase in PHASE_QUOTA_USAGE}
+
+    def _reserve(self, db_instance_id, region):
+        # The phases reserved for, None when the region hasn't got the headroom for them right now
+        # Resumed jobs and reused snapshots only reserve what is left to create
+        phases = self._pending_phases(db_instance_id, region)
+        if not self.region_limits[region].reserve(quota_usage(phases)):
+            return None
+        return phases
+
+    def _run_job(self, migrate, db_instance_id, region, phases):
+        limits = self.region_limits[region]
+        start = time.monotonic()
+        try:
+            new_db_instance_id = migrate(db_instance_id, region, limits)
+            error = "see output above"
+        except Exception as e:
+            new_db_instance_id = None
+            error = str(e)
+        if new_db_instance_id:
+            return 'completed', time.monotonic() - start, None
+
+        # Phases the job never got to created nothing, give their share back to the other jobs
+        not_started = [phase for phase, status in self._pending_phases(db_instance_id, region).items() if phase in phases and status is None]
+        limits.release(quota_usage(not_started))
+        return 'failed', time.monotonic() - start, error
+
+    def run(self, jobs, migrate):
+        results = {}
+        futures = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            def start(db, region):
+                limits = self.region_limits[region]
+                phases = self._reserve(db, region)
+                if phases is None:
+                    limits.waiting.append(db)
+                    return
+                limits.running += 1
+                futures[executor.submit(self._run_job, migrate, db, region, phases)] = (db, region)
+
+            def retry_waiting(region):
+                # In the order they were queued, a smaller job further back can still fit
+                limits = self.region_limits[region]
+                waiting, limits.waiting = limits.waiting, []
+                for db in waiting:
+                    start(db, region)
+                if not limits.running:
+                    for db in limits.waiting:
+                        results[(db, region)] = ('deferred', 0, f"not enough RDS quota headroom left in {region}")
+                    limits.waiting = []
+                elif limits.waiting:
+                    print(f"[{region}] Waiting for RDS quota headroom: {', '.join(limits.waiting)}")
+
+            for db, region in jobs:
+                start(db, region)
+            for region in self.region_limits:
+                retry_waiting(region)
+
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    db, region = futures.pop(future)
+                    results[(db, region)] = future.result()
+                    self.region_limits[region].running -= 1
+                    # The job has released whatever it gave back by now
+                    retry_waiting(region)
+        return results
+
+def print_fleet_summary(results):
+    print("### Fleet summary")
+    for (db, region), (status, elapsed, error) in sorted(results.items()):
+        line = f"{db} ({region}): {status} in {elapsed / 60:.1f} min"
+        if error:
+            line += f" - {error}"
+        print(line)
@@ -0,0 +1,85 @@
+# Durable per-migration state for create_encrypted_rds.py
+#
+# Every phase of a migration (snapshot, kms, copy, describe, restore, wait) is checkpointed to a
+# small JSON file once it completes, so a rerun after a crash picks up at the first phase that
+# didn't finish instead of starting again from the snapshot. Delete the file to start over.
+
+import json
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+from common import tracing
+
+DEFAULT_STATE_DIR = ".migration-state"
+
+PHASES = ['snapshot', 'kms', 'copy', 'describe', 'restore', 'wait']
+
+class MigrationState:
+    def __init__(self, path):
+        self.path = path
+        self.state = {'phases': {}}
+        # Pipelined runs checkpoint phases from several threads
+        self.lock = threading.Lock()
+        # Called with (phase, duration, result) whenever a phase completes
+        self.on_phase_done = None
+        # Prefix for the phase markers in traces
+        self.label = None
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.state = json.load(f)
+
+    @classmethod
+    def load(cls, db_instance_id, region, state_dir=DEFAULT_STATE_DIR):
+        os.makedirs(state_dir, exist_ok=True)
+        return cls(os.path.join(state_dir, f"{region}-{db_instance_id}.json"))
+
+    def save(self):
+        # Write to a temporary file first so a crash mid-write never leaves a truncated state file
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def status(self, phase):
+        # 'done' or 'failed', None when the phase was never run
+        return self.state['phases'].get(phase, {}).get('status')
+
+    def is_done(self, phase):
+        return self.state['phases'].get(phase, {}).get('status') == 'done'
+
+    def result(self, phase):
+        return self.state['phases'].get(phase, {}).get('result')
+
+    def first_incomplete_phase(self):
+        for phase in PHASES:
+            if not self.is_done(phase):
+                return phase
+        return None
+
+    def run(self, phase, step):
+        # Runs step() unless the phase already completed, in which case its recorded result is returned.
+        # A step signals failure by returning None or False, like the rest of create_encrypted_rds.py
+        if self.is_done(phase):
+            print(f"Phase '{phase}' already completed, skipping")
+            return self.result(phase)
+
+        start = time.monotonic()
+        with tracing.phase(phase, self.label):
+            result = step()
+        record = {
+            'status': 'done' if result not in (None, False) else 'failed',
+            'result': result,
+            'duration': round(time.monotonic() - start, 1),
+            'updated': datetime.now(timezone.utc).isoformat()
+        }
+        with self.lock:
+            self.state['phases'][phase] = record
+            self.save()
+        if record['status'] == 'failed':
+            print(f"Phase '{phase}' failed, rerun to resume from here (state file: {self.path})")
+            return None
+        if self.on_phase_done:
+            self.on_phase_done(phase, record['duration'], result)
+        return result
@@ -0,0 +1,206 @@
+# Shared status poller for RDS snapshots and instances
+#
+# Replaces one boto3 waiter per resource with a single background thread per region. Every
+# pending snapshot and instance is checked through a few filtered describe_db_snapshots /
+# describe_db_instances calls, and each resource is re-checked on its own adaptive schedule:
+# snapshots are polled based on how fast PercentProgress is moving, everything else backs off
+# while nothing changes. There is no overall timeout, large snapshots can take hours. When a
+# predicted duration is passed in (see duration_history.py), it times the checks of resources
+# without progress information and a warning is printed once a resource runs well past it.
+
+import threading
+import time
+
+from common import clients
+
+MIN_DELAY = 5
+MAX_DELAY = 60
+
+# Describe filters accept a limited number of values per call
+FILTER_BATCH_SIZE = 50
+
+# Warn when a resource takes this many times longer than predicted
+OVERDUE_FACTOR = 1.5
+
+# A resource that doesn't show up in this many polls in a row is treated as gone
+MAX_MISSING_POLLS = 5
+
+FAILED_SNAPSHOT_STATUSES = {'failed', 'error', 'deleted'}
+FAILED_INSTANCE_STATUSES = {
+    'failed',
+    'incompatible-restore',
+    'incompatible-parameters',
+    'incompatible-network',
+    'inaccessible-encryption-credentials',
+    'storage-full',
+    'deleting'
+}
+
+class PendingResource:
+    def __init__(self, kind, resource_id, expected=None):
+        self.kind = kind
+        self.resource_id = resource_id
+        self.expected = expected
+        self.started = time.monotonic()
+        self.overdue_warned = False
+        self.done = threading.Event()
+        self.succeeded = False
+        self.status = None
+        self.progress = None
+        self.first_progress = None
+        self.delay = MIN_DELAY
+        self.next_check = time.monotonic()
+        self.missing_polls = 0
+
+    def finish(self, succeeded):
+        self.succeeded = succeeded
+        self.done.set()
+
+    def update(self, status, progress=None):
+        now = time.monotonic()
+        changed = status != self.status or progress != self.progress
+        self.status = status
+        self.missing_polls = 0
+
+        eta = None
+        if progress is not None:
+            if self.first_progress is None:
+                self.first_progress = (now, progress)
+            self.progress = progress
+            eta = self.eta(now)
+        if eta is None and self.expected and self.expected > now - self.started:
+            eta = self.expected - (now - self.started)
+
+        if eta is not None:
+            # Check again half way to the expected completion, so the last poll lands close to it
+            self.delay = min(max(eta / 2, MIN_DELAY), MAX_DELAY)
+        elif changed:
+            self.delay = MIN_DELAY
+        else:
+            self.delay = min(self.delay * 1.5, MAX_DELAY)
+
+        if self.expected and not self.overdue_warned and now - self.started > self.expected * OVERDUE_FACTOR:
+            self.overdue_warned = True
+            print(f"Warning: {self.kind} '{self.resource_id}' has taken {(now - self.started) / 60:.0f} min, predicted {self.expected / 60:.0f} min")
+
+        self.next_check = now + self.delay
+        return changed
+
+    def eta(self, now):
+        start, start_progress = self.first_progress
+        if self.progress <= start_progress or now <= start:
+            return None
+        rate = (self.progress - start_progress) / (now - start)
+        return (100 - self.progress) / rate
+
+class StatusPoller:
+    def __init__(self, rds):
+        self.rds = rds
+        self.pending = {}
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def wait_for_snapshot(self, snapshot_id, expected=None):
+        return self._wait('snapshot', snapshot_id, expected)
+
+    def wait_for_db_instance(self, db_instance_id, expected=None):
+        return self._wait('instance', db_instance_id, expected)
+
+    def _wait(self, kind, resource_id, expected=None):
+        with self.condition:
+            key = (kind, resource_id)
+            if key not in self.pending:
+                self.pending[key] = PendingResource(kind, resource_id, expected)
+            resource = self.pending[key]
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+        resource.done.wait()
+        return resource.succeeded
+
+    def _run(self):
+        while True:
+            with self.condition:
+                if not self.pending:
+                    self.thread = None
+                    return
+                now = time.monotonic()
+                next_check = min(resource.next_check for resource in self.pending.values())
+                if next_check > now:
+                    # Woken early when a new resource is registered
+                    self.condition.wait(next_check - now)
+                    continue
+                due = [resource for resource in self.pending.values() if resource.next_check <= now]
+
+            try:
+                self._poll([r for r in due if r.kind == 'snapshot'], [r for r in due if r.kind == 'instance'])
+            except Exception as e:
+                print(f"Error while polling RDS status: {e}")
+                for resource in due:
+                    resource.delay = min(resource.delay * 2, MAX_DELAY)
+                    resource.next_check = time.monotonic() + resource.delay
+
+            with self.condition:
+                for resource in due:
+                    if resource.done.is_set():
+                        self.pending.pop((resource.kind, resource.resource_id), None)
+
+    def _poll(self, snapshots, instances):
+        if snapshots:
+            found = self._describe('describe_db_snapshots', 'DBSnapshots', 'db-snapshot-id', 'DBSnapshotIdentifier', snapshots)
+            for resource in snapshots:
+                snapshot = found.get(resource.resource_id)
+                if snapshot is None:
+                    self._missing(resource)
+                    continue
+                if resource.update(snapshot['Status'], snapshot.get('PercentProgress')):
+                    print(f"Snapshot '{resource.resource_id}': {snapshot['Status']} ({snapshot.get('PercentProgress', 0)}%)")
+                if snapshot['Status'] == 'available':
+                    resource.finish(True)
+                elif snapshot['Status'] in FAILED_SNAPSHOT_STATUSES:
+                    resource.finish(False)
+
+        if instances:
+            found = self._describe('describe_db_instances', 'DBInstances', 'db-instance-id', 'DBInstanceIdentifier', instances)
+            for resource in instances:
+                instance = found.get(resource.resource_id)
+                if instance is None:
+                    self._missing(resource)
+                    continue
+                if resource.update(instance['DBInstanceStatus']):
+                    print(f"DB instance '{resource.resource_id}': {instance['DBInstanceStatus']}")
+                # A modification applied immediately can still be pending while the status reads available
+                if instance['DBInstanceStatus'] == 'available' and not instance.get('PendingModifiedValues'):
+                    resource.finish(True)
+                elif instance['DBInstanceStatus'] in FAILED_INSTANCE_STATUSES:
+                    resource.finish(False)
+
+    def _describe(self, operation, result_key, filter_name, id_key, resources):
+        paginator = self.rds.get_paginator(operation)
+        ids = [resource.resource_id for resource in resources]
+        found = {}
+        for i in range(0, len(ids), FILTER_BATCH_SIZE):
+            filters = [{'Name': filter_name, 'Values': ids[i:i + FILTER_BATCH_SIZE]}]
+            for page in paginator.paginate(Filters=filters):
+                for item in page[result_key]:
+                    found[item[id_key]] = item
+        return found
+
+    def _missing(self, resource):
+        resource.missing_polls += 1
+        if resource.missing_polls >= MAX_MISSING_POLLS:
+            print(f"{resource.kind.capitalize()} '{resource.resource_id}' not found")
+            resource.finish(False)
+            return
+        resource.delay = min(resource.delay * 1.5, MAX_DELAY)
+        resource.next_check = time.monotonic() + resource.delay
+
+_pollers = {}
+_pollers_lock = threading.Lock()
+
+def get_status_poller(region):
+    with _pollers_lock:
+        if region not in _pollers:
+            _pollers[region] = StatusPoller(clients.get_client('rds', region))
+        return _pollers[region]
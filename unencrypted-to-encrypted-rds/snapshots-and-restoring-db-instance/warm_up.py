@@ -0,0 +1,109 @@
+# Usage
+# python3 warm_up.py --host <endpoint> --user <user> --password <password> [--port 3306] [--database <schema>] [--concurrency 8]
+#
+# Reads every table and index of a freshly restored instance so its blocks are pulled in from S3
+# before cutover, instead of the first DMS validation or real query paying the cold-storage latency.
+# create_encrypted_rds.py --warm-up runs this against the new -encrypted instance. Point it at a
+# local MySQL container to try it out, see the README.
+#
+# Needs PyMySQL (pip install pymysql)
+
+import argparse
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.mysql import connect, quote_identifier, schema_filter
+from common.stacks import stack_cache
+
+parser = argparse.ArgumentParser(description="Warm up the storage of a restored RDS instance")
+parser.add_argument('--host', required=True, help='database endpoint')
+parser.add_argument('--port', type=int, default=3306, help='database port')
+parser.add_argument('--user', required=True, help='database user')
+parser.add_argument('--password', required=True, help='database password')
+parser.add_argument('--database', action='append', help='schema to warm up, can be repeated, defaults to all non-system schemas')
+parser.add_argument('--concurrency', type=int, default=8, help='number of tables/indexes read at once')
+
+def list_scan_targets(connection, databases=None):
+    # One target per index, largest tables first so they aren't left running on their own at the end
+    condition, params = schema_filter(databases)
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT t.TABLE_SCHEMA, t.TABLE_NAME, s.INDEX_NAME "
+            "FROM information_schema.TABLES t "
+            "LEFT JOIN information_schema.STATISTICS s ON s.TABLE_SCHEMA = t.TABLE_SCHEMA AND s.TABLE_NAME = t.TABLE_NAME "
+            f"WHERE t.TABLE_TYPE = 'BASE TABLE' AND t.TABLE_SCHEMA {condition} "
+            "GROUP BY t.TABLE_SCHEMA, t.TABLE_NAME, s.INDEX_NAME "
+            "ORDER BY MAX(t.DATA_LENGTH + t.INDEX_LENGTH) DESC, t.TABLE_SCHEMA, t.TABLE_NAME",
+            params
+        )
+        return cursor.fetchall()
+
+def scan_query(schema, table, index):
+    # COUNT(*) forced through an index reads every page of it, the PRIMARY index being the table data itself
+    table_name = f"{quote_identifier(schema)}.{quote_identifier(table)}"
+    if index is None:
+        return f"SELECT COUNT(*) FROM {table_name}"
+    return f"SELECT COUNT(*) FROM {table_name} FORCE INDEX ({quote_identifier(index)})"
+
+def warm_up(host, user, password, port=3306, databases=None, concurrency=8):
+    print(f"### Warming up storage of '{host}'...")
+    connection = connect(host, user, password, port)
+    try:
+        targets = list_scan_targets(connection, databases)
+    finally:
+        connection.close()
+
+    # One connection per worker thread, PyMySQL connections can't be shared
+    local = threading.local()
+    connections = []
+    connections_lock = threading.Lock()
+
+    def scan(target):
+        if not hasattr(local, 'connection'):
+            local.connection = connect(host, user, password, port)
+            with connections_lock:
+                connections.append(local.connection)
+        start = time.monotonic()
+        with local.connection.cursor() as cursor:
+            cursor.execute(scan_query(*target))
+            cursor.fetchall()
+        return time.monotonic() - start
+
+    start = time.monotonic()
+    failed = 0
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = {executor.submit(scan, target): target for target in targets}
+            for done, future in enumerate(as_completed(futures), 1):
+                schema, table, index = futures[future]
+                try:
+                    elapsed = future.result()
+                    print(f"[{done}/{len(targets)}] {schema}.{table} ({index or 'table'}) read in {elapsed:.1f}s")
+                except Exception as e:
+                    failed += 1
+                    print(f"[{done}/{len(targets)}] Error reading {schema}.{table} ({index or 'table'}): {e}")
+    finally:
+        for worker_connection in connections:
+            worker_connection.close()
+
+    print(f"Warm-up finished in {time.monotonic() - start:.1f}s, {len(targets) - failed} of {len(targets)} tables/indexes read\n")
+    return failed == 0
+
+def get_stack_password(cf, stack_name):
+    try:
+        password = stack_cache(cf).get_output(stack_name, "MySQLPassword")
+        if password is not None:
+            return password
+        print(f"Output 'MySQLPassword' not found in stack '{stack_name}'")
+    except Exception as e:
+        print(f"Error fetching stack outputs: {e}")
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    warm_up(args.host, args.user, args.password, args.port, args.database, args.concurrency)
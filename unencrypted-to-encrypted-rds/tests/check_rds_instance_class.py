@@ -1,10 +1,14 @@
-import boto3
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.inventory import get_inventory
 
 def list_rds_instances():
-    client = boto3.client('rds')
-    response = client.describe_db_instances()
+    inventory = get_inventory(None)
     print("RDS instances and their sizes:")
-    for db_instance in response["DBInstances"]:
+    for db_instance in inventory.all():
         instance_id = db_instance["DBInstanceIdentifier"]
         instance_class = db_instance["DBInstanceClass"]
         print(f"Instance ID: {instance_id}, Size: {instance_class}")
@@ -1,5 +1,10 @@
-import boto3
 import argparse
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.inventory import get_inventory
 
 parser = argparse.ArgumentParser(description="Describe RDS instance")
 parser.add_argument('--db', required=True, help='source snapshot')
@@ -11,13 +16,15 @@ args = parser.parse_args()
 AWS_REGION = args.region
 DB_INSTANCE_IDENTIFIER = args.db
 
-# Create RDS client
-rds = boto3.client('rds', region_name=AWS_REGION)
+# Instances are read from the shared inventory cache
+inventory = get_inventory(AWS_REGION)
 
 def describe_rds_instance(instance_id):
     try:
-        response = rds.describe_db_instances(DBInstanceIdentifier=instance_id)
-        instance = response['DBInstances'][0]
+        instance = inventory.get(instance_id)
+        if instance is None:
+            print(f"Error describing DB instance: '{instance_id}' not found")
+            return None
 
         info = {
             'DBInstanceIdentifier': instance['DBInstanceIdentifier'],
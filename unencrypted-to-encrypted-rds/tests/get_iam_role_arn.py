@@ -1,8 +1,13 @@
-import boto3
+import os
+import sys
 from botocore.exceptions import ClientError
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import clients
+
 def get_role_arn(role_name):
-    iam = boto3.client('iam')
+    iam = clients.get_client('iam')
     try:
         response = iam.get_role(RoleName=role_name)
         arn = response['Role']['Arn']
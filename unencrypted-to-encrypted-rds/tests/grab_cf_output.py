@@ -1,4 +1,10 @@
-import boto3
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import clients
+from common.stacks import stack_cache
 
 def get_stack_output(stack_name, output_key):
     """
@@ -8,16 +14,12 @@ def get_stack_output(stack_name, output_key):
     :param output_key: The key of the output value to retrieve
     :return: The value associated with the output key or None if not found
     """
-    cf = boto3.client('cloudformation')
+    cf = clients.get_client('cloudformation')
 
     try:
-        response = cf.describe_stacks(StackName=stack_name)
-        stack = response['Stacks'][0]
-        
-        outputs = stack.get('Outputs', [])
-        for output in outputs:
-            if output['OutputKey'] == output_key:
-                return output['OutputValue']
+        value = stack_cache(cf).get_output(stack_name, output_key)
+        if value is not None:
+            return value
         
         print(f"Output key '{output_key}' not found in stack '{stack_name}'.")
         return None